@@ -0,0 +1,50 @@
+"""Benchmark decoding a banan history, comparing the validated and fast paths.
+
+Run from the backend directory with:
+
+    python -m bench.bench_decode
+"""
+
+import argparse
+import sys
+import timeit
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.fetch_history import (
+    CompressedProfilingHistory,
+    RawProfilingHistory,
+    decompress_history,
+)
+
+
+def validated_path(data: str):
+    return decompress_history(CompressedProfilingHistory.model_validate_json(data))
+
+
+def fast_path(data: str):
+    return RawProfilingHistory.from_json(data).decompress()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ticks", type=int, default=30)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    generator = SyntheticHistoryGenerator(depth=args.depth, fanout=args.fanout)
+    data = generator.generate_json(ticks=args.ticks, max_history=args.ticks + 5)
+    node_count = sum(1 for _ in data.split("[")) - 1
+    print(f"History: {len(data)} bytes, ~{node_count} nodes")
+
+    assert validated_path(data) == fast_path(data)
+
+    for name, func in [("validated", validated_path), ("fast", fast_path)]:
+        best = min(timeit.repeat(lambda: func(data), number=1, repeat=args.repeat))
+        print(f"{name:>10}: {best * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Benchmark scraping, ingesting and exporting end to end, offline.
+
+The backend scrapes `--servers` servers, all answered by `ReplayScreeps`
+from captured responses (or synthetic ones), and pushes to a
+`FakePyroscope`. Scrapes are started at `--rate` per second, at most
+`--concurrency` at a time, and the throughput and latency of the whole
+pipeline and of each stage are reported.
+
+Run from the backend directory with:
+
+    python -m bench.bench_ingest --corpus data/captures --servers 8 --rate 4
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+# The app reads its config and opens the archive when it's imported, so
+# point it at a throwaway config before anything from src is imported
+BENCH_DIR = tempfile.mkdtemp()
+os.environ["CONFIG_FILE"] = os.path.join(BENCH_DIR, "secrets.yml")
+os.environ["ARCHIVE_PATH"] = os.path.join(BENCH_DIR, "archive.sqlite3")
+
+import httpx  # noqa: E402
+
+sys.path.append(".")
+from bench.replay import (  # noqa: E402
+    FakePyroscope,
+    ReplayScreeps,
+    synthetic_responses,
+)
+from src.corpus import ResponseCorpus  # noqa: E402
+
+
+def write_config(servers: int):
+    with open(os.environ["CONFIG_FILE"], "w") as fh:
+        fh.write("banan_history_key: BANAN\nservers:\n")
+        for i in range(servers):
+            fh.write(f"  - name: replay{i}\n    host: replay{i}\n    token: replay\n")
+
+
+async def run(
+    screeps: ReplayScreeps,
+    pyroscope: FakePyroscope,
+    scrapes: int,
+    rate: float,
+    concurrency: int,
+) -> Dict[str, Any]:
+    from src import app as app_module
+    from src.metrics import TICKS
+
+    app_module.screeps_client.http = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=screeps.app)
+    )
+    app_module.exporter.http = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=pyroscope.app)
+    )
+    app_module.exporter.url = "http://pyroscope"
+
+    servers = app_module.config.servers
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    failures = 0
+
+    async def scrape(server_cfg):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await app_module.scrape_server(server_cfg)
+            except Exception as e:
+                failures += 1
+                print(f"Scrape of {server_cfg.name} failed: {e}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(scrapes):
+        if rate:
+            await asyncio.sleep(max(start + i / rate - time.perf_counter(), 0))
+        # Servers are taken in turn, so with at least as many servers as
+        # the concurrency, a server is never scraped twice at once, as in
+        # the app's scraper
+        tasks.append(asyncio.ensure_future(scrape(servers[i % len(servers)])))
+    await asyncio.gather(*tasks)
+    scrape_duration = time.perf_counter() - start
+    await app_module.exporter.flush()
+    duration = time.perf_counter() - start
+
+    def ticks(result: str) -> int:
+        return int(sum(TICKS.get(server=cfg.name, result=result) for cfg in servers))
+
+    latencies.sort()
+    return {
+        "scrapes": scrapes,
+        "failures": failures,
+        "duration_s": duration,
+        "scrapes_per_s": scrapes / scrape_duration,
+        "latency_mean_ms": statistics.mean(latencies) * 1000,
+        "latency_p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+        "ticks_ingested": ticks("ingested"),
+        "ticks_skipped": ticks("skipped"),
+        "ticks_per_s": ticks("ingested") / duration,
+        "profiles_pushed": sum(pyroscope.profiles.values()),
+        "bytes_fetched": screeps.bytes_sent,
+        "bytes_pushed": pyroscope.bytes_received,
+    }
+
+
+def print_stages():
+    """Print the mean time of each stage, from the app's metrics."""
+    from src.metrics import STAGE_SECONDS
+
+    totals: Dict[str, List[float]] = {}
+    for (stage, _), counts in STAGE_SECONDS.values.items():
+        total = totals.setdefault(stage, [0, 0])
+        total[0] += sum(counts[:-1])
+        total[1] += counts[-1]
+    for stage, (count, seconds) in totals.items():
+        print(f"{stage:>12}: {seconds / count * 1000:9.1f} ms mean x{int(count)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--corpus", help="Directory of captured responses, or synthetic if unset"
+    )
+    parser.add_argument("--servers", type=int, default=8)
+    parser.add_argument("--scrapes", type=int, default=32)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="Scrapes started per second, 0 for all"
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--pyroscope-latency", type=float, default=0.05)
+    parser.add_argument("--synthetic-ticks", type=int, default=30)
+    args = parser.parse_args()
+
+    if args.corpus:
+        responses = list(ResponseCorpus(args.corpus, max_bytes=sys.maxsize))
+    else:
+        responses = synthetic_responses(count=10, ticks=args.synthetic_ticks)
+    print(f"Replaying {len(responses)} responses")
+
+    write_config(args.servers)
+    screeps = ReplayScreeps(responses, args.latency_scale)
+    pyroscope = FakePyroscope(args.pyroscope_latency)
+    result = asyncio.run(
+        run(screeps, pyroscope, args.scrapes, args.rate, args.concurrency)
+    )
+
+    for name, value in result.items():
+        value = round(value, 1) if isinstance(value, float) else value
+        print(f"{name:>16}: {value}")
+    print_stages()
+
+
+if __name__ == "__main__":
+    main()
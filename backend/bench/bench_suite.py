@@ -0,0 +1,265 @@
+"""Benchmark the hot paths of the backend on a synthetic history.
+
+Each stage is timed, and its peak memory measured with tracemalloc, then
+the endpoints are run under concurrent load. The results are appended to
+a JSON lines file, and compared with the last run with the same settings
+so regressions between versions show up.
+
+Run from the backend directory with:
+
+    python -m bench.bench_suite --ticks 30 --depth 6 --out bench/results.jsonl
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+# The app reads its config and opens the archive when it's imported, so
+# point it at a throwaway config before anything from src is imported
+BENCH_DIR = tempfile.mkdtemp()
+with open(os.path.join(BENCH_DIR, "secrets.yml"), "w") as fh:
+    fh.write(
+        """
+banan_history_key: BANAN
+servers:
+  - name: bench
+    host: screeps.bench
+    token: bench
+"""
+    )
+os.environ["CONFIG_FILE"] = os.path.join(BENCH_DIR, "secrets.yml")
+os.environ["ARCHIVE_PATH"] = os.path.join(BENCH_DIR, "archive.sqlite3")
+
+import httpx  # noqa: E402
+
+sys.path.append(".")
+from bench.replay import encode_memory_response  # noqa: E402
+from bench.synthetic import SyntheticHistoryGenerator  # noqa: E402
+from src.config import DEBUG_DIR  # noqa: E402
+from src.fetch_history import (  # noqa: E402
+    CompressedProfilingHistory,
+    RawProfilingHistory,
+    decompress_history,
+)
+from src.pprof_convert import PprofConverter, TimelineConverter  # noqa: E402
+
+
+def measure(name: str, func: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    """Time the best and mean of `repeat` runs, and the peak memory of one."""
+    times = timeit.repeat(func, number=1, repeat=repeat)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "best_ms": min(times) * 1000,
+        "mean_ms": statistics.mean(times) * 1000,
+        "peak_kib": peak / 1024,
+    }
+
+
+def bench_stages(data: str, repeat: int) -> List[Dict[str, Any]]:
+    comp = CompressedProfilingHistory.model_validate_json(data)
+    history = decompress_history(comp)
+    tick = history[0]
+
+    return [
+        measure(
+            "model_validate_json",
+            lambda: CompressedProfilingHistory.model_validate_json(data),
+            repeat,
+        ),
+        measure("decompress_history", lambda: decompress_history(comp), repeat),
+        measure(
+            "raw_decompress",
+            lambda: RawProfilingHistory.from_json(data).decompress(),
+            repeat,
+        ),
+        measure("timeline_convert", lambda: TimelineConverter().convert(tick), repeat),
+        measure(
+            "convert_to_pprof_bytes",
+            lambda: PprofConverter().convert_to_pprof_bytes(tick),
+            repeat,
+        ),
+    ]
+
+
+async def bench_endpoint(
+    url: str, memory_response: Dict[str, Any], concurrency: int, requests: int
+) -> Dict[str, Any]:
+    """Send `requests` requests to an endpoint, `concurrency` at a time."""
+    from src import app as app_module
+
+    async def screeps(_: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json=memory_response)
+
+    app_module.screeps_client.http = httpx.AsyncClient(
+        transport=httpx.MockTransport(screeps)
+    )
+
+    transport = httpx.ASGITransport(app=app_module.app)
+
+    async def load() -> List[float]:
+        """Send the requests, starting from an empty cache."""
+        app_module.history_cache.entries.clear()
+        latencies: List[float] = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+
+            async def request():
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.get(url)
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+
+            await asyncio.gather(*[request() for _ in range(requests)])
+        return latencies
+
+    start = time.perf_counter()
+    latencies = await load()
+    duration = time.perf_counter() - start
+
+    # Tracing slows everything down, so measure memory in a separate run
+    tracemalloc.start()
+    await load()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "name": f"GET {url} x{concurrency}",
+        "best_ms": latencies[0] * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+        "requests_per_s": requests / duration,
+        "peak_kib": peak / 1024,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous(path: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Return the last saved run with the same settings."""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as fh:
+        for line in fh:
+            run = json.loads(line)
+            if run.get("params") == params:
+                previous = run
+    return previous
+
+
+def print_results(results: List[Dict[str, Any]], previous: Optional[Dict[str, Any]]):
+    before = {r["name"]: r for r in previous["results"]} if previous else {}
+    for result in results:
+        line = (
+            f"{result['name']:>40}: {result['best_ms']:9.1f} ms best,"
+            f" {result['mean_ms']:9.1f} ms mean, {result['peak_kib']:9.0f} KiB peak"
+        )
+        if result["name"] in before:
+            change = result["best_ms"] / before[result["name"]]["best_ms"] - 1
+            line += f" ({change:+.0%} vs {previous['commit'] or 'last run'})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ticks", type=int, default=30)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--tick-cpu", type=float, default=20.0)
+    parser.add_argument(
+        "--cpu-distribution",
+        choices=SyntheticHistoryGenerator.CPU_DISTRIBUTIONS,
+        default="uniform",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--out", default="bench/results.jsonl")
+    args = parser.parse_args()
+
+    params = {
+        "seed": args.seed,
+        "ticks": args.ticks,
+        "depth": args.depth,
+        "fanout": args.fanout,
+        "keys": args.keys,
+        "tick_cpu": args.tick_cpu,
+        "cpu_distribution": args.cpu_distribution,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+    }
+
+    generator = SyntheticHistoryGenerator(
+        seed=args.seed,
+        depth=args.depth,
+        fanout=args.fanout,
+        key_count=args.keys,
+        tick_cpu_ms=args.tick_cpu,
+        cpu_distribution=args.cpu_distribution,
+    )
+    data = generator.generate_json(ticks=args.ticks)
+    print(f"History: {args.ticks} ticks, {len(data)} bytes")
+
+    # The converters write debug output
+    os.makedirs(DEBUG_DIR, exist_ok=True)
+
+    results = bench_stages(data, args.repeat)
+    memory_response = encode_memory_response(data)
+    for url in ["/api/history/bench", "/api/history_pprof/bench"]:
+        results.append(
+            asyncio.run(
+                bench_endpoint(url, memory_response, args.concurrency, args.requests)
+            )
+        )
+
+    run = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+    }
+    print_results(results, load_previous(args.out, params))
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "a") as fh:
+        fh.write(json.dumps(run) + "\n")
+    print(f"Saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Stand-ins for Screeps and Pyroscope, to load test the backend offline.
+
+`ReplayScreeps` serves the Memory and RawMemory segment APIs from
+responses captured by setting
+`capture_dir` in the config, or from synthetic histories. `FakePyroscope`
+accepts profiles like Pyroscope's ingest API and counts what arrives.
+Both are ASGI apps. `bench/bench_ingest.py` runs them in process, and
+they can also be served on a port to load test a running backend:
+
+    python -m bench.replay screeps --corpus data/captures --port 21025
+    python -m bench.replay pyroscope --port 4040
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+from fastapi import FastAPI, Request, Response
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.corpus import CapturedResponse, ResponseCorpus
+
+
+def encode_memory_response(data: str) -> Dict[str, Any]:
+    # The bot stores the history as a string, which Screeps sends gzipped
+    # and base64 encoded
+    value = json.dumps(data).encode("utf-8")
+    encoded = base64.b64encode(gzip.compress(value)).decode("ascii")
+    return {"ok": 1, "data": "gz:" + encoded}
+
+
+def synthetic_responses(
+    count: int,
+    ticks: int = 30,
+    step: int = 10,
+    elapsed: float = 0.2,
+    seed: int = 0,
+) -> List[CapturedResponse]:
+    """Generate responses as if a server was scraped `count` times.
+
+    Each history is the bot's ring buffer of `ticks` ticks, after `step`
+    more ticks than the one before.
+    """
+    generator = SyntheticHistoryGenerator(seed=seed)
+    responses = []
+    for i in range(count):
+        data = generator.generate_json(ticks=ticks, first_tick=1000 + i * step)
+        body = json.dumps(encode_memory_response(data)).encode("utf-8")
+        responses.append(
+            CapturedResponse(
+                "synthetic", "shard0", "BANAN", 200, elapsed, time.time(), body
+            )
+        )
+    return responses
+
+
+class ReplayScreeps:
+    """Serve the Memory and segment APIs from captured responses.
+
+    Each host the requests are sent to replays the captures of one
+    captured server. The captures of each shard and Memory path, or
+    segment, are replayed in capture order, wrapping around at the end.
+    So successive scrapes see the bot's history move on as they did live.
+    Requests for anything which wasn't captured get a 404. Responses are
+    delayed by their captured time times `latency_scale`.
+    """
+
+    def __init__(self, responses: List[CapturedResponse], latency_scale: float = 1.0):
+        if not responses:
+            raise ValueError("No responses to replay")
+
+        self.servers: List[str] = []
+        self.sequences: Dict[Tuple[str, str, str], List[CapturedResponse]] = {}
+        for response in responses:
+            if response.server not in self.servers:
+                self.servers.append(response.server)
+            key = (response.server, response.shard, response.path)
+            self.sequences.setdefault(key, []).append(response)
+
+        self.latency_scale = latency_scale
+        self.hosts: Dict[str, str] = {}
+        """The captured server replayed to each host."""
+        self.positions: Counter = Counter()
+
+        self.requests = 0
+        self.bytes_sent = 0
+
+        self.app = FastAPI()
+        self.app.post("/api/auth/signin")(self.sign_in)
+        self.app.get("/api/user/memory")(self.get_memory)
+        self.app.get("/api/user/memory-segment")(self.get_memory_segment)
+
+    async def sign_in(self) -> Dict[str, Any]:
+        return {"ok": 1, "token": "replay"}
+
+    async def get_memory(self, request: Request) -> Response:
+        return await self.replay(request, request.query_params.get("path", ""))
+
+    async def get_memory_segment(self, request: Request) -> Response:
+        segment = request.query_params.get("segment", "")
+        # As the client records segment responses when capturing
+        return await self.replay(request, f"segment:{segment}")
+
+    async def replay(self, request: Request, path: str) -> Response:
+        host = request.headers.get("host", "")
+        server = self.hosts.get(host)
+        if server is None:
+            server = self.servers[len(self.hosts) % len(self.servers)]
+            self.hosts[host] = server
+
+        shard = request.query_params.get("shard", "")
+        sequence = self.sequences.get((server, shard, path))
+        if sequence is None:
+            return Response(
+                content=json.dumps({"error": f"No captures of {shard} {path}"}),
+                status_code=404,
+                media_type="application/json",
+            )
+
+        position = (host, shard, path)
+        response = sequence[self.positions[position] % len(sequence)]
+        self.positions[position] += 1
+        self.requests += 1
+        self.bytes_sent += len(response.body)
+
+        await asyncio.sleep(response.elapsed * self.latency_scale)
+        return Response(
+            content=response.body,
+            status_code=response.status,
+            media_type="application/json",
+        )
+
+
+class FakePyroscope:
+    """Accept profiles like Pyroscope's ingest API, after a `latency`."""
+
+    def __init__(self, latency: float = 0.0, status: int = 200):
+        self.latency = latency
+        self.status = status
+
+        self.profiles: Counter = Counter()
+        self.bytes_received = 0
+
+        self.app = FastAPI()
+        self.app.post("/ingest")(self.ingest)
+
+    async def ingest(self, request: Request) -> Response:
+        body = await request.body()
+        params = request.query_params
+        if params.get("format") != "pprof" or not params.get("name") or not body:
+            return Response(status_code=400)
+
+        await asyncio.sleep(self.latency)
+        self.profiles[params["name"]] += 1
+        self.bytes_received += len(body)
+        return Response(status_code=self.status)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("fake", choices=["screeps", "pyroscope"])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--corpus", help="Directory of captured responses, or synthetic if unset"
+    )
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    if args.fake == "screeps":
+        if args.corpus:
+            corpus = ResponseCorpus(args.corpus, max_bytes=sys.maxsize)
+            responses = list(corpus)
+        else:
+            responses = synthetic_responses(count=10)
+        app = ReplayScreeps(responses, args.latency_scale).app
+    else:
+        app = FakePyroscope(args.latency).app
+
+    uvicorn.run(app, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Seeded generator of synthetic banan v2 profiling histories.
+
+The output mimics what `bot/banan.ts` writes to Memory, so it can be fed
+to the same decoding code as a real dump.
+"""
+
+import json
+import math
+import random
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from src.fetch_history import EXPECTED_BANAN_FORMAT_VERSION
+
+
+class SyntheticHistoryGenerator:
+    """Generate a compressed history of ticks with random call trees.
+
+    Each node gets between 0 and `fanout` children, until `depth` is
+    reached, and the children share out the CPU time of their parent.
+    Keys are drawn from a pool of `key_count` class and method names.
+
+    `cpu_distribution` sets how the CPU time of ticks and calls varies:
+
+    - `uniform`: ticks vary evenly around `tick_cpu_ms`, and children get
+      similar shares of their parent.
+    - `lognormal`: ticks and shares vary log-normally, so a few calls
+      take most of the time, as they often do in a real bot.
+    - `pareto`: a heavier tail still, with occasional very expensive
+      ticks and calls.
+    """
+
+    CPU_DISTRIBUTIONS = ("uniform", "lognormal", "pareto")
+
+    def __init__(
+        self,
+        seed: int = 0,
+        depth: int = 6,
+        fanout: int = 4,
+        key_count: int = 200,
+        tick_cpu_ms: float = 20.0,
+        cpu_distribution: str = "uniform",
+    ):
+        if cpu_distribution not in self.CPU_DISTRIBUTIONS:
+            raise ValueError(f"Unknown CPU distribution: {cpu_distribution}")
+
+        self.rng = random.Random(seed)
+        self.depth = depth
+        self.fanout = fanout
+        self.key_pool = [
+            f"Class{i // 8}:method{i % 8}" for i in range(max(key_count, 1))
+        ]
+        self.tick_cpu_ms = tick_cpu_ms
+        self.cpu_distribution = cpu_distribution
+
+        self.key_map: Dict[str, int] = {}
+
+    def generate(
+        self, ticks: int = 30, max_history: Optional[int] = None, first_tick: int = 1000
+    ) -> Dict[str, Any]:
+        """Generate a history, as the decoded JSON object.
+
+        Like the bot, ticks are stored in a ring buffer of `max_history`
+        slots and any slots without a tick are null.
+        """
+        max_history = max_history or ticks
+        buffer: List[Optional[Dict[str, Any]]] = [None] * max_history
+        for i in range(ticks):
+            tick = first_tick + i
+            buffer[tick % max_history] = self.generate_tick(tick, 1700000000000 + i * 3000)
+
+        return {
+            "version": EXPECTED_BANAN_FORMAT_VERSION,
+            "keyMap": {"maxID": len(self.key_map), "map": dict(self.key_map)},
+            "ticks": buffer,
+        }
+
+    def generate_json(self, *args, **kwargs) -> str:
+        return json.dumps(self.generate(*args, **kwargs))
+
+    def generate_tick(self, tick: int, timestamp: int) -> Dict[str, Any]:
+        cpu = self._round(self._tick_cpu())
+        root = self._node(f"Tick {tick}", 0, cpu, 0)
+        marks = [
+            {"shortName": "spawn", "fullName": "Spawned creep", "timestamp": cpu / 2}
+        ]
+        return {"t": timestamp, "m": marks, "d": root}
+
+    def _node(self, key: str, start: float, cpu: float, depth: int) -> list:
+        children = []
+        child_count = self.rng.randint(0, self.fanout) if depth < self.depth else 0
+        if child_count:
+            for child_start, child_cpu in self._share_cpu(start, cpu, child_count):
+                child_key = self.rng.choice(self.key_pool)
+                children.append(self._node(child_key, child_start, child_cpu, depth + 1))
+
+        intents = sum(child[3] for child in children)
+        if not children and self.rng.random() < 0.1:
+            intents += 1
+        return [self._key_id(key), start, cpu, intents, children]
+
+    def _tick_cpu(self) -> float:
+        if self.cpu_distribution == "lognormal":
+            # With a median of the configured CPU
+            return self.rng.lognormvariate(math.log(self.tick_cpu_ms), 0.5)
+        if self.cpu_distribution == "pareto":
+            # Scaled so the mean is the configured CPU
+            return self.tick_cpu_ms * self.rng.paretovariate(3) * 2 / 3
+        return self.rng.uniform(0.5, 1.5) * self.tick_cpu_ms
+
+    def _share_cpu(
+        self, start: float, cpu: float, count: int
+    ) -> Iterator[Tuple[float, float]]:
+        """Yield the start and CPU of each child, one after another."""
+        if self.cpu_distribution == "uniform":
+            # Share out most of the parent's time between the children
+            slot = cpu / count
+            for i in range(count):
+                child_cpu = self._round(slot * self.rng.uniform(0.3, 0.95))
+                yield self._round(start + i * slot), child_cpu
+            return
+
+        if self.cpu_distribution == "lognormal":
+            weights = [self.rng.lognormvariate(0, 1) for _ in range(count)]
+        else:
+            weights = [self.rng.paretovariate(1.2) for _ in range(count)]
+        shared = cpu * self.rng.uniform(0.6, 0.95)
+        total = sum(weights)
+
+        child_start = start
+        for weight in weights:
+            child_cpu = self._round(shared * weight / total)
+            yield self._round(child_start), child_cpu
+            child_start += child_cpu
+
+    def _key_id(self, key: str) -> int:
+        key_id = self.key_map.get(key)
+        if key_id is None:
+            key_id = self.key_map[key] = len(self.key_map)
+        return key_id
+
+    @staticmethod
+    def _round(value: float) -> float:
+        # Same precision as the bot
+        return round(value * 10000) / 10000
@@ -0,0 +1,229 @@
+"""Merge many ticks into one call tree, for a flame graph of a whole history."""
+
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from src.archive import parse_tick_number
+from src.fetch_history import ProfilingNode
+from src.history_query import RawTick, check_node
+
+ROOT_KEY = "All ticks"
+
+
+class AggregateNode:
+    """The merged cost of every call along one stack path."""
+
+    __slots__ = ("key", "total", "self_total", "max", "calls", "intents", "children")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.total = 0.0
+        """The summed CPU of every call, including its children."""
+        self.self_total = 0.0
+        """The summed CPU of every call, excluding its children."""
+        self.max = 0.0
+        """The CPU of the most expensive single call."""
+        self.calls = 0
+        self.intents = 0
+        self.children: Dict[str, "AggregateNode"] = {}
+
+    def child(self, key: str) -> "AggregateNode":
+        node = self.children.get(key)
+        if node is None:
+            node = self.children[key] = AggregateNode(key)
+        return node
+
+    def add_call(self, cpu: float, self_cost: float, intents: int):
+        self.total += cpu
+        self.self_total += self_cost
+        self.max = max(self.max, cpu)
+        self.calls += 1
+        self.intents += intents
+
+
+class AggregateTree:
+    """A call tree merged from many ticks, keyed by stack path.
+
+    The roots of the ticks, whose keys are each a different tick, are all
+    merged into a single root. Below it, calls to the same key from the
+    same stack path are merged into one node. Ticks are added
+    incrementally, and a tick is never added twice.
+    """
+
+    def __init__(self):
+        self.root = AggregateNode(ROOT_KEY)
+        self.tick_keys: Set[str] = set()
+        self.first_tick: Optional[int] = None
+        self.last_tick: Optional[int] = None
+
+    @classmethod
+    def from_ticks(cls, ticks: Iterable[ProfilingNode]) -> "AggregateTree":
+        tree = cls()
+        tree.add_ticks(ticks)
+        return tree
+
+    @classmethod
+    def from_raw_ticks(cls, ticks: Iterable[RawTick]) -> "AggregateTree":
+        tree = cls()
+        tree.add_raw_ticks(ticks)
+        return tree
+
+    @property
+    def tick_count(self) -> int:
+        return len(self.tick_keys)
+
+    def add_ticks(self, ticks: Iterable[ProfilingNode]) -> int:
+        """Merge in the ticks not already added, returning how many were new."""
+        added = 0
+        for tick in ticks:
+            if tick.key in self.tick_keys:
+                continue
+            self.tick_keys.add(tick.key)
+            self._add_tick(tick)
+            added += 1
+        return added
+
+    def add_raw_ticks(self, ticks: Iterable[RawTick]) -> int:
+        """Like `add_ticks`, but merge compressed ticks without decompressing."""
+        added = 0
+        for history, tick in ticks:
+            tick_key = history.tick_key(tick)
+            if tick_key in self.tick_keys:
+                continue
+            self.tick_keys.add(tick_key)
+            self._add_raw_tick(history.keys, tick_key, tick["d"])
+            added += 1
+        return added
+
+    def _add_tick_number(self, tick_key: str):
+        tick_number = parse_tick_number(tick_key)
+        if tick_number is not None:
+            if self.first_tick is None or tick_number < self.first_tick:
+                self.first_tick = tick_number
+            if self.last_tick is None or tick_number > self.last_tick:
+                self.last_tick = tick_number
+
+    def _add_tick(self, tick: ProfilingNode):
+        self._add_tick_number(tick.key)
+
+        pending: List[Tuple[ProfilingNode, AggregateNode]] = [(tick, self.root)]
+        while pending:
+            node, merged = pending.pop()
+            # Rounding in the bot can make the children sum to slightly
+            # more than the parent, so never count a negative cost
+            merged.add_call(node.cpu, max(node.self_cost(), 0.0), node.intents)
+            for child in node.children:
+                pending.append((child, merged.child(child.key)))
+
+    def _add_raw_tick(self, keys: Dict[int, str], tick_key: str, comp: list):
+        self._add_tick_number(tick_key)
+
+        check_node(comp)
+        pending: List[Tuple[list, AggregateNode]] = [(comp, self.root)]
+        while pending:
+            node, merged = pending.pop()
+            # Subtract in the same order as `ProfilingNode.self_cost`, so
+            # the sums match to the bit
+            self_cost = node[2]
+            for child in node[4]:
+                check_node(child)
+                self_cost -= child[2]
+            merged.add_call(node[2], max(self_cost, 0.0), node[3])
+            for child in node[4]:
+                key = keys.get(child[0])
+                if key is None:
+                    raise ValueError(f"Did not find key ID {child[0]} in key map")
+                pending.append((child, merged.child(key)))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the tree as JSON-able dicts, with children in key order.
+
+        `mean` is the average CPU per tick, so a flame graph of the means
+        shows the average tick.
+        """
+        tick_count = max(self.tick_count, 1)
+
+        def to_dict(node: AggregateNode) -> Dict[str, Any]:
+            return {
+                "key": node.key,
+                "total": node.total,
+                "self": node.self_total,
+                "mean": node.total / tick_count,
+                "max": node.max,
+                "calls": node.calls,
+                "intents": node.intents,
+                "children": [],
+            }
+
+        root = to_dict(self.root)
+        pending = [(self.root, root)]
+        while pending:
+            node, obj = pending.pop()
+            for key in sorted(node.children):
+                child = node.children[key]
+                child_obj = to_dict(child)
+                obj["children"].append(child_obj)
+                pending.append((child, child_obj))
+
+        return {
+            "ticks": self.tick_count,
+            "first_tick": self.first_tick,
+            "last_tick": self.last_tick,
+            "tree": root,
+        }
+
+
+def diff_aggregates(base: AggregateTree, target: AggregateTree) -> Dict[str, Any]:
+    """Compare the average tick of two aggregates, stack path by stack path.
+
+    Costs are means per tick, so ranges with different numbers of ticks
+    can be compared. Each node of the diff tree has the mean self and
+    total CPU of its path in both, and the change from base to target.
+    `self_ratio` is the change relative to the base, or None for a path
+    which only the target called. Paths in either are included.
+    """
+    base_ticks = max(base.tick_count, 1)
+    target_ticks = max(target.tick_count, 1)
+
+    def to_dict(
+        key: str,
+        base_node: Optional[AggregateNode],
+        target_node: Optional[AggregateNode],
+    ) -> Dict[str, Any]:
+        base_self = base_node.self_total / base_ticks if base_node else 0.0
+        target_self = target_node.self_total / target_ticks if target_node else 0.0
+        base_total = base_node.total / base_ticks if base_node else 0.0
+        target_total = target_node.total / target_ticks if target_node else 0.0
+        self_delta = target_self - base_self
+        return {
+            "key": key,
+            "base_self": base_self,
+            "target_self": target_self,
+            "self_delta": self_delta,
+            "self_ratio": self_delta / base_self if base_self else None,
+            "base_total": base_total,
+            "target_total": target_total,
+            "total_delta": target_total - base_total,
+            "children": [],
+        }
+
+    root = to_dict(ROOT_KEY, base.root, target.root)
+    pending = [(base.root, target.root, root)]
+    while pending:
+        base_node, target_node, obj = pending.pop()
+        base_children = base_node.children if base_node else {}
+        target_children = target_node.children if target_node else {}
+        for key in sorted(base_children.keys() | target_children.keys()):
+            base_child = base_children.get(key)
+            target_child = target_children.get(key)
+            child_obj = to_dict(key, base_child, target_child)
+            obj["children"].append(child_obj)
+            pending.append((base_child, target_child, child_obj))
+
+    def summary(tree: AggregateTree) -> Dict[str, Any]:
+        return {
+            "ticks": tree.tick_count,
+            "first_tick": tree.first_tick,
+            "last_tick": tree.last_tick,
+        }
+
+    return {"base": summary(base), "target": summary(target), "tree": root}
@@ -1,23 +1,52 @@
-import io
+import asyncio
 import json
 import logging
-import math
 import os
 import sys
-import time
 from contextlib import asynccontextmanager
-from typing import List, Set
+from typing import Any, Callable, Dict, List, Literal, Optional, Union
 
 import pydantic
-import requests
-from apscheduler.schedulers.background import BackgroundScheduler
-from fastapi import FastAPI, HTTPException, Response
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from fastapi import FastAPI, HTTPException, Header, Query, Response
 from fastapi.responses import StreamingResponse
 
-from src.config import DEBUG_DIR, DEBUG_ENABLED, PYROSCOPE_URL, load_config
-from src.fetch_history import ProfilingNode, fetch_history
-from src.pprof_convert import PprofConverter, ms_to_ns
-
+from src.aggregate import AggregateTree, diff_aggregates
+from src.archive import TickArchive
+from src.config import (
+    ARCHIVE_PATH,
+    DEBUG_DIR,
+    DEBUG_ENABLED,
+    PYROSCOPE_URL,
+    ServerConfig,
+    load_config,
+)
+from src.corpus import ResponseCorpus
+from src.cost_index import CostIndex
+from src.fetch_history import (
+    ProfilingNode,
+    RawProfilingHistory,
+    fetch_shard_histories_async,
+)
+from src.history_cache import HistoryCache
+from src.history_query import HistoryQuery, RawTick
+from src.ingest import ingest_history
+from src.live_tail import MEDIA_TYPE as LIVE_TAIL_MEDIA_TYPE
+from src.live_tail import LiveTail
+from src.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from src.metrics import REGISTRY, STAGE_SECONDS, TICKS, TICK_NODES
+from src.pprof_convert import PprofConverter
+from src.pprof_encode import iter_pprof_bytes
+from src.protogen.perftools.profiles import Profile
+from src.pyroscope_export import PyroscopeExporter
+from src.scrape_schedule import ScrapeSchedule
+from src.scraper import Scraper
+from src.screeps_client import ScreepsClient
+from src.tick_index import TickIndexStore
+from src.tick_tree import TickTree
+from src.tree_cache import TreeCache
+from src.wire import MEDIA_TYPE as WIRE_MEDIA_TYPE
+from src.wire import encode_history_wire
 
 if DEBUG_ENABLED:
     os.makedirs(DEBUG_DIR, exist_ok=True)
@@ -25,8 +54,11 @@ if DEBUG_ENABLED:
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    await asyncio.to_thread(enqueue_unpushed_ticks)
     init_schedules()
     yield
+    await screeps_client.aclose()
+    await exporter.aclose()
 
 
 logger = logging.getLogger(__name__)
@@ -39,8 +71,132 @@ logger.addHandler(stream_handler)
 app = FastAPI(lifespan=lifespan)
 config = load_config()
 
-# Avoid uploading to Pyroscope for ticks we've already sent
-pyroscope_sent_ticks: Set[str] = set()
+# Every tick we've scraped, which also records the ticks we've already
+# sent to Pyroscope so they aren't uploaded twice
+archive = TickArchive(ARCHIVE_PATH)
+
+# The flame graph of every archived tick, kept up to date as ticks arrive
+aggregates = TickIndexStore(archive, AggregateTree)
+
+# The cost of every function in every tick, for querying over time
+cost_indexes = TickIndexStore(
+    archive,
+    lambda: CostIndex(stacks=config.cost_index_stacks),
+)
+
+# The recently used decompressed ticks, shared by the API and the exporter
+trees = TreeCache(config.tree_cache_max_nodes)
+
+exporter = PyroscopeExporter(
+    PYROSCOPE_URL,
+    archive,
+    batch_size=config.pyroscope_batch_size,
+    max_batches=config.pyroscope_max_batches,
+    trees=trees,
+)
+
+# Clients following the ticks of a shard as they arrive
+live_tail = LiveTail(archive, max_queued=config.live_tail_max_queued)
+
+# One pool of connections to the screeps servers for the whole app
+screeps_client = ScreepsClient(
+    token_ttl=config.screeps_token_ttl,
+    corpus=(
+        ResponseCorpus(config.capture_dir, config.capture_max_bytes)
+        if config.capture_dir
+        else None
+    ),
+)
+
+
+# The history of each shard of a server
+ShardHistories = Dict[str, RawProfilingHistory]
+
+
+async def load_raw_history(server_name: str) -> ShardHistories:
+    histories = await fetch_shard_histories_async(config, server_name, screeps_client)
+    # Only an actual fetch, by the API or the scraper, puts off the next
+    # scrape, not a request served from the cache
+    server_cfg = config.get_server_cfg(server_name)
+    if server_cfg is not None:
+        schedule.observe(server_cfg, histories)
+    return histories
+
+
+# Shared by the API and the scheduler, so they don't each fetch from screeps.
+# Every shard of a server is fetched together.
+history_cache: HistoryCache[ShardHistories] = HistoryCache(
+    load_raw_history, ttl=config.history_cache_ttl
+)
+
+
+# Counts kept elsewhere in the app, read when the metrics are scraped
+REGISTRY.callback(
+    "banan_history_cache_hits_total",
+    "Requests for a history served from the cache.",
+    "counter",
+    lambda: history_cache.hits,
+)
+REGISTRY.callback(
+    "banan_history_cache_misses_total",
+    "Requests for a history which had to fetch it.",
+    "counter",
+    lambda: history_cache.misses,
+)
+REGISTRY.callback(
+    "banan_tree_cache_hits_total",
+    "Decompressed ticks served from the tree cache.",
+    "counter",
+    lambda: trees.hits,
+)
+REGISTRY.callback(
+    "banan_tree_cache_misses_total",
+    "Ticks which weren't in the tree cache.",
+    "counter",
+    lambda: trees.misses,
+)
+REGISTRY.callback(
+    "banan_tree_cache_nodes",
+    "Nodes of the decompressed ticks held in the tree cache.",
+    "gauge",
+    lambda: trees.nodes,
+)
+REGISTRY.callback(
+    "banan_exported_ticks_total",
+    "Ticks pushed to Pyroscope.",
+    "counter",
+    lambda: exporter.exported_ticks,
+)
+REGISTRY.callback(
+    "banan_dropped_ticks_total",
+    "Ticks dropped without being pushed to Pyroscope.",
+    "counter",
+    lambda: exporter.dropped_ticks,
+)
+REGISTRY.callback(
+    "banan_export_failures_total",
+    "Failed attempts to push a batch to Pyroscope.",
+    "counter",
+    lambda: exporter.failed_attempts,
+)
+REGISTRY.callback(
+    "banan_live_tail_clients",
+    "Clients following ticks as they're ingested.",
+    "gauge",
+    lambda: len(live_tail),
+)
+REGISTRY.callback(
+    "banan_live_tail_resyncs_total",
+    "Times a live tail client fell behind and read missed ticks from the archive.",
+    "counter",
+    lambda: live_tail.resyncs,
+)
+REGISTRY.callback(
+    "banan_export_queued_batches",
+    "Batches waiting to be pushed to Pyroscope.",
+    "gauge",
+    lambda: len(exporter.pending),
+)
 
 
 class ApiHistoryResponse(pydantic.BaseModel):
@@ -48,118 +204,570 @@ class ApiHistoryResponse(pydantic.BaseModel):
 
 
 def init_schedules():
-    """Setup a schedule to periodically push to Pyroscope."""
+    """Setup schedules to periodically scrape servers and push to Pyroscope."""
     logger.info("Initializing schedules")
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(scrape_all_and_push_to_pyroscope, "cron", second="*/30")
+    scheduler = AsyncIOScheduler()
+    # Each run only scrapes the servers which are due
+    scheduler.add_job(
+        scraper.scrape_all,
+        "interval",
+        seconds=config.scrape_poll_interval,
+        max_instances=1,
+        coalesce=True,
+    )
+    # Separate from scraping, so retries while Pyroscope is down don't
+    # hold up the next scrape
+    scheduler.add_job(
+        exporter.flush,
+        "interval",
+        seconds=config.pyroscope_flush_interval,
+        max_instances=1,
+        coalesce=True,
+    )
     scheduler.start()
 
 
-def scrape_all_and_push_to_pyroscope():
-    """Push profiling data to pyroscope from every screeps server we can."""
-    logger.info("Pushing to pyroscope...")
+async def scrape_server(server_cfg: ServerConfig):
+    logger.info("Loading data from server %s", server_cfg.name)
 
-    for server_cfg in config.servers:
-        logger.info("Loading data from server %s", server_cfg.name)
+    # Always fetch, which also warms the cache for the API
+    histories = await history_cache.refresh(server_cfg.name)
+    await ingest(server_cfg, histories)
+
+
+schedule = ScrapeSchedule(
+    config.servers,
+    screeps_client.get_rate_limits,
+    default_interval=config.scrape_interval,
+    min_interval=config.scrape_min_interval,
+    max_interval=config.scrape_max_interval,
+    safety=config.scrape_safety,
+)
 
-        history = []
+scraper = Scraper(
+    config.servers,
+    scrape_server,
+    max_workers=config.scrape_workers,
+    timeout=config.scrape_timeout,
+    interval=config.scrape_poll_interval,
+    schedule=schedule,
+)
+
+
+async def ingest(server_cfg: ServerConfig, histories: ShardHistories):
+    """Archive any new ticks of every shard and queue them for Pyroscope."""
+    for shard, raw_history in histories.items():
         try:
-            history = fetch_history(config, server_cfg.name)
+            new_ticks = await asyncio.to_thread(
+                ingest_new_ticks, server_cfg, shard, raw_history
+            )
         except Exception:
-            logger.exception(f"Error fetching history for: {server_cfg.name}")
-
-        for tick in history:
-            tick_str = f"{server_cfg.name}:{tick.key}"
+            TICKS.inc(len(raw_history.ticks), server=server_cfg.name, result="failed")
+            raise
+        exporter.enqueue(server_cfg.name, shard, new_ticks)
+        live_tail.publish(server_cfg.name, shard, new_ticks)
+
+
+def ingest_new_ticks(
+    server_cfg: ServerConfig, shard: str, raw_history: RawProfilingHistory
+) -> List[ProfilingNode]:
+    server = server_cfg.name
+    with STAGE_SECONDS.time(stage="ingest", server=server):
+        result = ingest_history(archive, server, shard, raw_history)
+
+    # Only the new ticks are decompressed, and they're cached for the
+    # exporter and the API
+    with STAGE_SECONDS.time(stage="decompress", server=server):
+        new_ticks = [
+            trees.decompress(server, shard, raw_history, tick)
+            for tick in result.new_ticks
+        ]
+
+    # Indexed from the compressed ticks, so the trees aren't walked again
+    raw_ticks = [(raw_history, tick) for tick in result.new_ticks]
+    with STAGE_SECONDS.time(stage="index", server=server):
+        aggregates.add_raw_ticks(server, shard, raw_ticks)
+        cost_indexes.add_raw_ticks(server, shard, raw_ticks)
+
+    TICKS.inc(len(new_ticks), server=server, result="ingested")
+    TICKS.inc(result.skipped, server=server, result="skipped")
+    for tick in new_ticks:
+        TICK_NODES.observe(tick.count_nodes(), server=server)
+    return new_ticks
+
+
+def enqueue_unpushed_ticks():
+    """Queue any ticks which weren't pushed to Pyroscope before a restart."""
+    max_ticks = config.pyroscope_batch_size * config.pyroscope_max_batches
+    for server_cfg in config.servers:
+        for shard in server_cfg.get_shards():
+            ticks = archive.get_unpushed_ticks(server_cfg.name, shard, limit=max_ticks)
+            exporter.enqueue(server_cfg.name, shard, ticks)
+
+
+@app.get("/api/history/{server_name}", response_model=ApiHistoryResponse)
+async def get_history(
+    server_name: str,
+    from_tick: Optional[int] = None,
+    to_tick: Optional[int] = None,
+    from_time: Optional[int] = None,
+    to_time: Optional[int] = None,
+    last: Optional[int] = None,
+    max_depth: Optional[int] = None,
+    min_cpu: Optional[float] = None,
+    shard: Optional[str] = None,
+    format: Literal["json", "wire"] = "json",
+) -> Response:
+    """Fetch profiling history from screeps and return in Banan format
+
+    The ticks of every shard of the server are returned together, each
+    tagged with its shard, unless one `shard` is asked for.
+
+    If a tick range or a window of timestamps in ms is given, the ticks are
+    served from the archive instead of the history currently held by the
+    bot. `last` keeps only the most recent.
+    `max_depth` cuts off the deeper calls of each tick, and calls taking
+    less than `min_cpu` are folded into an "other" node.
+
+    Pass `format=wire` to get the compact binary format of `src.wire`
+    instead of JSON.
+    """
+    server_cfg = get_server_cfg_or_404(server_name)
+    if shard is not None:
+        get_shard_or_404(server_cfg, shard)
 
-            if tick_str in pyroscope_sent_ticks:
-                logger.info("Already sent tick %s", tick_str)
-                continue
+    try:
+        query = HistoryQuery(
+            from_tick, to_tick, from_time, to_time, last, max_depth, min_cpu
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-            try:
-                push_single_tick_to_pyroscope(server_cfg.name, tick)
-                pyroscope_sent_ticks.add(tick_str)
-            except Exception:
-                logger.exception(
-                    f"Error pushing tick to Pyroscope for: {server_cfg.name}"
+    wire = format == "wire"
+    try:
+        if any(bound is not None for bound in [from_tick, to_tick, from_time, to_time]):
+            with STAGE_SECONDS.time(stage="serialize", server=server_name):
+                body = await asyncio.to_thread(
+                    get_archived_history_body, server_cfg, shard, query, wire
                 )
+        else:
+            histories = await history_cache.get(server_name)
+            await ingest(server_cfg, histories)
+            if shard is not None:
+                histories = {shard: histories[shard]} if shard in histories else {}
+            with STAGE_SECONDS.time(stage="serialize", server=server_name):
+                body = await asyncio.to_thread(
+                    get_current_history_body, server_cfg, histories, query, wire
+                )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
+    return Response(
+        content=body,
+        media_type=WIRE_MEDIA_TYPE if wire else "application/json",
+        headers={"Cache-Control": "max-age: 0"},
+    )
 
-def push_single_tick_to_pyroscope(server_name: str, tick: ProfilingNode):
-    """Push a single tick of profiling data to Pyroscope.
 
-    See https://grafana.com/docs/pyroscope/latest/configure-server/about-server-api/
-    """
-    pprof_bytes = PprofConverter().convert_to_pprof_bytes(tick)
+def get_current_history_body(
+    server_cfg: ServerConfig,
+    histories: ShardHistories,
+    query: HistoryQuery,
+    wire: bool = False,
+) -> Union[str, bytes]:
+    """Serialize the history held by the bot on each shard."""
+    ticks = query.select(
+        (raw_history, tick)
+        for raw_history in histories.values()
+        for tick in raw_history.ticks
+    )
+    if wire:
+        return serialize_history_wire(ticks)
+
+    history = decompress_ticks(server_cfg, ticks, query)
 
     if DEBUG_ENABLED:
-        with open(f"{DEBUG_DIR}/{server_name}.prof", "wb") as fh:
-            fh.write(pprof_bytes)
-
-    if not tick.timestamp:
-        raise ValueError("Expecting to find a timestamp on tick")
-
-    # TODO actual timestamp from dump
-    app_name = f"screeps-{server_name}"
-    from_time = ms_to_ns(tick.timestamp)
-    until_time = ms_to_ns(tick.timestamp) + ms_to_ns(tick.cpu)
-
-    url_params = {
-        "name": app_name,
-        "format": "pprof",
-        "from": from_time,
-        "until": until_time,
-    }
-
-    resp = requests.post(PYROSCOPE_URL + "/ingest", params=url_params, data=pprof_bytes)
-    resp.raise_for_status()
-
-    logger.info("Successfully sent {}:{} to Pyroscope".format(app_name, tick.key))
-    logger.info(
-        "tick_duration_ms: {}, from: {}, until: {}".format(
-            tick.cpu, from_time, until_time
+        with open(f"{DEBUG_DIR}/parsed.json", "w") as fh:
+            fh.write(
+                json.dumps([node.model_dump(exclude_unset=True) for node in history])
+            )
+
+    return serialize_history(history)
+
+
+def get_archived_history_body(
+    server_cfg: ServerConfig,
+    shard: Optional[str],
+    query: HistoryQuery,
+    wire: bool = False,
+) -> Union[str, bytes]:
+    # Every shard's ticks, unless one is given
+    stored = archive.get_raw_ticks(
+        server_cfg.name,
+        shard,
+        from_tick=query.from_tick,
+        to_tick=query.to_tick,
+        from_time=query.from_time,
+        to_time=query.to_time,
+    )
+    ticks = query.select(stored)
+    if wire:
+        return serialize_history_wire(ticks)
+    return serialize_history(decompress_ticks(server_cfg, ticks, query))
+
+
+def decompress_ticks(
+    server_cfg: ServerConfig, ticks: List[RawTick], query: HistoryQuery
+) -> List[ProfilingNode]:
+    # Pruned trees are particular to the query, so aren't worth caching
+    if query.prunes:
+        return [history.decompress_tick(tick) for history, tick in ticks]
+    return [
+        trees.decompress(
+            server_cfg.name, history.shard or server_cfg.shard, history, tick
         )
+        for history, tick in ticks
+    ]
+
+
+def serialize_history_wire(ticks: List[RawTick]) -> bytes:
+    # Encoded straight from the compressed ticks
+    trees = [TickTree.from_raw_tick(history, tick) for history, tick in ticks]
+    trees.sort(key=lambda tree: (tree.key, tree.shard or ""))
+    return encode_history_wire(trees)
+
+
+def serialize_history(history: List[ProfilingNode]) -> str:
+    history.sort(key=lambda node: (node.key, node.shard or ""))
+    # The nodes are already valid, so skip validating them all again
+    return ApiHistoryResponse.model_construct(history=history).model_dump_json()
+
+
+@app.get("/api/history_live/{server_name}")
+async def get_history_live(
+    server_name: str,
+    shard: Optional[str] = None,
+    after: Optional[int] = None,
+    last_event_id: Optional[str] = Header(default=None),
+) -> StreamingResponse:
+    """Stream the ticks of a shard as they're ingested, as server-sent events.
+
+    Each event is one tick in the JSON of the history API, with its tick
+    number as the event id. To resume, pass the last tick seen as `after`,
+    or in the `Last-Event-ID` header which browsers send when they
+    reconnect, and the archived ticks since are sent first.
+    """
+    server_cfg = get_server_cfg_or_404(server_name)
+    shard = get_shard_or_404(server_cfg, shard)
+    if last_event_id:
+        try:
+            after = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+
+    return StreamingResponse(
+        live_tail.stream(server_cfg.name, shard, after),
+        media_type=LIVE_TAIL_MEDIA_TYPE,
+        # Stop proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
-@app.get("/api/history/{server_name}")
-async def get_history(server_name: str, response: Response) -> ApiHistoryResponse:
-    """Fetch profiling history from screeps and return in Banan format"""
-    response.headers["Cache-Control"] = "max-age: 0"
+@app.get("/api/history_aggregate/{server_name}")
+async def get_history_aggregate(
+    server_name: str, shard: Optional[str] = None
+) -> Response:
+    """Return every archived tick of a shard merged into one call tree.
+
+    Each node has the total, mean per tick, max and call count of the
+    calls along its stack path. The shard defaults to the server's first.
+    """
+    server_cfg = get_server_cfg_or_404(server_name)
+    shard = get_shard_or_404(server_cfg, shard)
 
     try:
-        history = fetch_history(config, server_name)
+        body = await asyncio.to_thread(get_aggregate_json, server_cfg, shard)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    with open(f"{DEBUG_DIR}/parsed.json", "w") as fh:
-        fh.write(json.dumps([node.model_dump(exclude_unset=True) for node in history]))
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"Cache-Control": "max-age: 0"},
+    )
 
-    history.sort(key=lambda node: node.key)
-    return ApiHistoryResponse(history=history)
+
+def get_aggregate_json(server_cfg: ServerConfig, shard: str) -> str:
+    aggregate = aggregates.query(server_cfg.name, shard, lambda tree: tree.to_dict())
+    return json.dumps(aggregate)
+
+
+@app.get("/api/history_diff/{server_name}")
+async def get_history_diff(
+    server_name: str,
+    base_from_tick: Optional[int] = None,
+    base_to_tick: Optional[int] = None,
+    target_from_tick: Optional[int] = None,
+    target_to_tick: Optional[int] = None,
+    target_server: Optional[str] = None,
+    shard: Optional[str] = None,
+    target_shard: Optional[str] = None,
+) -> Response:
+    """Compare the average tick of two ranges of archived ticks.
+
+    The base is a range of a shard's ticks, and the target a range of the
+    same shard's ticks, or of `target_shard` of `target_server`. Returns
+    one call tree keyed by stack path, with the change in mean self and
+    total CPU per tick of each path from base to target. A range with any
+    bounds can hold at most `diff_max_ticks` ticks, and one without any is
+    every archived tick.
+    """
+    base_cfg = get_server_cfg_or_404(server_name)
+    base_shard = get_shard_or_404(base_cfg, shard)
+    target_cfg = get_server_cfg_or_404(target_server or server_name)
+    if target_shard is None and target_cfg is base_cfg:
+        target_shard = base_shard
+    target_shard = get_shard_or_404(target_cfg, target_shard)
+    await asyncio.to_thread(
+        check_diff_range, base_cfg, base_shard, base_from_tick, base_to_tick
+    )
+    await asyncio.to_thread(
+        check_diff_range, target_cfg, target_shard, target_from_tick, target_to_tick
+    )
+
+    try:
+        body = await asyncio.to_thread(
+            get_diff_json,
+            base_cfg,
+            base_shard,
+            base_from_tick,
+            base_to_tick,
+            target_cfg,
+            target_shard,
+            target_from_tick,
+            target_to_tick,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"Cache-Control": "max-age: 0"},
+    )
+
+
+def check_diff_range(
+    server_cfg: ServerConfig,
+    shard: str,
+    from_tick: Optional[int],
+    to_tick: Optional[int],
+):
+    """Refuse a bounded range of a diff with too many ticks to aggregate."""
+    if from_tick is None and to_tick is None:
+        return
+    count = archive.count_ticks(server_cfg.name, shard, from_tick, to_tick)
+    if count > config.diff_max_ticks:
+        raise HTTPException(
+            status_code=400,
+            detail=f"The range of {server_cfg.name} {shard} has {count} ticks,"
+            f" more than the {config.diff_max_ticks} allowed",
+        )
+
+
+def get_diff_json(
+    base_cfg: ServerConfig,
+    base_shard: str,
+    base_from_tick: Optional[int],
+    base_to_tick: Optional[int],
+    target_cfg: ServerConfig,
+    target_shard: str,
+    target_from_tick: Optional[int],
+    target_to_tick: Optional[int],
+) -> str:
+    base = aggregate_range(base_cfg, base_shard, base_from_tick, base_to_tick)
+    target = aggregate_range(target_cfg, target_shard, target_from_tick, target_to_tick)
+
+    def with_aggregate(
+        server_cfg: ServerConfig,
+        shard: str,
+        tree: Optional[AggregateTree],
+        then: Callable[[AggregateTree], Any],
+    ) -> Any:
+        # Without bounds, the aggregate of every tick is kept up to date
+        if tree is not None:
+            return then(tree)
+        return aggregates.query(server_cfg.name, shard, then)
+
+    diff = with_aggregate(
+        base_cfg,
+        base_shard,
+        base,
+        lambda base_tree: with_aggregate(
+            target_cfg,
+            target_shard,
+            target,
+            lambda target_tree: diff_aggregates(base_tree, target_tree),
+        ),
+    )
+    return json.dumps(diff)
+
+
+def aggregate_range(
+    server_cfg: ServerConfig,
+    shard: str,
+    from_tick: Optional[int],
+    to_tick: Optional[int],
+) -> Optional[AggregateTree]:
+    """Aggregate a range of archived ticks, or None if it has no bounds.
+
+    The ticks are merged straight from their compressed form, a chunk at a
+    time.
+    """
+    if from_tick is None and to_tick is None:
+        return None
+    return AggregateTree.from_raw_ticks(
+        archive.iter_raw_ticks(server_cfg.name, shard, from_tick, to_tick)
+    )
+
+
+@app.get("/api/costs/{server_name}/top")
+async def get_top_costs(
+    server_name: str,
+    n: int = Query(10, ge=1, le=1000),
+    by: Literal["mean", "p95"] = "mean",
+    metric: Literal["self", "total", "intents", "calls"] = "self",
+    from_tick: Optional[int] = None,
+    to_tick: Optional[int] = None,
+    stacks: bool = False,
+    shard: Optional[str] = None,
+) -> Response:
+    """Return the keys with the highest mean or p95 cost per archived tick.
+
+    Pass `stacks=true` to rank full stacks instead, if they're indexed.
+    """
+    server_cfg = get_server_cfg_or_404(server_name)
+    shard = get_shard_or_404(server_cfg, shard)
+
+    def query(index: CostIndex):
+        return index.top(n, by, metric, from_tick, to_tick, stacks)
+
+    return await query_cost_index(server_cfg, shard, query)
+
+
+@app.get("/api/costs/{server_name}/series")
+async def get_cost_series(
+    server_name: str,
+    key: str,
+    from_tick: Optional[int] = None,
+    to_tick: Optional[int] = None,
+    stacks: bool = False,
+    shard: Optional[str] = None,
+) -> Response:
+    """Return the cost of a key in each archived tick it was called in."""
+    server_cfg = get_server_cfg_or_404(server_name)
+    shard = get_shard_or_404(server_cfg, shard)
+
+    def query(index: CostIndex):
+        return index.series(key, from_tick, to_tick, stacks)
+
+    return await query_cost_index(server_cfg, shard, query)
+
+
+def get_server_cfg_or_404(server_name: str) -> ServerConfig:
+    server_cfg = config.get_server_cfg(server_name)
+    if not server_cfg:
+        raise HTTPException(status_code=404, detail=f"No such server: {server_name}")
+    return server_cfg
+
+
+def get_shard_or_404(server_cfg: ServerConfig, shard: Optional[str]) -> str:
+    """Return the shard asked for, or the server's first if none was."""
+    if shard is None:
+        return server_cfg.shard
+    if shard not in server_cfg.get_shards():
+        raise HTTPException(
+            status_code=404,
+            detail=f"No such shard on {server_cfg.name}: {shard}",
+        )
+    return shard
+
+
+async def query_cost_index(server_cfg: ServerConfig, shard: str, query) -> Response:
+    def run_query() -> str:
+        result = cost_indexes.query(server_cfg.name, shard, query)
+        return json.dumps(result)
+
+    try:
+        body = await asyncio.to_thread(run_query)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"No such key: {e.args[0]}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"Cache-Control": "max-age: 0"},
+    )
 
 
 @app.get("/api/history_pprof/{server_name}")
-async def get_history_pprof(server_name: str, response: Response):
+async def get_history_pprof(
+    server_name: str, gzip: bool = False, shard: Optional[str] = None
+):
     """Fetch profiling history from screeps and convert to pprof format.
 
     This allows for other standard profiling tools to inspect the dump.
     Could be useful for upload to Pyroscope for example.
+    Pass `gzip=true` to get it gzipped, as pprof files usually are.
     """
-    response.headers["Cache-Control"] = "max-age: 0"
-
+    server_cfg = get_server_cfg_or_404(server_name)
+    shard = get_shard_or_404(server_cfg, shard)
     try:
-        pprof_bytes = get_screeps_profile_pprof_bytes(server_name)
+        profile = await get_screeps_profile_pprof(server_name, shard)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    # The profile is encoded as it's streamed
     return StreamingResponse(
-        io.BytesIO(pprof_bytes), media_type="application/octet-stream"
+        iter_pprof_bytes(profile, compress=gzip),
+        media_type="application/octet-stream",
+        headers={"Cache-Control": "max-age: 0"},
+    )
+
+
+async def get_screeps_profile_pprof(
+    server_name: str, shard: Optional[str] = None
+) -> Profile:
+    """Fetch banan history for the given server and return a pprof profile."""
+    server_cfg = config.get_server_cfg(server_name)
+    if not server_cfg:
+        raise ValueError("No such server: {}".format(server_name))
+
+    histories = await history_cache.get(server_name)
+    raw_history = histories.get(shard or server_cfg.shard)
+    if raw_history is None:
+        raise ValueError("No history fetched from shard {}".format(shard))
+    return await asyncio.to_thread(convert_first_tick_to_pprof, server_cfg, raw_history)
+
+
+def convert_first_tick_to_pprof(
+    server_cfg: ServerConfig, raw_history: RawProfilingHistory
+) -> Profile:
+    if not raw_history.ticks:
+        raise ValueError("No ticks recorded in history")
+    # Only the one tick is decompressed
+    example_node = trees.decompress(
+        server_cfg.name,
+        raw_history.shard or server_cfg.shard,
+        raw_history,
+        raw_history.ticks[0],
     )
+    return PprofConverter().convert_to_pprof_format(example_node)
 
 
-def get_screeps_profile_pprof_bytes(server_name: str) -> bytes:
-    """Fetch banan history for the given server and return pprof bytestring."""
-    history = fetch_history(config, server_name)
-    example_node = history[0]
-    pprof_bytes = PprofConverter().convert_to_pprof_bytes(example_node)
-    return pprof_bytes
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    """Return the metrics of the backend in the Prometheus text format."""
+    return Response(content=REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
@@ -0,0 +1,415 @@
+"""Persistent archive of every tick scraped from the screeps servers."""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from src.fetch_history import ProfilingNode, RawProfilingHistory
+
+TICK_KEY_RE = re.compile(r"^Tick (\d+)$")
+
+
+def parse_tick_number(tick_key: str) -> Optional[int]:
+    """Return the game tick from the key of a tick's root node, e.g. `Tick 123`."""
+    match = TICK_KEY_RE.match(tick_key)
+    return int(match.group(1)) if match else None
+
+
+class TickSummary(NamedTuple):
+    """The stored columns of a tick, without its tree."""
+
+    key: str
+    timestamp: int
+    cpu: float
+
+
+class TickArchive:
+    """An append-only SQLite archive of ticks, keyed by server, shard and tick key.
+
+    Each tick is stored in the compressed banan format with its own small
+    key table, so it can be read back on its own. The archive also records
+    which ticks have been pushed to Pyroscope, so that isn't lost on restart.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS ticks (
+            server TEXT NOT NULL,
+            shard TEXT NOT NULL,
+            tick_key TEXT NOT NULL,
+            tick INTEGER,
+            timestamp INTEGER NOT NULL,
+            cpu REAL NOT NULL,
+            payload BLOB NOT NULL,
+            pushed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (server, shard, tick_key)
+        );
+        CREATE INDEX IF NOT EXISTS ticks_by_tick ON ticks (server, shard, tick);
+    """
+
+    def __init__(self, path: str):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The archive is shared by the scheduler thread and the API
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def add_ticks(self, server: str, shard: str, ticks: Iterable[ProfilingNode]) -> int:
+        """Add ticks to the archive, ignoring any already stored.
+
+        Return the number of ticks which were new.
+        """
+        rows = []
+        for tick in ticks:
+            if tick.timestamp is None:
+                raise ValueError("Expecting to find a timestamp on tick")
+            payload = encode_tick_payload(tick)
+            rows.append(
+                (
+                    server,
+                    shard,
+                    tick.key,
+                    parse_tick_number(tick.key),
+                    tick.timestamp,
+                    tick.cpu,
+                    payload,
+                )
+            )
+        return len(self._insert(rows))
+
+    def add_raw_ticks(
+        self, server: str, shard: str, history: RawProfilingHistory, ticks: Iterable[Dict]
+    ) -> List[Dict]:
+        """Add raw ticks of a history to the archive, without decompressing them.
+
+        Return the ticks which were new. Each tick is only ever returned
+        once, even if several threads add it at the same time.
+        """
+        ticks = list(ticks)
+        rows = []
+        for tick in ticks:
+            tick_key = history.tick_key(tick)
+            rows.append(
+                (
+                    server,
+                    shard,
+                    tick_key,
+                    parse_tick_number(tick_key),
+                    tick["t"],
+                    tick["d"][2],
+                    encode_raw_tick_payload(history.keys, tick),
+                )
+            )
+        return [ticks[i] for i in self._insert(rows)]
+
+    def _insert(self, rows: List[Tuple]) -> List[int]:
+        """Insert rows, ignoring ticks already stored.
+
+        Return the index of each row which was inserted.
+        """
+        inserted = []
+        with self.lock, self.conn:
+            for i, row in enumerate(rows):
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO ticks"
+                    " (server, shard, tick_key, tick, timestamp, cpu, payload)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    row,
+                )
+                if cursor.rowcount:
+                    inserted.append(i)
+        return inserted
+
+    def get_ticks(
+        self,
+        server: str,
+        shard: Optional[str] = None,
+        from_tick: Optional[int] = None,
+        to_tick: Optional[int] = None,
+        from_time: Optional[int] = None,
+        to_time: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> List[ProfilingNode]:
+        """Return the stored ticks of a server in tick order.
+
+        The tick range and timestamp window are inclusive, and either end
+        of them can be left open. With a `limit`, only the oldest ticks
+        are returned.
+        """
+        rows = self._select_payloads(
+            server, shard, from_tick, to_tick, from_time, to_time, limit
+        )
+        return [decode_tick_payload(payload, shard) for shard, payload in rows]
+
+    def get_raw_ticks(
+        self,
+        server: str,
+        shard: Optional[str] = None,
+        from_tick: Optional[int] = None,
+        to_tick: Optional[int] = None,
+        from_time: Optional[int] = None,
+        to_time: Optional[int] = None,
+    ) -> List[Tuple[RawProfilingHistory, Dict[str, Any]]]:
+        """Like `get_ticks`, but leave each tick in its compressed form.
+
+        Each tick is returned with the history of its own key table.
+        """
+        rows = self._select_payloads(
+            server, shard, from_tick, to_tick, from_time, to_time
+        )
+        return [decode_raw_tick_payload(payload, shard) for shard, payload in rows]
+
+    def iter_raw_ticks(
+        self,
+        server: str,
+        shard: str,
+        from_tick: Optional[int] = None,
+        to_tick: Optional[int] = None,
+        chunk_size: int = 1000,
+    ) -> Iterator[Tuple[RawProfilingHistory, Dict[str, Any]]]:
+        """Yield the stored ticks of a shard in their compressed form.
+
+        Ticks are read `chunk_size` at a time, in no particular order, so
+        only one chunk of them is held at once however big the archive is.
+        The tick range is inclusive, and either end of it can be left open.
+        """
+        where, params = self._tick_range(from_tick, to_tick)
+        after = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT rowid, payload FROM ticks"
+                    f" WHERE server = ? AND shard = ? AND rowid > ?{where}"
+                    " ORDER BY rowid LIMIT ?",
+                    (server, shard, after, *params, chunk_size),
+                ).fetchall()
+            for _, payload in rows:
+                yield decode_raw_tick_payload(payload, shard)
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][0]
+
+    def count_ticks(
+        self,
+        server: str,
+        shard: str,
+        from_tick: Optional[int] = None,
+        to_tick: Optional[int] = None,
+    ) -> int:
+        """Return how many ticks of a shard are stored in an inclusive range."""
+        where, params = self._tick_range(from_tick, to_tick)
+        with self.lock:
+            (count,) = self.conn.execute(
+                f"SELECT COUNT(*) FROM ticks WHERE server = ? AND shard = ?{where}",
+                (server, shard, *params),
+            ).fetchone()
+        return count
+
+    @staticmethod
+    def _tick_range(
+        from_tick: Optional[int], to_tick: Optional[int]
+    ) -> Tuple[str, List[int]]:
+        """Return the conditions of a query for a tick range, and their params."""
+        where = ""
+        params = []
+        if from_tick is not None:
+            where += " AND tick >= ?"
+            params.append(from_tick)
+        if to_tick is not None:
+            where += " AND tick <= ?"
+            params.append(to_tick)
+        return where, params
+
+    def _select_payloads(
+        self,
+        server: str,
+        shard: Optional[str],
+        from_tick: Optional[int],
+        to_tick: Optional[int],
+        from_time: Optional[int],
+        to_time: Optional[int],
+        limit: Optional[int] = None,
+    ) -> List[Tuple[str, bytes]]:
+        """Return the shard and payload of each matching tick."""
+        query = "SELECT shard, payload FROM ticks WHERE server = ?"
+        params: List[Any] = [server]
+        for column, op, value in [
+            ("shard", "=", shard),
+            ("tick", ">=", from_tick),
+            ("tick", "<=", to_tick),
+            ("timestamp", ">=", from_time),
+            ("timestamp", "<=", to_time),
+        ]:
+            if value is not None:
+                query += f" AND {column} {op} ?"
+                params.append(value)
+        query += " ORDER BY tick, timestamp"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def get_unpushed_ticks(
+        self, server: str, shard: str, limit: int = -1
+    ) -> List[TickSummary]:
+        """Return the stored ticks which haven't been pushed to Pyroscope yet.
+
+        Only their summaries are read, so nothing is decompressed. If there
+        is a limit, only the most recent ticks are returned.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT tick_key, timestamp, cpu FROM ticks"
+                " WHERE server = ? AND shard = ? AND NOT pushed"
+                " ORDER BY tick DESC, timestamp DESC LIMIT ?",
+                (server, shard, limit),
+            ).fetchall()
+        return [TickSummary(*row) for row in reversed(rows)]
+
+    def get_ticks_by_key(
+        self, server: str, shard: str, tick_keys: Iterable[str]
+    ) -> List[ProfilingNode]:
+        """Return the stored ticks with the given keys, in no particular order."""
+        tick_keys = list(tick_keys)
+        if not tick_keys:
+            return []
+
+        placeholders = ", ".join("?" * len(tick_keys))
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT payload FROM ticks WHERE server = ? AND shard = ?"
+                f" AND tick_key IN ({placeholders})",
+                [server, shard, *tick_keys],
+            ).fetchall()
+        return [decode_tick_payload(payload, shard) for (payload,) in rows]
+
+    def stored_tick_keys(
+        self, server: str, shard: str, tick_keys: Iterable[str]
+    ) -> Set[str]:
+        """Return which of the given tick keys are already in the archive."""
+        tick_keys = list(tick_keys)
+        if not tick_keys:
+            return set()
+
+        placeholders = ", ".join("?" * len(tick_keys))
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT tick_key FROM ticks WHERE server = ? AND shard = ?"
+                f" AND tick_key IN ({placeholders})",
+                [server, shard, *tick_keys],
+            ).fetchall()
+        return {tick_key for (tick_key,) in rows}
+
+    def pushed_tick_keys(self, server: str, shard: str) -> Set[str]:
+        """Return the keys of the ticks which were pushed to Pyroscope."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT tick_key FROM ticks WHERE server = ? AND shard = ? AND pushed",
+                (server, shard),
+            ).fetchall()
+        return {tick_key for (tick_key,) in rows}
+
+    def mark_pushed(self, server: str, shard: str, tick_keys: Iterable[str]):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE ticks SET pushed = 1"
+                " WHERE server = ? AND shard = ? AND tick_key = ?",
+                [(server, shard, tick_key) for tick_key in tick_keys],
+            )
+
+
+def encode_tick_payload(tick: ProfilingNode) -> bytes:
+    """Encode a tick in the compressed banan format with its own key table."""
+    key_ids: Dict[str, int] = {}
+
+    def compress(node: ProfilingNode) -> list:
+        key_id = key_ids.setdefault(node.key, len(key_ids))
+        return [key_id, node.start, node.cpu, node.intents, []]
+
+    root = compress(tick)
+    pending = [(tick, root)]
+    while pending:
+        node, comp = pending.pop()
+        for child in node.children:
+            child_comp = compress(child)
+            comp[4].append(child_comp)
+            pending.append((child, child_comp))
+
+    payload = {
+        "t": tick.timestamp,
+        "m": [mark.model_dump() for mark in tick.marks or []],
+        "k": list(key_ids),
+        "d": root,
+    }
+    return zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+
+
+def encode_raw_tick_payload(keys: Dict[int, str], tick: Dict[str, Any]) -> bytes:
+    """Encode a raw tick with its own key table, without decompressing it.
+
+    `keys` is the inverted keyMap of the history the tick came from.
+    """
+    local_ids: Dict[int, int] = {}
+
+    def remap(comp: list) -> list:
+        if not isinstance(comp, list) or len(comp) != 5:
+            raise ValueError("Invalid node in banan history: {}".format(comp))
+        if comp[0] not in keys:
+            raise ValueError("Did not find key ID {} in key map".format(comp[0]))
+        local_id = local_ids.setdefault(comp[0], len(local_ids))
+        return [local_id, comp[1], comp[2], comp[3], []]
+
+    root = remap(tick["d"])
+    pending = [(tick["d"], root)]
+    while pending:
+        comp, remapped = pending.pop()
+        for child in comp[4]:
+            child_remapped = remap(child)
+            remapped[4].append(child_remapped)
+            pending.append((child, child_remapped))
+
+    payload = {
+        "t": tick["t"],
+        "m": tick["m"],
+        "k": [keys[key_id] for key_id in local_ids],
+        "d": root,
+    }
+    return zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_tick_payload(payload: bytes, shard: Optional[str] = None) -> ProfilingNode:
+    history, tick = decode_raw_tick_payload(payload, shard)
+    return history.decompress_tick(tick)
+
+
+def decode_raw_tick_payload(
+    payload: bytes, shard: Optional[str] = None
+) -> Tuple[RawProfilingHistory, Dict]:
+    """Decode a tick to its compressed form, with a history of its key table.
+
+    The shard is stored alongside the payload, and the tick is tagged with it.
+    """
+    obj = json.loads(zlib.decompress(payload))
+    return RawProfilingHistory(dict(enumerate(obj["k"])), [obj], shard), obj
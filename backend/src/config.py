@@ -10,7 +10,8 @@ DEBUG_ENABLED = os.getenv("DEBUG")
 DEBUG_ENABLED = True
 DEBUG_DIR = "debug"
 PYROSCOPE_URL = os.getenv("PYROSCOPE_URL", "http://pyroscope:4040")
-CONFIG_FILE_NAME = "secrets.yml"
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "data/archive.sqlite3")
+CONFIG_FILE_NAME = os.getenv("CONFIG_FILE", "secrets.yml")
 
 
 class ServerConfig(BaseModel):
@@ -20,13 +21,92 @@ class ServerConfig(BaseModel):
     email: Optional[str] = None
     password: Optional[str] = None
     shard: str = "shard0"
+    shards: List[str] = []
+    """Every shard the bot runs on, if more than just `shard`."""
+    history_segments: List[int] = []
+    """RawMemory segments the bot writes its history across, in order.
+
+    If empty, the history is read from Memory at `banan_history_key`.
+    """
+    max_requests_per_hour: Optional[float] = None
+    """A budget of Screeps API requests for scraping this server."""
     secure: bool = False
 
+    def get_shards(self) -> List[str]:
+        """Return the shards to scrape, with the default shard first."""
+        return [self.shard] + [shard for shard in self.shards if shard != self.shard]
+
 
 class AppConfig(BaseModel):
     servers: List[ServerConfig]
     banan_history_key: str
 
+    history_cache_ttl: float = 10.0
+    """How long in seconds a fetched history is reused for."""
+
+    scrape_interval: float = 30.0
+    """Seconds between scrapes of a server, until its tick rate is known."""
+
+    scrape_min_interval: float = 5.0
+    """The fewest seconds between scrapes of a server."""
+
+    scrape_max_interval: float = 600.0
+    """The most seconds between scrapes of a server, however slow it ticks."""
+
+    scrape_safety: float = 0.25
+    """Fraction of the bot's history still unread when a scrape is due.
+
+    This leaves time for the fetch, and for ticks which come faster than
+    measured, before the oldest unread tick is overwritten.
+    """
+
+    scrape_poll_interval: float = 1.0
+    """Seconds between checks for servers which are due to be scraped."""
+
+    scrape_workers: int = 4
+    """How many servers can be scraped at once."""
+
+    scrape_timeout: float = 25.0
+    """Seconds a scrape cycle waits for each server."""
+
+    pyroscope_batch_size: int = 10
+    """How many ticks are sent to Pyroscope in each profile."""
+
+    pyroscope_max_batches: int = 100
+    """How many batches are kept queued while Pyroscope is unavailable."""
+
+    pyroscope_flush_interval: float = 5.0
+    """Seconds between pushes of the queued batches to Pyroscope."""
+
+    live_tail_max_queued: int = 100
+    """The most new ticks queued for each live tail client.
+
+    A client which falls further behind reads the ticks it missed from the
+    archive instead.
+    """
+
+    diff_max_ticks: int = 10_000
+    """The most archived ticks in each bounded range of a diff.
+
+    A range with no bounds is compared from the aggregate of every tick,
+    which is kept up to date, so isn't limited.
+    """
+
+    cost_index_stacks: bool = False
+    """Whether to index the cost of every full stack, as well as every key."""
+
+    tree_cache_max_nodes: int = 500_000
+    """How many nodes of decompressed ticks are kept in memory, over all servers."""
+
+    screeps_token_ttl: float = 3600.0
+    """Seconds a token from signing in is reused for, unless it's rejected."""
+
+    capture_dir: Optional[str] = None
+    """If set, every Memory response is saved here, to be replayed offline."""
+
+    capture_max_bytes: int = 512 * 1024 * 1024
+    """How big the capture directory can get before old responses are deleted."""
+
     def get_server_cfg(self, name: str) -> Optional[ServerConfig]:
         """Get a server configuration by name."""
         for server_cfg in self.servers:
@@ -0,0 +1,169 @@
+"""A bounded on-disk corpus of Memory responses captured from Screeps.
+
+When capture is enabled, each raw response is saved with how long it took
+to arrive, so scrapes can later be replayed offline by `bench/replay.py`.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ENTRY_SUFFIX = ".json"
+
+
+class CapturedResponse:
+    """A Memory response exactly as it was received from a server."""
+
+    def __init__(
+        self,
+        server: str,
+        shard: str,
+        path: str,
+        status: int,
+        elapsed: float,
+        captured_at: float,
+        body: bytes,
+    ):
+        self.server = server
+        self.shard = shard
+        self.path = path
+        self.status = status
+
+        self.elapsed = elapsed
+        """Seconds from sending the request to reading the whole response."""
+
+        self.captured_at = captured_at
+        """Unix time in seconds when the response arrived."""
+
+        self.body = body
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "server": self.server,
+                "shard": self.shard,
+                "path": self.path,
+                "status": self.status,
+                "elapsed": self.elapsed,
+                "captured_at": self.captured_at,
+                # Memory responses are JSON, so always valid UTF-8
+                "body": self.body.decode("utf-8"),
+            }
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "CapturedResponse":
+        obj = json.loads(data)
+        return cls(
+            obj["server"],
+            obj["shard"],
+            obj["path"],
+            obj["status"],
+            obj["elapsed"],
+            obj["captured_at"],
+            obj["body"].encode("utf-8"),
+        )
+
+
+class ResponseCorpus:
+    """Captured responses stored one per file, oldest removed first.
+
+    Files are named by a sequence number, so they sort in capture order.
+    Once the corpus holds more than `max_entries` files or `max_bytes`
+    bytes, the oldest files are deleted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_entries: int = 10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+        # Captures are written from worker threads
+        self.lock = threading.Lock()
+        self.files: List[Tuple[str, int]] = [
+            (name, os.path.getsize(os.path.join(directory, name)))
+            for name in self._entry_names()
+        ]
+        self.size = sum(size for _, size in self.files)
+        self.next_sequence = (
+            int(self.files[-1][0][: -len(ENTRY_SUFFIX)]) + 1 if self.files else 0
+        )
+
+    def _entry_names(self) -> List[str]:
+        return sorted(
+            name
+            for name in os.listdir(self.directory)
+            if name.endswith(ENTRY_SUFFIX) and name[: -len(ENTRY_SUFFIX)].isdigit()
+        )
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def add(self, response: CapturedResponse):
+        data = response.to_json().encode("utf-8")
+        with self.lock:
+            name = f"{self.next_sequence:010d}{ENTRY_SUFFIX}"
+            self.next_sequence += 1
+
+            # Write then rename, so a reader never sees half an entry
+            path = os.path.join(self.directory, name)
+            with open(path + ".tmp", "wb") as fh:
+                fh.write(data)
+            os.replace(path + ".tmp", path)
+
+            self.files.append((name, len(data)))
+            self.size += len(data)
+            self._evict()
+
+    def _evict(self):
+        while len(self.files) > 1 and (
+            len(self.files) > self.max_entries or self.size > self.max_bytes
+        ):
+            name, size = self.files.pop(0)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def __iter__(self) -> Iterator[CapturedResponse]:
+        """Read every response, oldest first."""
+        with self.lock:
+            names = [name for name, _ in self.files]
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name)) as fh:
+                    yield CapturedResponse.from_json(fh.read())
+            except FileNotFoundError:
+                # Evicted since we listed it
+                continue
+
+    def capture(
+        self,
+        server: str,
+        shard: str,
+        path: str,
+        status: int,
+        elapsed: float,
+        body: bytes,
+        captured_at: Optional[float] = None,
+    ):
+        """Save a response, logging rather than raising if it can't be written.
+
+        A full disk shouldn't stop the scrape the response came from.
+        """
+        captured_at = time.time() if captured_at is None else captured_at
+        try:
+            self.add(
+                CapturedResponse(
+                    server, shard, path, status, elapsed, captured_at, body
+                )
+            )
+        except OSError:
+            logger.exception("Failed to capture response from %s", server)
@@ -0,0 +1,383 @@
+"""Columnar time series of the cost of every function, for fast queries."""
+
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from src.archive import parse_tick_number
+from src.fetch_history import ProfilingNode
+from src.history_query import RawTick
+from src.tick_tree import TickTree
+
+TICK_KEY = "Tick"
+"""The key the root of every tick is indexed under."""
+
+STACK_SEPARATOR = ";"
+
+METRICS = ("self", "total", "intents", "calls")
+
+# The columns of a table, with one row per key per tick
+COLUMN_DTYPES = {
+    "tick": np.int64,
+    "timestamp": np.int64,
+    "key": np.int32,
+    "self": np.float64,
+    "total": np.float64,
+    "intents": np.int64,
+    "calls": np.int32,
+}
+
+
+class CostTable:
+    """The per tick cost of each key, stored as one typed array per column.
+
+    Each tick adds one row for every key called during it, with the
+    summed self cost, total cost, intents and calls of that key. Rows are
+    appended in chunks, which are only joined together when queried.
+    """
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.key_ids: Dict[str, int] = {}
+        self._chunks: List[Dict[str, np.ndarray]] = []
+
+    def key_id(self, key: str) -> int:
+        key_id = self.key_ids.get(key)
+        if key_id is None:
+            key_id = self.key_ids[key] = len(self.keys)
+            self.keys.append(key)
+        return key_id
+
+    def append(
+        self,
+        tick: int,
+        timestamp: int,
+        key_id: np.ndarray,
+        self_cost: np.ndarray,
+        cpu: np.ndarray,
+        intents: np.ndarray,
+        nested: np.ndarray,
+    ):
+        """Add the rows for one tick, from the nodes of its tree.
+
+        `nested` marks the nodes called from within another call of the
+        same key, which are left out of the total cost and intents so
+        recursion isn't counted twice.
+        """
+        length = len(self.keys)
+        outer = ~nested
+        calls = np.bincount(key_id, minlength=length)
+        present = np.flatnonzero(calls)
+        chunk = {
+            "tick": np.full(len(present), tick),
+            "timestamp": np.full(len(present), timestamp),
+            "key": present,
+            "self": np.bincount(key_id, weights=self_cost, minlength=length)[present],
+            "total": np.bincount(key_id[outer], weights=cpu[outer], minlength=length)[
+                present
+            ],
+            "intents": np.bincount(
+                key_id[outer], weights=intents[outer], minlength=length
+            )[present],
+            "calls": calls[present],
+        }
+        self._chunks.append(
+            {name: chunk[name].astype(dtype) for name, dtype in COLUMN_DTYPES.items()}
+        )
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Return every row, joining the chunks added since the last query."""
+        if len(self._chunks) != 1:
+            if not self._chunks:
+                return {
+                    name: np.empty(0, dtype=dtype)
+                    for name, dtype in COLUMN_DTYPES.items()
+                }
+            self._chunks = [
+                {
+                    name: np.concatenate([chunk[name] for chunk in self._chunks])
+                    for name in COLUMN_DTYPES
+                }
+            ]
+        return self._chunks[0]
+
+
+class CostIndex:
+    """The cost of every function key in every tick, for vectorized queries.
+
+    Costs are indexed by function key, and optionally by full stack path
+    too. Queries are answered from the typed columns without touching the
+    call trees. A tick is never indexed twice.
+    """
+
+    def __init__(self, stacks: bool = False):
+        self.functions = CostTable()
+        self.stacks: Optional[CostTable] = CostTable() if stacks else None
+
+        self.tick_keys: Set[str] = set()
+        # The tick number of every indexed tick, to count ticks in a range
+        self._ticks: List[int] = []
+        # The stack ID of each call, by the packed stack ID of its caller and
+        # its key
+        self._stack_calls: Dict[int, int] = {}
+
+    @classmethod
+    def from_ticks(
+        cls, ticks: Iterable[ProfilingNode], stacks: bool = False
+    ) -> "CostIndex":
+        index = cls(stacks)
+        index.add_ticks(ticks)
+        return index
+
+    def add_ticks(self, ticks: Iterable[ProfilingNode]) -> int:
+        """Index the ticks not already indexed, returning how many were new."""
+        added = 0
+        for tick in ticks:
+            if tick.key in self.tick_keys:
+                continue
+            self.tick_keys.add(tick.key)
+            self._add_tree(TickTree.from_profiling_node(tick))
+            added += 1
+        return added
+
+    def add_raw_ticks(self, ticks: Iterable[RawTick]) -> int:
+        """Like `add_ticks`, but build each tree straight from a compressed tick."""
+        added = 0
+        for history, tick in ticks:
+            tick_key = history.tick_key(tick)
+            if tick_key in self.tick_keys:
+                continue
+            self.tick_keys.add(tick_key)
+            self._add_tree(TickTree.from_raw_tick(history, tick))
+            added += 1
+        return added
+
+    def _add_tree(self, tree: TickTree):
+        tick = parse_tick_number(tree.key)
+        tick = -1 if tick is None else tick
+        timestamp = tree.timestamp or 0
+        self._ticks.append(tick)
+
+        # Every tick has a different root key, so index them all under one
+        local_ids = np.zeros(max(tree.keys, default=-1) + 1, dtype=np.int64)
+        for local_id, key in tree.keys.items():
+            local_ids[local_id] = self.functions.key_id(key)
+        key_id = local_ids[tree.key_id]
+        key_id[0] = self.functions.key_id(TICK_KEY)
+
+        self_cost = np.maximum(tree.self_costs(), 0.0)
+        self.functions.append(
+            tick,
+            timestamp,
+            key_id,
+            self_cost,
+            tree.cpu,
+            tree.intents,
+            nested_in_same_key(key_id, tree.subtree_end),
+        )
+
+        if self.stacks is not None:
+            stack_id = self._stack_ids(tree, key_id)
+            # A stack can't be called from within itself
+            nested = np.zeros(len(tree), dtype=bool)
+            self.stacks.append(
+                tick, timestamp, stack_id, self_cost, tree.cpu, tree.intents, nested
+            )
+
+    def _stack_ids(self, tree: TickTree, key_id: np.ndarray) -> np.ndarray:
+        """Return the stack ID of every node, a level of the tree at a time.
+
+        A stack is its caller's stack and its own key, so the nodes of each
+        depth are grouped by that pair, and only each distinct pair is
+        looked up.
+        """
+        stacks = self.stacks
+        assert stacks is not None
+
+        stack_id = np.empty(len(tree), dtype=np.int64)
+        stack_id[0] = stacks.key_id(TICK_KEY)
+
+        depths = tree.depths()
+        by_depth = np.argsort(depths, kind="stable")
+        level_ends = np.cumsum(np.bincount(depths))
+        for start, end in zip(level_ends[:-1], level_ends[1:]):
+            nodes = by_depth[start:end]
+            # Both IDs fit in 32 bits, so a pair packs into one integer
+            calls = (stack_id[tree.parent[nodes]] << 32) | key_id[nodes]
+            unique_calls, inverse = np.unique(calls, return_inverse=True)
+            known = self._stack_calls
+            ids = [
+                known[call] if call in known else self._add_stack_call(call)
+                for call in unique_calls.tolist()
+            ]
+            stack_id[nodes] = np.array(ids, dtype=np.int64)[inverse]
+        return stack_id
+
+    def _add_stack_call(self, call: int) -> int:
+        """Add the stack of a call, packed as its caller's stack ID and key."""
+        stacks = self.stacks
+        assert stacks is not None
+        caller, key = call >> 32, call & 0xFFFFFFFF
+        path = stacks.keys[caller] + STACK_SEPARATOR + self.functions.keys[key]
+        stack_id = self._stack_calls[call] = stacks.key_id(path)
+        return stack_id
+
+    def table(self, stacks: bool = False) -> CostTable:
+        if not stacks:
+            return self.functions
+        if self.stacks is None:
+            raise ValueError("Stacks aren't indexed")
+        return self.stacks
+
+    def tick_count(
+        self, from_tick: Optional[int] = None, to_tick: Optional[int] = None
+    ) -> int:
+        ticks = np.array(self._ticks, dtype=np.int64)
+        return int(np.count_nonzero(tick_range_mask(ticks, from_tick, to_tick)))
+
+    def top(
+        self,
+        n: int = 10,
+        by: str = "mean",
+        metric: str = "self",
+        from_tick: Optional[int] = None,
+        to_tick: Optional[int] = None,
+        stacks: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """Return the `n` keys with the highest mean or p95 cost per tick.
+
+        Ticks in the range which didn't call a key count as a cost of 0.
+        """
+        if n < 1:
+            raise ValueError("n must be at least 1")
+        if by not in ("mean", "p95"):
+            raise ValueError(f"Can't rank by {by}")
+        if metric not in METRICS:
+            raise ValueError(f"No such metric: {metric}")
+
+        table = self.table(stacks)
+        columns = table.columns()
+        mask = tick_range_mask(columns["tick"], from_tick, to_tick)
+        tick_count = self.tick_count(from_tick, to_tick)
+        if not tick_count:
+            return []
+
+        key_id = columns["key"][mask]
+        values = columns[metric][mask].astype(np.float64)
+        length = len(table.keys)
+
+        ticks_called = np.bincount(key_id, minlength=length)
+        means = np.bincount(key_id, weights=values, minlength=length) / tick_count
+        maxes = np.zeros(length)
+        np.maximum.at(maxes, key_id, values)
+        p95s = grouped_percentile(key_id, values, length, tick_count, 0.95)
+
+        scores = means if by == "mean" else p95s
+        candidates = np.flatnonzero(ticks_called)
+        # Highest first, breaking ties by key ID so results are stable
+        order = np.lexsort((candidates, -scores[candidates]))[:n]
+
+        return [
+            {
+                "key": table.keys[key],
+                "mean": float(means[key]),
+                "p95": float(p95s[key]),
+                "max": float(maxes[key]),
+                "ticks": int(ticks_called[key]),
+            }
+            for key in candidates[order]
+        ]
+
+    def series(
+        self,
+        key: str,
+        from_tick: Optional[int] = None,
+        to_tick: Optional[int] = None,
+        stacks: bool = False,
+    ) -> Dict[str, List[Any]]:
+        """Return the cost of a key in each tick it was called, in tick order."""
+        table = self.table(stacks)
+        key_id = table.key_ids.get(key)
+        if key_id is None:
+            raise KeyError(key)
+
+        columns = table.columns()
+        mask = (columns["key"] == key_id) & tick_range_mask(
+            columns["tick"], from_tick, to_tick
+        )
+        rows = np.flatnonzero(mask)
+        rows = rows[np.argsort(columns["tick"][rows], kind="stable")]
+        return {
+            name: columns[name][rows].tolist()
+            for name in COLUMN_DTYPES
+            if name != "key"
+        }
+
+
+def tick_range_mask(
+    ticks: np.ndarray, from_tick: Optional[int], to_tick: Optional[int]
+) -> np.ndarray:
+    """Select the ticks in an inclusive range, where either end can be open."""
+    mask = np.ones(len(ticks), dtype=bool)
+    if from_tick is not None:
+        mask &= ticks >= from_tick
+    if to_tick is not None:
+        mask &= ticks <= to_tick
+    return mask
+
+
+def nested_in_same_key(key_id: np.ndarray, subtree_end: np.ndarray) -> np.ndarray:
+    """Mark the nodes of a pre-order tree called within a node of the same key.
+
+    The nodes of each key are grouped in pre-order. A node is nested if it
+    starts before the furthest subtree end of the earlier nodes of its key.
+    Offsetting each group by more than the tree size lets one running
+    maximum cover every group at once.
+    """
+    count = len(key_id)
+    if not count:
+        return np.zeros(0, dtype=bool)
+
+    indices = np.arange(count)
+    order = np.lexsort((indices, key_id))
+    offset = key_id[order].astype(np.int64) * (count + 1)
+    starts = indices[order] + offset
+    ends = np.maximum.accumulate(subtree_end[order] + offset)
+
+    nested = np.zeros(count, dtype=bool)
+    nested[order[1:]] = starts[1:] < ends[:-1]
+    return nested
+
+
+def grouped_percentile(
+    key_id: np.ndarray,
+    values: np.ndarray,
+    length: int,
+    tick_count: int,
+    q: float,
+) -> np.ndarray:
+    """Return a percentile of the values of each key over `tick_count` ticks.
+
+    Each key has at most one value per tick, and the ticks without a value
+    count as 0. Like `np.percentile`, it interpolates linearly between the
+    closest ranks.
+    """
+    order = np.lexsort((values, key_id))
+    sorted_values = values[order]
+    counts = np.bincount(key_id, minlength=length)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    zeros = tick_count - counts
+
+    position = q * (tick_count - 1)
+    lower = int(np.floor(position))
+    upper = min(lower + 1, tick_count - 1)
+    fraction = position - lower
+
+    def value_at(rank: int) -> np.ndarray:
+        # The zeros come first, then the key's values in ascending order
+        index = np.clip(starts + rank - zeros, 0, max(len(sorted_values) - 1, 0))
+        found = sorted_values[index] if len(sorted_values) else np.zeros(length)
+        return np.where(rank < zeros, 0.0, found)
+
+    low = value_at(lower)
+    return low + (value_at(upper) - low) * fraction
@@ -1,10 +1,17 @@
+import asyncio
 import json
-from typing import Dict, List, Optional, Tuple
+import logging
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import pydantic
-import screepsapi
 
-from src.config import DEBUG_DIR, DEBUG_ENABLED, AppConfig, load_config
+from src.config import DEBUG_DIR, DEBUG_ENABLED, AppConfig
+from src.metrics import STAGE_SECONDS
+from src.screeps_client import ScreepsClient, decode_memory_data
+from src.segments import decode_segment_response, reassemble_segments
+
+logger = logging.getLogger(__name__)
 
 EXPECTED_BANAN_FORMAT_VERSION = 2
 
@@ -42,7 +49,9 @@ class CompressedProfilingHistory(pydantic.BaseModel):
     """See equivalent TypeScript definition."""
 
     version: int
-    ticks: List[CompressedProfilingDump]
+    ticks: List[Optional[CompressedProfilingDump]]
+    """The bot's ring buffer, which has None for ticks not yet recorded."""
+
     keyMap: KeyMap
 
 
@@ -56,6 +65,13 @@ class ProfilingNode(pydantic.BaseModel):
     children: List["ProfilingNode"]
     marks: Optional[List[ProfilingMark]] = None
     timestamp: Optional[int] = None
+    shard: Optional[str] = None
+
+    _child_starts: Optional[List[float]] = pydantic.PrivateAttr(default=None)
+    """Sorted start times of the children, when they don't overlap."""
+
+    _child_index_size: int = pydantic.PrivateAttr(default=-1)
+    """Number of children when the index was built, to notice appends."""
 
     def self_cost(self) -> float:
         """Return the cpu cost of this node minus the cost of the children."""
@@ -67,6 +83,61 @@ class ProfilingNode(pydantic.BaseModel):
     def get_end_time(self) -> float:
         return self.start + self.cpu
 
+    def count_nodes(self) -> int:
+        """Return the number of nodes in the tree under this one, inclusive."""
+        count = 0
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            count += 1
+            pending.extend(node.children)
+        return count
+
+    def contains_time(self, search_time: float) -> bool:
+        return self.start <= search_time <= self.get_end_time()
+
+    def find_child_index(self, search_time: float) -> Optional[int]:
+        """Return the index of the first child running at the given time.
+
+        Children recorded by the bot are ordered and don't overlap, so the
+        lookup is a bisect over their start times. If that doesn't hold
+        (e.g. a hand built tree) fall back to checking every child.
+        """
+        if not self.has_ordered_children():
+            for i, child in enumerate(self.children):
+                if child.contains_time(search_time):
+                    return i
+            return None
+
+        i = bisect_right(self._child_starts, search_time) - 1
+        if i < 0 or not self.children[i].contains_time(search_time):
+            return None
+
+        # Neighbours may touch at the boundary (or have zero cpu), in which
+        # case the earliest one is the match
+        while i > 0 and self.children[i - 1].contains_time(search_time):
+            i -= 1
+        return i
+
+    def has_ordered_children(self) -> bool:
+        """Whether the children are sorted by time and don't overlap."""
+        if self._child_index_size != len(self.children):
+            self._build_child_index()
+        return self._child_starts is not None
+
+    def _build_child_index(self):
+        starts = []
+        prev_end = None
+        for child in self.children:
+            if prev_end is not None and child.start < prev_end:
+                starts = None
+                break
+            starts.append(child.start)
+            prev_end = child.get_end_time()
+
+        self._child_starts = starts
+        self._child_index_size = len(self.children)
+
     def search_by_time(
         self, search_time: float, call_stack: List[str]
     ) -> Tuple[Optional["ProfilingNode"], List[str]]:
@@ -76,22 +147,21 @@ class ProfilingNode(pydantic.BaseModel):
         """
         call_stack.append(self.key)
 
-        if search_time < self.start or search_time > self.get_end_time():
+        if not self.contains_time(search_time):
             return None, call_stack
 
-        # It's a leaf node so it must be this
-        if not self.children:
-            return self, call_stack
+        node = self
+        while True:
+            i = node.find_child_index(search_time)
+            # Either a leaf node or no children matched, so it must be this
+            if i is None:
+                return node, call_stack
+
+            node = node.children[i]
+            call_stack.append(node.key)
 
-        for child in self.children:
-            (target, _) = child.search_by_time(search_time, call_stack)
-            if target:
-                return target, call_stack
-            else:
-                call_stack.pop()
 
-        # No children matched so it must be this
-        return self, call_stack
+_NODE_FIELDS_SET = frozenset(["key", "start", "cpu", "intents", "children"])
 
 
 def decompress_history(comp: CompressedProfilingHistory) -> List[ProfilingNode]:
@@ -100,7 +170,7 @@ def decompress_history(comp: CompressedProfilingHistory) -> List[ProfilingNode]:
         raise ValueError(
             f"Expected banan format version {EXPECTED_BANAN_FORMAT_VERSION} but got {comp.version}"
         )
-    return [decompress_dump(comp.keyMap, dump) for dump in comp.ticks]
+    return [decompress_dump(comp.keyMap, dump) for dump in comp.ticks if dump]
 
 
 def decompress_dump(keyMap: KeyMap, dump: CompressedProfilingDump) -> ProfilingNode:
@@ -129,37 +199,233 @@ def decompress_node(inverted_key_map: Dict[int, str], node: Tuple) -> ProfilingN
     )
 
 
-def fetch_history(cfg: AppConfig, server_name: str) -> List[ProfilingNode]:
+class RawProfilingHistory:
+    """A compressed dump of profiling history, decoded straight from JSON.
+
+    This is a fast path compared to validating a CompressedProfilingHistory.
+    Only the outer schema is checked, and the ticks are left in their raw
+    compressed form until they are decompressed. The keyMap is inverted
+    once and shared by every tick.
+    """
+
+    def __init__(
+        self,
+        keys: Dict[int, str],
+        ticks: List[Dict[str, Any]],
+        shard: Optional[str] = None,
+        capacity: Optional[int] = None,
+    ):
+        self.keys = keys
+        """The inverted keyMap, to find a key by ID."""
+
+        self.ticks = ticks
+        """The recorded ticks, in ring buffer order."""
+
+        self.capacity = len(ticks) if capacity is None else capacity
+        """The size of the bot's ring buffer, including ticks not yet recorded."""
+
+        self.shard = shard
+        """The shard the ticks were recorded on, which they're tagged with."""
+
+    @classmethod
+    def from_json(
+        cls, data: Union[str, bytes], shard: Optional[str] = None
+    ) -> "RawProfilingHistory":
+        return cls.from_obj(json.loads(data), shard)
+
+    @classmethod
+    def from_obj(cls, obj: Any, shard: Optional[str] = None) -> "RawProfilingHistory":
+        if not isinstance(obj, dict):
+            raise ValueError("Expected banan history to be an object")
+
+        version = obj.get("version")
+        if version != EXPECTED_BANAN_FORMAT_VERSION:
+            raise ValueError(
+                f"Expected banan format version {EXPECTED_BANAN_FORMAT_VERSION} but got {version}"
+            )
+
+        key_map = obj.get("keyMap")
+        if not isinstance(key_map, dict) or not isinstance(key_map.get("map"), dict):
+            raise ValueError("Expected banan history to have a keyMap")
+
+        ticks = obj.get("ticks")
+        if not isinstance(ticks, list):
+            raise ValueError("Expected banan history to have a list of ticks")
+
+        recorded = []
+        for tick in ticks:
+            # The bot pre-fills its ring buffer with nulls
+            if tick is None:
+                continue
+            if (
+                not isinstance(tick, dict)
+                or not isinstance(tick.get("t"), int)
+                or not isinstance(tick.get("m"), list)
+                or not isinstance(tick.get("d"), list)
+                or len(tick["d"]) != 5
+            ):
+                raise ValueError("Invalid tick in banan history")
+            recorded.append(tick)
+
+        keys = {v: k for k, v in key_map["map"].items()}
+        return cls(keys, recorded, shard, capacity=len(ticks))
+
+    def tick_key(self, tick: Dict[str, Any]) -> str:
+        """Return the key of the root node of a tick without decompressing it."""
+        key = self.keys.get(tick["d"][0])
+        if key is None:
+            raise ValueError("Did not find key ID {} in key map".format(tick["d"][0]))
+        return key
+
+    def decompress(self) -> List[ProfilingNode]:
+        return [self.decompress_tick(tick) for tick in self.ticks]
+
+    def decompress_tick(self, tick: Dict[str, Any]) -> ProfilingNode:
+        """Decompress a single raw tick, without recursion.
+
+        Nodes are built without validation, since the structure of each
+        compressed node is checked as it is visited.
+        """
+        root = None
+        pending: List[Tuple[Any, Optional[ProfilingNode]]] = [(tick["d"], None)]
+        while pending:
+            comp, parent = pending.pop()
+            if not isinstance(comp, list) or len(comp) != 5:
+                raise ValueError("Invalid node in banan history: {}".format(comp))
+
+            key = self.keys.get(comp[0])
+            if key is None:
+                raise ValueError("Did not find key ID {} in key map".format(comp[0]))
+            if not isinstance(comp[4], list):
+                raise ValueError("Invalid node in banan history: {}".format(comp))
+            try:
+                start, cpu, intents = float(comp[1]), float(comp[2]), int(comp[3])
+            except (TypeError, ValueError):
+                raise ValueError("Invalid node in banan history: {}".format(comp))
+
+            # Passing every field, and which were set, spares model_construct
+            # from looking up the defaults of each node
+            node = ProfilingNode.model_construct(
+                set(_NODE_FIELDS_SET),
+                key=key,
+                start=start,
+                cpu=cpu,
+                intents=intents,
+                children=[],
+                marks=None,
+                timestamp=None,
+                shard=None,
+            )
+            if parent is None:
+                root = node
+            else:
+                parent.children.append(node)
+
+            for child in reversed(comp[4]):
+                pending.append((child, node))
+
+        assert root is not None
+        root.marks = [ProfilingMark.model_validate(mark) for mark in tick["m"]]
+        root.timestamp = tick["t"]
+        root.shard = self.shard
+        return root
+
+
+async def fetch_raw_history_async(
+    cfg: AppConfig,
+    server_name: str,
+    client: ScreepsClient,
+    shard: Optional[str] = None,
+) -> RawProfilingHistory:
+    """Fetch the profiling history from screeps without blocking the event loop.
+
+    The history of the server's default shard is fetched, unless another
+    is given. It's read from Memory, or from RawMemory segments if the
+    server has `history_segments`, which are all fetched at once.
+    Decoding the response is CPU bound, so is done in a worker thread.
+    """
     server_cfg = cfg.get_server_cfg(server_name)
     if not server_cfg:
         raise ValueError("No such server: {}".format(server_name))
 
-    pargs = []
-    kwargs = {}
+    shard = shard or server_cfg.shard
+    segments = server_cfg.history_segments
+    if segments:
+        with STAGE_SECONDS.time(stage="fetch", server=server_name):
+            resps = await asyncio.gather(
+                *[
+                    client.get_memory_segment(server_cfg, segment, shard)
+                    for segment in segments
+                ]
+            )
+        return await asyncio.to_thread(
+            parse_segment_responses,
+            dict(zip(segments, resps)),
+            server_name,
+            shard,
+        )
+
+    with STAGE_SECONDS.time(stage="fetch", server=server_name):
+        resp = await client.get_memory(server_cfg, cfg.banan_history_key, shard)
+    return await asyncio.to_thread(parse_memory_response, resp, server_name, shard)
 
-    if server_cfg.token:
-        kwargs["token"] = server_cfg.token
-    else:
-        pargs.append(server_cfg.email)
-        pargs.append(server_cfg.password)
 
-    kwargs["host"] = server_cfg.host
-    kwargs["secure"] = server_cfg.secure
+async def fetch_shard_histories_async(
+    cfg: AppConfig, server_name: str, client: ScreepsClient
+) -> Dict[str, RawProfilingHistory]:
+    """Fetch the history of every shard of a server concurrently.
 
-    api = screepsapi.API(*pargs, **kwargs)
+    A shard which fails is logged and left out, unless they all fail.
+    """
+    server_cfg = cfg.get_server_cfg(server_name)
+    if not server_cfg:
+        raise ValueError("No such server: {}".format(server_name))
 
-    resp = api.memory(shard="shard0", path=cfg.banan_history_key)
+    shards = server_cfg.get_shards()
+    results = await asyncio.gather(
+        *[fetch_raw_history_async(cfg, server_name, client, shard) for shard in shards],
+        return_exceptions=True,
+    )
+
+    histories = {}
+    for shard, result in zip(shards, results):
+        if isinstance(result, BaseException):
+            if len(shards) == 1:
+                raise result
+            logger.error(
+                "Error fetching history of %s/%s", server_name, shard, exc_info=result
+            )
+            continue
+        histories[shard] = result
+
+    if not histories:
+        raise ValueError("Failed to fetch any shard of {}".format(server_name))
+    return histories
+
+
+def parse_memory_response(
+    resp: Dict[str, Any], server_name: str = "", shard: Optional[str] = None
+) -> RawProfilingHistory:
     if DEBUG_ENABLED:
         with open(f"{DEBUG_DIR}/dump.json", "w") as fh:
             fh.write(json.dumps(resp))
 
-    if not resp or not resp.get("ok") or not resp.get("data"):
-        raise ValueError("Failed to fetch history: {}".format(resp))
-
-    comp = CompressedProfilingHistory.model_validate_json(resp["data"])
-    return decompress_history(comp)
-
-
-if __name__ == "__main__":
-    cfg = load_config()
-    print(json.dumps(fetch_history(cfg, "pserver"), indent=4))
+    with STAGE_SECONDS.time(stage="decode", server=server_name):
+        data = decode_memory_data(resp)
+    with STAGE_SECONDS.time(stage="parse", server=server_name):
+        return RawProfilingHistory.from_json(data, shard)
+
+
+def parse_segment_responses(
+    resps: Dict[int, Dict[str, Any]], server_name: str = "", shard: Optional[str] = None
+) -> RawProfilingHistory:
+    with STAGE_SECONDS.time(stage="decode", server=server_name):
+        values = {}
+        for segment, resp in resps.items():
+            value = decode_segment_response(segment, resp)
+            # Segments past the end of a short history may never be written
+            if value is not None:
+                values[segment] = value
+        data = reassemble_segments(values)
+    with STAGE_SECONDS.time(stage="parse", server=server_name):
+        return RawProfilingHistory.from_json(data, shard)
@@ -0,0 +1,74 @@
+"""Cache of the profiling history fetched from each screeps server."""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class CacheEntry(Generic[T]):
+    def __init__(self, value: T, fetched_at: float):
+        self.value = value
+        self.fetched_at = fetched_at
+
+
+class HistoryCache(Generic[T]):
+    """A per-server cache with a TTL, which coalesces concurrent fetches.
+
+    When the cached value for a server is missing or stale, the first caller
+    starts a fetch with `loader` and any other callers arriving before it
+    finishes wait on that same fetch, so there is only ever one upstream
+    request per server in flight.
+    """
+
+    def __init__(self, loader: Callable[[str], Awaitable[T]], ttl: float):
+        self.loader = loader
+        self.ttl = ttl
+
+        self.entries: Dict[str, CacheEntry[T]] = {}
+        self.in_flight: Dict[str, "asyncio.Future[T]"] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, server_name: str, max_age: Optional[float] = None) -> T:
+        """Return the history of a server, fetching it if the cache is stale."""
+        max_age = self.ttl if max_age is None else max_age
+        entry = self.entries.get(server_name)
+        if entry and time.monotonic() - entry.fetched_at <= max_age:
+            self.hits += 1
+            return entry.value
+
+        self.misses += 1
+        return await self.refresh(server_name)
+
+    async def refresh(self, server_name: str) -> T:
+        """Fetch the history of a server, joining a fetch already in flight.
+
+        This is also used by the scheduler to keep the cache warm.
+        """
+        future = self.in_flight.get(server_name)
+        if future is None:
+            future = asyncio.ensure_future(self._load(server_name))
+            self.in_flight[server_name] = future
+            future.add_done_callback(lambda done: self._finish_load(server_name, done))
+
+        # One waiter giving up shouldn't cancel the fetch for the others
+        return await asyncio.shield(future)
+
+    def invalidate(self, server_name: str):
+        self.entries.pop(server_name, None)
+
+    async def _load(self, server_name: str) -> T:
+        value = await self.loader(server_name)
+        self.entries[server_name] = CacheEntry(value, time.monotonic())
+        return value
+
+    def _finish_load(self, server_name: str, future: "asyncio.Future[T]"):
+        if self.in_flight.get(server_name) is future:
+            del self.in_flight[server_name]
+        # Avoid warnings about an exception nobody retrieved, if every
+        # waiter was cancelled
+        if not future.cancelled():
+            future.exception()
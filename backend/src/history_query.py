@@ -0,0 +1,145 @@
+"""Choose and trim the ticks of a history before they're decompressed."""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from src.archive import parse_tick_number
+from src.fetch_history import RawProfilingHistory
+
+OTHER_KEY = "other"
+"""The key of the node which small calls are folded into."""
+
+RawTick = Tuple[RawProfilingHistory, Dict[str, Any]]
+
+
+class HistoryQuery:
+    """Which ticks of a history to return, and how much of their trees.
+
+    Ticks are chosen by an inclusive range of tick numbers and timestamp
+    window, and then only the `last` most recent are kept. Nodes deeper
+    than `max_depth` are cut off, where the root is at depth 0. Calls
+    which took less than `min_cpu` are folded into one "other" node under
+    their parent.
+
+    This all works on the compressed ticks, so the parts of the trees
+    which are dropped are never decompressed.
+    """
+
+    def __init__(
+        self,
+        from_tick: Optional[int] = None,
+        to_tick: Optional[int] = None,
+        from_time: Optional[int] = None,
+        to_time: Optional[int] = None,
+        last: Optional[int] = None,
+        max_depth: Optional[int] = None,
+        min_cpu: Optional[float] = None,
+    ):
+        if last is not None and last < 0:
+            raise ValueError("last can't be negative")
+        if max_depth is not None and max_depth < 0:
+            raise ValueError("max_depth can't be negative")
+
+        self.from_tick = from_tick
+        self.to_tick = to_tick
+        self.from_time = from_time
+        self.to_time = to_time
+        self.last = last
+        self.max_depth = max_depth
+        self.min_cpu = min_cpu
+
+    @property
+    def prunes(self) -> bool:
+        return self.max_depth is not None or self.min_cpu is not None
+
+    def matches(self, tick_key: str, timestamp: int) -> bool:
+        if self.from_tick is not None or self.to_tick is not None:
+            tick = parse_tick_number(tick_key)
+            if tick is None:
+                return False
+            if self.from_tick is not None and tick < self.from_tick:
+                return False
+            if self.to_tick is not None and tick > self.to_tick:
+                return False
+        if self.from_time is not None and timestamp < self.from_time:
+            return False
+        if self.to_time is not None and timestamp > self.to_time:
+            return False
+        return True
+
+    def select(self, ticks: Iterable[RawTick]) -> List[RawTick]:
+        """Return the chosen ticks, oldest first, with their trees pruned."""
+        selected = [
+            (history, tick)
+            for history, tick in ticks
+            if self.matches(history.tick_key(tick), tick["t"])
+        ]
+        selected.sort(key=lambda raw_tick: raw_tick[1]["t"])
+        if self.last is not None:
+            selected = selected[len(selected) - self.last :]
+
+        if not self.prunes:
+            return selected
+
+        # Each history needs a key for the "other" nodes, so give it a copy
+        # of its key table rather than change one which may be shared
+        pruned_histories: Dict[int, Tuple[RawProfilingHistory, int]] = {}
+        pruned = []
+        for history, tick in selected:
+            if id(history) not in pruned_histories:
+                keys = dict(history.keys)
+                other_id = max(keys, default=-1) + 1
+                keys[other_id] = OTHER_KEY
+                pruned_histories[id(history)] = (
+                    RawProfilingHistory(keys, [], history.shard),
+                    other_id,
+                )
+
+            pruned_history, other_id = pruned_histories[id(history)]
+            pruned_tick = dict(tick, d=self.prune(tick["d"], other_id))
+            pruned_history.ticks.append(pruned_tick)
+            pruned.append((pruned_history, pruned_tick))
+        return pruned
+
+    def prune(self, node: list, other_id: int) -> list:
+        """Return a compressed node with its tree cut to depth and folded.
+
+        The "other" node of each parent starts at the earliest folded call
+        and has the summed cpu and intents of all of them. It's placed among
+        its siblings by that start, so they stay in start order.
+        """
+        check_node(node)
+        root = node[:4] + [[]]
+        pending: List[Tuple[list, list, int]] = [(node, root, 0)]
+        while pending:
+            comp, pruned, depth = pending.pop()
+            if self.max_depth is not None and depth >= self.max_depth:
+                continue
+
+            other: Optional[list] = None
+            for child in comp[4]:
+                check_node(child)
+                if self.min_cpu is not None and child[2] < self.min_cpu:
+                    if other is None:
+                        other = [other_id, child[1], child[2], child[3], []]
+                    else:
+                        other[1] = min(other[1], child[1])
+                        other[2] += child[2]
+                        other[3] += child[3]
+                    continue
+
+                pruned_child = child[:4] + [[]]
+                pruned[4].append(pruned_child)
+                pending.append((child, pruned_child, depth + 1))
+
+            if other is not None:
+                siblings = pruned[4]
+                i = len(siblings)
+                while i > 0 and siblings[i - 1][1] > other[1]:
+                    i -= 1
+                siblings.insert(i, other)
+        return root
+
+
+def check_node(node: Any):
+    if not isinstance(node, list) or len(node) != 5:
+        raise ValueError("Invalid node in banan history: {}".format(node))
@@ -0,0 +1,60 @@
+"""Incrementally ingest the profiling history scraped from a screeps server."""
+
+import logging
+from typing import Dict, List
+
+from src.archive import TickArchive
+from src.fetch_history import RawProfilingHistory
+
+logger = logging.getLogger(__name__)
+
+
+class IngestResult:
+    """The outcome of ingesting a history."""
+
+    def __init__(self, new_ticks: List[Dict], skipped: int):
+        self.new_ticks = new_ticks
+        """The raw ticks which weren't in the archive before."""
+
+        self.skipped = skipped
+        """How many ticks were skipped as already ingested."""
+
+
+def ingest_history(
+    archive: TickArchive, server: str, shard: str, history: RawProfilingHistory
+) -> IngestResult:
+    """Add the ticks of a history which haven't been seen before to the archive.
+
+    Ticks are identified by the key of their root node, which is looked up
+    from the raw payload, so ticks already in the archive are skipped before
+    any of their tree is decompressed. The new ticks are stored in their
+    compressed form.
+
+    The same history can be ingested by the scraper and API requests at
+    once, so the ticks reported as new are the ones this call actually
+    inserted, and each tick is only ever reported by one of them.
+    """
+    tick_keys = [history.tick_key(tick) for tick in history.ticks]
+    known = archive.stored_tick_keys(server, shard, tick_keys)
+
+    candidates = []
+    seen = set(known)
+    for tick, tick_key in zip(history.ticks, tick_keys):
+        if tick_key in seen:
+            continue
+        seen.add(tick_key)
+        candidates.append(tick)
+
+    # Store oldest first, in case of an error part way through
+    candidates.sort(key=lambda tick: tick["t"])
+    new_ticks = archive.add_raw_ticks(server, shard, history, candidates)
+
+    skipped = len(history.ticks) - len(new_ticks)
+    logger.info(
+        "Ingested %d new ticks from %s/%s, skipped %d",
+        len(new_ticks),
+        server,
+        shard,
+        skipped,
+    )
+    return IngestResult(new_ticks, skipped)
@@ -0,0 +1,179 @@
+"""Stream newly ingested ticks to clients as server-sent events.
+
+See https://html.spec.whatwg.org/multipage/server-sent-events.html
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from src.archive import TickArchive, parse_tick_number
+from src.fetch_history import ProfilingNode
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPE = "text/event-stream"
+
+KEEPALIVE = ": keepalive\n\n"
+"""A comment, which keeps idle connections from being closed by proxies."""
+
+
+class TickEvent(NamedTuple):
+    tick: int
+    data: str
+    """The tick as JSON."""
+
+
+def format_event(event: TickEvent) -> str:
+    # The tick's JSON is on one line, so it's a single data field
+    return f"id: {event.tick}\nevent: tick\ndata: {event.data}\n\n"
+
+
+def to_events(ticks: List[ProfilingNode]) -> List[TickEvent]:
+    events = []
+    for tick in ticks:
+        number = parse_tick_number(tick.key)
+        if number is not None:
+            events.append(TickEvent(number, tick.model_dump_json()))
+    events.sort(key=lambda event: event.tick)
+    return events
+
+
+class Subscription:
+    """A client following the ticks of one shard."""
+
+    def __init__(self, server: str, shard: str, max_queued: int):
+        self.server = server
+        self.shard = shard
+        self.queue: "asyncio.Queue[TickEvent]" = asyncio.Queue(max_queued)
+
+        self.overflowed = False
+        """Whether ticks were dropped because the client fell behind."""
+
+
+class LiveTail:
+    """Fan the ticks of each shard out to subscribers as they're ingested.
+
+    Each subscriber has a queue of at most `max_queued` ticks. Once a slow
+    client's queue is full it isn't sent any more, and when it has caught
+    up on what was queued it reads the ticks it missed from the archive,
+    `backlog_chunk` at a time. So a slow client holds a bounded amount of
+    memory, and never misses a tick.
+    """
+
+    def __init__(
+        self,
+        archive: TickArchive,
+        max_queued: int = 100,
+        keepalive: float = 15.0,
+        backlog_chunk: int = 100,
+    ):
+        self.archive = archive
+        self.max_queued = max_queued
+        self.keepalive = keepalive
+        self.backlog_chunk = backlog_chunk
+
+        self.subscriptions: Dict[Tuple[str, str], Set[Subscription]] = {}
+
+        self.resyncs = 0
+        """How many times a subscriber fell behind and read from the archive."""
+
+    def __len__(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+    def subscribe(self, server: str, shard: str) -> Subscription:
+        subscription = Subscription(server, shard, self.max_queued)
+        self.subscriptions.setdefault((server, shard), set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        key = (subscription.server, subscription.shard)
+        subscriptions = self.subscriptions.get(key)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[key]
+
+    def publish(self, server: str, shard: str, ticks: List[ProfilingNode]):
+        """Send newly ingested ticks to the shard's subscribers.
+
+        The ticks must already be archived, for subscribers which have
+        fallen behind to read.
+        """
+        subscriptions = self.subscriptions.get((server, shard))
+        if not subscriptions or not ticks:
+            return
+
+        # Serialized once, and shared by every subscriber
+        events = to_events(ticks)
+        for subscription in subscriptions:
+            if subscription.overflowed:
+                continue
+            for event in events:
+                try:
+                    subscription.queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    subscription.overflowed = True
+                    break
+
+    async def stream(
+        self, server: str, shard: str, after: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """Yield server-sent events of the shard's ticks as they're ingested.
+
+        If `after` is given, the archived ticks after it are sent first.
+        """
+        subscription = self.subscribe(server, shard)
+        try:
+            last = after
+            if last is not None:
+                async for event in self._read_archive(server, shard, last):
+                    last = event.tick
+                    yield format_event(event)
+
+            while True:
+                if subscription.overflowed and subscription.queue.empty():
+                    # Everything queued before it filled up has been sent,
+                    # so the ticks after the last one were dropped
+                    subscription.overflowed = False
+                    self.resyncs += 1
+                    logger.info("Live tail of %s/%s fell behind", server, shard)
+                    if last is not None:
+                        async for event in self._read_archive(server, shard, last):
+                            last = event.tick
+                            yield format_event(event)
+                    continue
+
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.queue.get(), self.keepalive
+                    )
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE
+                    continue
+
+                # It may have been read from the archive already
+                if last is not None and event.tick <= last:
+                    continue
+                last = event.tick
+                yield format_event(event)
+        finally:
+            self.unsubscribe(subscription)
+
+    async def _read_archive(
+        self, server: str, shard: str, after: int
+    ) -> AsyncIterator[TickEvent]:
+        """Yield the archived ticks after a tick, oldest first."""
+        while True:
+            events = await asyncio.to_thread(self._read_chunk, server, shard, after)
+            for event in events:
+                after = event.tick
+                yield event
+            if not events or len(events) < self.backlog_chunk:
+                return
+
+    def _read_chunk(self, server: str, shard: str, after: int) -> List[TickEvent]:
+        ticks = self.archive.get_ticks(
+            server, shard, from_tick=after + 1, limit=self.backlog_chunk
+        )
+        return to_events(ticks)
@@ -0,0 +1,330 @@
+"""Metrics of the scrape and export pipeline, in the Prometheus text format.
+
+The metrics are kept in memory with a lock each, so recording one is a
+dict lookup and a few additions, and cheap enough to leave on. Stages are
+timed with `STAGE_SECONDS.time(stage=..., server=...)`. The app serves
+`REGISTRY.render()` at `/metrics`.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import abc
+import math
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+"""Histogram buckets in seconds, from a tiny tick to a slow Screeps API."""
+
+NODE_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = [
+        f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)
+    ]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric(abc.ABC):
+    """A named metric, with one value per combination of label values."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}"
+            )
+        try:
+            return tuple(str(labels[name]) for name in self.labelnames)
+        except KeyError as e:
+            raise ValueError(f"{self.name} has no label {e.args[0]}")
+
+    @abc.abstractmethod
+    def samples(self) -> List[Tuple[str, LabelValues, Tuple[str, ...], float]]:
+        """Return each sample as a suffix, label values, extra labels and value."""
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, values, extra, value in self.samples():
+            # Only histogram buckets have an extra label, which is `le`
+            names = self.labelnames + (("le",) if extra else ())
+            labels = format_labels(names, values + extra)
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A value which only goes up, such as a number of ticks."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        if amount < 0:
+            raise ValueError("Counters can only go up")
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self.label_values(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [("", key, (), value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """A value which can go up or down, such as the lag of the scheduler."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels: str) -> Optional[float]:
+        return self.values.get(self.label_values(labels))
+
+    def samples(self):
+        with self.lock:
+            return [("", key, (), value) for key, value in sorted(self.values.items())]
+
+
+class CallbackMetric(Metric):
+    """A metric without labels, read from elsewhere when it's rendered.
+
+    This exposes counts which are already kept by other parts of the app,
+    like the hits of the history cache.
+    """
+
+    def __init__(
+        self, name: str, documentation: str, type: str, read: Callable[[], float]
+    ):
+        super().__init__(name, documentation)
+        self.type = type
+        self.read = read
+
+    def samples(self):
+        return [("", (), (), self.read())]
+
+
+class Histogram(Metric):
+    """Counts of observed values in cumulative buckets, such as latencies."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        if list(buckets) != sorted(buckets):
+            raise ValueError("Histogram buckets must be in order")
+        self.buckets = tuple(buckets)
+        # Per label values, the count in each bucket, then the +Inf bucket,
+        # then the sum of the values
+        self.values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self.label_values(labels)
+        # Buckets are upper bounds, so a value on a bound counts in it
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels: str) -> "Timer":
+        """Time a block of code in seconds, and observe it when it exits."""
+        return Timer(self, labels)
+
+    def count(self, **labels: str) -> int:
+        counts = self.values.get(self.label_values(labels))
+        return int(sum(counts[:-1])) if counts else 0
+
+    def samples(self):
+        samples = []
+        bounds = [format_value(bound) for bound in self.buckets] + ["+Inf"]
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    samples.append(("_bucket", key, (bound,), cumulative))
+                samples.append(("_sum", key, (), counts[-1]))
+                samples.append(("_count", key, (), cumulative))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(
+        self, name: str, documentation: str, type: str, read: Callable[[], float]
+    ) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, type, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "banan_stage_seconds",
+    "Time spent in each stage of scraping, ingesting and exporting a history.",
+    ["stage", "server"],
+)
+
+FETCHED_BYTES = REGISTRY.counter(
+    "banan_fetched_bytes_total",
+    "Bytes of Memory responses fetched from each server.",
+    ["server"],
+)
+
+SIGN_INS = REGISTRY.counter(
+    "banan_screeps_sign_ins_total",
+    "Sign ins to each server, which happen when its token expires or is rejected.",
+    ["server"],
+)
+
+TICKS = REGISTRY.counter(
+    "banan_ticks_total",
+    "Ticks seen in scraped histories, by whether they were ingested, skipped"
+    " as already archived, or failed.",
+    ["server", "result"],
+)
+
+TICK_NODES = REGISTRY.histogram(
+    "banan_tick_nodes",
+    "Number of nodes in the call tree of each ingested tick.",
+    ["server"],
+    buckets=NODE_BUCKETS,
+)
+
+LOST_TICKS = REGISTRY.counter(
+    "banan_lost_ticks_total",
+    "Ticks missing between scrapes, overwritten in the bot's history before"
+    " they were fetched.",
+    ["server", "shard"],
+)
+
+TICK_SECONDS = REGISTRY.gauge(
+    "banan_tick_seconds",
+    "Seconds per game tick, measured from the timestamps of scraped ticks.",
+    ["server", "shard"],
+)
+
+SCRAPE_DELAY = REGISTRY.gauge(
+    "banan_scrape_delay_seconds",
+    "Seconds from each server's last scrape until its next one is due.",
+    ["server"],
+)
+
+SCHEDULER_LAG = REGISTRY.gauge(
+    "banan_scheduler_lag_seconds",
+    "How late the last scrape cycle started, compared to the interval.",
+)
+
+SCRAPE_CYCLE_SECONDS = REGISTRY.histogram(
+    "banan_scrape_cycle_seconds",
+    "Time taken to scrape every server.",
+)
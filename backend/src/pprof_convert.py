@@ -1,10 +1,11 @@
-from typing import Dict, Optional, List
+import logging
+from typing import Dict, Iterator, List, Tuple
 
 import pydantic
 
 from src.config import DEBUG_ENABLED
 from src.fetch_history import ProfilingNode
-from src.protogen.orig import pprof_pb2
+from src.pprof_encode import encode_pprof
 from src.protogen.perftools.profiles import (
     Function,
     Line,
@@ -15,6 +16,8 @@ from src.protogen.perftools.profiles import (
     ValueType,
 )
 
+logger = logging.getLogger(__name__)
+
 
 def ms_to_ns(ms: float) -> int:
     return int(ms * 1e6)
@@ -51,7 +54,7 @@ class TimelineConverter:
 
     def convert(self, root: ProfilingNode) -> List[TimelineStackTrace]:
         """Convert from tree structure to a list of stack traces."""
-        print("Converting to timeline format...")
+        logger.debug("Converting to timeline format...")
 
         traces = []
 
@@ -73,9 +76,75 @@ class TimelineConverter:
 
         return traces
 
+    def iter_traces(self, root: ProfilingNode) -> Iterator[TimelineStackTrace]:
+        """Lazily yield the same stack traces as `convert`.
+
+        Rather than searching from the root for every trace, the tree is
+        swept once in time order. The path to the node running at the
+        previous frame is kept, and is only re-searched from the first
+        level where it no longer holds.
+        """
+        path: List[ProfilingNode] = []
+        # Index of each node of the path within its parent
+        path_indices: List[int] = []
+
+        frame_time = 0
+        end = root.get_end_time()
+        while frame_time < end:
+            if not root.contains_time(frame_time):
+                raise ValueError(f"No frame at {frame_time}")
+
+            # Keep the part of the path which is still the first node
+            # running at this time on each level. When the children are
+            # ordered, a node that was the first match earlier and is still
+            # running must still be the first match.
+            depth = 1
+            while depth < len(path):
+                parent = path[depth - 1]
+                if not path[depth].contains_time(frame_time):
+                    break
+                if (
+                    not parent.has_ordered_children()
+                    and parent.find_child_index(frame_time) != path_indices[depth]
+                ):
+                    break
+                depth += 1
+            del path[depth:]
+            del path_indices[depth:]
+            if not path:
+                path.append(root)
+                path_indices.append(0)
+
+            # Then descend from there to the deepest running node
+            while True:
+                i = path[-1].find_child_index(frame_time)
+                if i is None:
+                    break
+                path.append(path[-1].children[i])
+                path_indices.append(i)
+
+            frame_time += self.PERIOD_BETWEEN_TRACES_MS
+            yield TimelineStackTrace(
+                start_ms=frame_time,
+                location_stack=[node.key for node in reversed(path)],
+            )
+
 
 class PprofConverter:
-    def __init__(self):
+    """Convert from banan call tree to a pprof profile.
+
+    By default the conversion is exact: the call tree is walked once and
+    each unique call stack becomes a single sample weighted by the total
+    self cost spent in it. Pass `exact=False` to instead sample the tree
+    with a fixed period using the TimelineConverter.
+    """
+
+    def __init__(self, exact: bool = True):
+        self.exact = exact
+        self._reset()
+
+    def _reset(self):
+        """Start a new profile, with empty tables."""
         self.string_map: Dict[str, int] = {}
         self.location_id_map: Dict[str, int] = {}
         self.location_map: Dict[int, Location] = {}
@@ -84,33 +153,27 @@ class PprofConverter:
         self.next_location_id = 1
         self.profile = Profile()
 
-    def convert_to_pprof_bytes(self, node: ProfilingNode) -> bytes:
-        """Convert a from banan format to a pprof format bytestring."""
-        profile = self.convert_to_pprof_format(node)
-        serialized_profile = bytes(profile)
+    def convert_to_pprof_bytes(
+        self, node: ProfilingNode, compress: bool = False
+    ) -> bytes:
+        """Convert a from banan format to a pprof format bytestring.
 
-        # Patch the string table:
-        # python-betterproto seems to have a bug where it won't properly
-        # serialize the empty string at the start of the string table
-        # To fix this, load the dump with the original Google python
-        # code and just patch the string table.
-        patched_profile = pprof_pb2.Profile()
-        patched_profile.ParseFromString(serialized_profile)
-        patched_profile.string_table.insert(0, "")
+        Pass `compress=True` to gzip it, as pprof files usually are.
+        """
+        return self.convert_ticks_to_pprof_bytes([node], compress)
 
-        serialized_patched = patched_profile.SerializeToString()
+    def convert_ticks_to_pprof_bytes(
+        self, nodes: List[ProfilingNode], compress: bool = False
+    ) -> bytes:
+        """Convert several ticks to a single pprof format bytestring."""
+        profile = self.convert_ticks_to_pprof_format(nodes)
+        serialized_profile = encode_pprof(profile, compress)
 
         if DEBUG_ENABLED:
             with open("debug/profile.prof", "wb") as fh:
-                fh.write(serialized_patched)
-
-            profile2 = Profile()
-            profile2.parse(serialized_patched)
-
-            with open("debug/profile.prof.json", "w") as fh:
-                fh.write(profile2.to_json(indent=2))
+                fh.write(serialized_profile)
 
-        return serialized_patched
+        return serialized_profile
 
     def convert_to_pprof_format(self, node: ProfilingNode) -> Profile:
         """Convert a from banan format to a pprof format Profile object.
@@ -118,16 +181,32 @@ class PprofConverter:
         This object comes from generated Python code created by
         python-betterproto from the pprof protobuf.
         """
-        cpu_in_ns = ms_to_ns(node.cpu)
-        start_in_ns = ms_to_ns(node.start)
+        return self.convert_ticks_to_pprof_format([node])
 
-        # TODO: seems like a bug in python-betterproto - this doesn't get serialized
+    def convert_ticks_to_pprof_format(self, nodes: List[ProfilingNode]) -> Profile:
+        """Convert several ticks to a single pprof format Profile object.
+
+        The ticks share the string, function and location tables, so each
+        function only appears once however many ticks it ran in. Each call
+        returns a new profile, so a converter can be reused.
+        """
+        if not nodes:
+            raise ValueError("Expecting at least one tick to convert")
+        self._reset()
+
+        cpu_in_ns = sum(ms_to_ns(node.cpu) for node in nodes)
+
+        # python-betterproto won't serialize this, so see src.pprof_encode
         self.profile.string_table.append("")  # empty string must be first entry
 
-        if node.timestamp:
-            self.profile.time_nanos = ms_to_ns(node.timestamp)
+        timestamps = [node.timestamp for node in nodes if node.timestamp]
+        if timestamps:
+            self.profile.time_nanos = ms_to_ns(min(timestamps))
         self.profile.duration_nanos = cpu_in_ns
-        self.profile.period = ms_to_ns(TimelineConverter.PERIOD_BETWEEN_TRACES_MS)
+        if self.exact:
+            self.profile.period = 1
+        else:
+            self.profile.period = ms_to_ns(TimelineConverter.PERIOD_BETWEEN_TRACES_MS)
 
         unit_name = "nanoseconds"
         self.profile.period_type = ValueType(
@@ -142,19 +221,36 @@ class PprofConverter:
             )
         )
 
+        # Exact samples count the calls of each stack, rather than how
+        # many times it was seen by sampling the timeline
         self.profile.sample_type.append(
             ValueType(
-                type=self._get_string_map_id("samples"),
+                type=self._get_string_map_id("calls" if self.exact else "samples"),
                 unit=self._get_string_map_id("count"),
             )
         )
 
-        self.profile.default_sample_type = self._get_string_map_id("samples")
-
         self.profile.mapping = []
 
-        stack_frames = TimelineConverter().convert(node)
-        print("Converting from timeline to pprof format...")
+        if self.exact:
+            # Samples are counts of calls, so the cost is the interesting value
+            self.profile.default_sample_type = self._get_string_map_id("cpu")
+            for node in nodes:
+                self._add_exact_samples(node)
+        else:
+            self.profile.default_sample_type = self._get_string_map_id("samples")
+            for node in nodes:
+                self._add_timeline_samples(node)
+
+        self._check_validity()
+
+        logger.debug("Done")
+        return self.profile
+
+    def _add_timeline_samples(self, node: ProfilingNode):
+        """Add one sample per fixed period stack trace of the timeline."""
+        stack_frames = TimelineConverter().iter_traces(node)
+        logger.debug("Converting from timeline to pprof format...")
 
         for frame in stack_frames:
             location_id_stack = []
@@ -169,11 +265,6 @@ class PprofConverter:
             sample = Sample(location_id=location_id_stack, value=[cpu_val, 1])
             self.profile.sample.append(sample)
 
-        self._check_validity()
-
-        print("Done")
-        return self.profile
-
     def _check_validity(self):
         """Check for validity."""
         for key, lid in self.location_id_map.items():
@@ -189,34 +280,47 @@ class PprofConverter:
             assert self.profile.function[lid - 1], key
 
         for key, sid in self.string_map.items():
-            assert (
-                self.profile.string_table[sid] == key
-            ), f"{key} {self.profile.string_table[sid]}"
+            assert self.profile.string_table[sid] == key, (
+                f"{key} {self.profile.string_table[sid]}"
+            )
 
         return self.profile
 
-    def _recurse_add_node(self, node: ProfilingNode, sample: Optional[Sample] = None):
-        lid = self._get_location_id(node.key)
-        loc = self._get_location(node.key)
-        self._get_function(node.key)
-
-        # If no sample exists, bootstrap the first sample
-        if not sample:
-            sample = Sample(location_id=[loc.id], value=[ms_to_ns(node.self_cost()), 1])
-            self.profile.sample.append(sample)
-        else:
-            sample.location_id.insert(0, lid)
+    def _add_exact_samples(self, root: ProfilingNode):
+        """Add one sample per unique call stack, weighted by exact self cost.
 
-        for child in node.children:
-            # For each child, prepend the stack and the cost of the child
-            child_sample = Sample(
-                location_id=[] + sample.location_id,
-                value=[ms_to_ns(child.self_cost()), 1],
+        The tree is walked once without recursion. Every node contributes
+        its self cost and a call count to the sample for its call stack, so
+        repeated calls along the same path are merged together.
+        """
+        # Location ID stacks are leaf first, as pprof expects
+        stack_costs: Dict[Tuple[int, ...], List[float]] = {}
+
+        pending: List[Tuple[ProfilingNode, Tuple[int, ...]]] = [(root, ())]
+        while pending:
+            node, parent_stack = pending.pop()
+            self._get_location(node.key)
+            self._get_function(node.key)
+            location_stack = (self._get_location_id(node.key),) + parent_stack
+
+            # Rounding in the bot can make the children sum to slightly
+            # more than the parent, so never report a negative cost
+            self_cost = max(node.self_cost(), 0.0)
+            totals = stack_costs.get(location_stack)
+            if totals is None:
+                stack_costs[location_stack] = [self_cost, 1]
+            else:
+                totals[0] += self_cost
+                totals[1] += 1
+
+            for child in reversed(node.children):
+                pending.append((child, location_stack))
+
+        for location_stack, (cost, calls) in stack_costs.items():
+            sample = Sample(
+                location_id=list(location_stack), value=[ms_to_ns(cost), int(calls)]
             )
             self.profile.sample.append(sample)
-            self._recurse_add_node(child, child_sample)
-
-        return self.profile
 
     def _get_location(self, key: str) -> Location:
         lid = self._get_location_id(key)
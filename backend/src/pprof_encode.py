@@ -0,0 +1,180 @@
+"""Encode pprof profiles straight to the protobuf wire format.
+
+python-betterproto won't serialize the empty string which pprof requires
+at the start of the string table, so rather than round tripping through
+the Google protobuf code to patch it, profiles are encoded here in a
+single pass. Only the fields of `profile.proto` are supported.
+
+See https://github.com/google/pprof/blob/main/proto/profile.proto
+"""
+
+import zlib
+from typing import Iterable, Iterator
+
+from src.protogen.perftools.profiles import (
+    Function,
+    Line,
+    Location,
+    Mapping,
+    Profile,
+    Sample,
+    ValueType,
+)
+
+WIRE_VARINT = 0
+WIRE_LEN = 2
+
+UINT64_MASK = (1 << 64) - 1
+
+CHUNK_SIZE = 64 * 1024
+
+
+def write_varint(buf: bytearray, value: int):
+    # Negative int64 values are encoded as 10 byte two's complement
+    value &= UINT64_MASK
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def write_int_field(buf: bytearray, field: int, value: int):
+    """Write a scalar field, which like proto3 is left out if it is zero."""
+    if value:
+        buf.append(field << 3 | WIRE_VARINT)
+        write_varint(buf, int(value))
+
+
+def write_bytes_field(buf: bytearray, field: int, value: bytes):
+    write_varint(buf, field << 3 | WIRE_LEN)
+    write_varint(buf, len(value))
+    buf += value
+
+
+def write_packed_field(buf: bytearray, field: int, values: Iterable[int]):
+    packed = bytearray()
+    for value in values:
+        write_varint(packed, value)
+    if packed:
+        write_bytes_field(buf, field, packed)
+
+
+def encode_value_type(value_type: ValueType) -> bytearray:
+    buf = bytearray()
+    write_int_field(buf, 1, value_type.type)
+    write_int_field(buf, 2, value_type.unit)
+    return buf
+
+
+def encode_sample(sample: Sample) -> bytearray:
+    buf = bytearray()
+    write_packed_field(buf, 1, sample.location_id)
+    write_packed_field(buf, 2, sample.value)
+    for label in sample.label:
+        label_buf = bytearray()
+        write_int_field(label_buf, 1, label.key)
+        write_int_field(label_buf, 2, label.str)
+        write_int_field(label_buf, 3, label.num)
+        write_int_field(label_buf, 4, label.num_unit)
+        write_bytes_field(buf, 3, label_buf)
+    return buf
+
+
+def encode_mapping(mapping: Mapping) -> bytearray:
+    buf = bytearray()
+    write_int_field(buf, 1, mapping.id)
+    write_int_field(buf, 2, mapping.memory_start)
+    write_int_field(buf, 3, mapping.memory_limit)
+    write_int_field(buf, 4, mapping.file_offset)
+    write_int_field(buf, 5, mapping.filename)
+    write_int_field(buf, 6, mapping.build_id)
+    write_int_field(buf, 7, mapping.has_functions)
+    write_int_field(buf, 8, mapping.has_filenames)
+    write_int_field(buf, 9, mapping.has_line_numbers)
+    write_int_field(buf, 10, mapping.has_inline_frames)
+    return buf
+
+
+def encode_line(line: Line) -> bytearray:
+    buf = bytearray()
+    write_int_field(buf, 1, line.function_id)
+    write_int_field(buf, 2, line.line)
+    write_int_field(buf, 3, line.column)
+    return buf
+
+
+def encode_location(location: Location) -> bytearray:
+    buf = bytearray()
+    write_int_field(buf, 1, location.id)
+    write_int_field(buf, 2, location.mapping_id)
+    write_int_field(buf, 3, location.address)
+    for line in location.line:
+        write_bytes_field(buf, 4, encode_line(line))
+    write_int_field(buf, 5, location.is_folded)
+    return buf
+
+
+def encode_function(function: Function) -> bytearray:
+    buf = bytearray()
+    write_int_field(buf, 1, function.id)
+    write_int_field(buf, 2, function.name)
+    write_int_field(buf, 3, function.system_name)
+    write_int_field(buf, 4, function.filename)
+    write_int_field(buf, 5, function.start_line)
+    return buf
+
+
+def iter_profile_chunks(
+    profile: Profile, chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Encode a profile, yielding the bytes in chunks of about `chunk_size`."""
+    buf = bytearray()
+
+    def repeated(field: int, messages, encode) -> Iterator[bytes]:
+        nonlocal buf
+        for message in messages:
+            write_bytes_field(buf, field, encode(message))
+            if len(buf) >= chunk_size:
+                yield bytes(buf)
+                buf = bytearray()
+
+    yield from repeated(1, profile.sample_type, encode_value_type)
+    yield from repeated(2, profile.sample, encode_sample)
+    yield from repeated(3, profile.mapping, encode_mapping)
+    yield from repeated(4, profile.location, encode_location)
+    yield from repeated(5, profile.function, encode_function)
+    # Every string is written, including the empty string at the start
+    yield from repeated(6, profile.string_table, lambda s: s.encode("utf-8"))
+
+    write_int_field(buf, 7, profile.drop_frames)
+    write_int_field(buf, 8, profile.keep_frames)
+    write_int_field(buf, 9, profile.time_nanos)
+    write_int_field(buf, 10, profile.duration_nanos)
+    if profile.period_type is not None:
+        write_bytes_field(buf, 11, encode_value_type(profile.period_type))
+    write_int_field(buf, 12, profile.period)
+    write_packed_field(buf, 13, profile.comment)
+    write_int_field(buf, 14, profile.default_sample_type)
+    yield bytes(buf)
+
+
+def iter_pprof_bytes(
+    profile: Profile, compress: bool = False, chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Encode a profile in chunks, optionally gzipped as pprof files usually are."""
+    if not compress:
+        yield from iter_profile_chunks(profile, chunk_size)
+        return
+
+    # wbits of 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in iter_profile_chunks(profile, chunk_size):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def encode_pprof(profile: Profile, compress: bool = False) -> bytes:
+    """Encode a profile to the pprof format bytestring."""
+    return b"".join(iter_pprof_bytes(profile, compress))
@@ -0,0 +1,258 @@
+"""Export ticks to Pyroscope in batches, retrying when it's unavailable."""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import httpx
+
+from src.archive import TickArchive, TickSummary
+from src.config import DEBUG_DIR, DEBUG_ENABLED
+from src.fetch_history import ProfilingNode
+from src.metrics import STAGE_SECONDS
+from src.pprof_convert import PprofConverter, ms_to_ns
+from src.tree_cache import TreeCache
+
+logger = logging.getLogger(__name__)
+
+
+class ExportBatch:
+    """A batch of ticks from one server, sent to Pyroscope as one profile.
+
+    Only the summaries of the ticks are kept, and their trees are loaded
+    when the batch is converted.
+    """
+
+    def __init__(self, server: str, shard: str, ticks: List[TickSummary]):
+        self.server = server
+        self.shard = shard
+        self.ticks = ticks
+        self.attempts = 0
+
+        self.sealed = False
+        """Whether the batch is being pushed, so no more ticks can be added."""
+
+    @property
+    def tick_keys(self) -> List[str]:
+        return [tick.key for tick in self.ticks]
+
+
+class PyroscopeExporter:
+    """Queue ticks and push them to Pyroscope in batches.
+
+    Each batch is converted to a single profile, so the ticks share one
+    symbol table, and is sent over a keep-alive connection. A failed push
+    is retried with exponential backoff, and if it still fails the batch
+    stays queued for the next flush. The queue holds at most `max_batches`
+    batches, after which the oldest are dropped.
+
+    Once pushed, ticks are marked in the archive so they're never sent twice.
+
+    Queued ticks don't hold on to their trees. When a batch is converted,
+    its trees are taken from `trees` if they're still cached there, and
+    otherwise read back from the archive.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        archive: TickArchive,
+        batch_size: int = 10,
+        max_batches: int = 100,
+        retries: int = 3,
+        backoff: float = 1.0,
+        http: Optional[httpx.AsyncClient] = None,
+        trees: Optional[TreeCache] = None,
+    ):
+        self.url = url
+        self.archive = archive
+        self.trees = trees
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.http = http or httpx.AsyncClient(timeout=10)
+
+        self.pending: Deque[ExportBatch] = deque()
+        self.queued: Set[Tuple[str, str, str]] = set()
+        """The server, shard and key of every queued tick."""
+        self.max_batches = max_batches
+        self.flush_lock = asyncio.Lock()
+
+        self.exported_ticks = 0
+        self.dropped_ticks = 0
+        self.failed_attempts = 0
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    def enqueue(
+        self,
+        server: str,
+        shard: str,
+        ticks: Iterable[Union[ProfilingNode, TickSummary]],
+    ):
+        """Queue archived ticks to be pushed on the next flush.
+
+        Ticks which are already queued are ignored.
+        """
+        for tick in ticks:
+            if not tick.timestamp:
+                logger.error("Expecting to find a timestamp on tick %s", tick.key)
+                continue
+            if (server, shard, tick.key) in self.queued:
+                continue
+            self.queued.add((server, shard, tick.key))
+            summary = TickSummary(tick.key, tick.timestamp, tick.cpu)
+
+            last = self.pending[-1] if self.pending else None
+            if (
+                last
+                and last.server == server
+                and last.shard == shard
+                and not last.sealed
+                and len(last.ticks) < self.batch_size
+            ):
+                last.ticks.append(summary)
+                continue
+
+            if len(self.pending) >= self.max_batches:
+                dropped = self.pending.popleft()
+                self._forget(dropped)
+                self.dropped_ticks += len(dropped.ticks)
+                logger.warning(
+                    "Export queue full, dropping %d ticks from %s",
+                    len(dropped.ticks),
+                    dropped.server,
+                )
+            self.pending.append(ExportBatch(server, shard, [summary]))
+
+    async def flush(self):
+        """Push every queued batch, stopping at the first which can't be sent."""
+        async with self.flush_lock:
+            while self.pending:
+                batch = self.pending[0]
+                if not await self._push_with_retries(batch):
+                    logger.warning(
+                        "Keeping %d batches queued until Pyroscope recovers",
+                        len(self.pending),
+                    )
+                    return
+
+                # The queue may have dropped it while we were pushing
+                if self.pending and self.pending[0] is batch:
+                    self.pending.popleft()
+                    self._forget(batch)
+
+    def _forget(self, batch: ExportBatch):
+        """Stop tracking the ticks of a batch which has left the queue."""
+        for tick_key in batch.tick_keys:
+            self.queued.discard((batch.server, batch.shard, tick_key))
+
+    async def _push_with_retries(self, batch: ExportBatch) -> bool:
+        """Push a batch, returning whether it is done with."""
+        batch.sealed = True
+        try:
+            pprof_bytes = await asyncio.to_thread(self.convert, batch)
+        except Exception:
+            logger.exception("Error converting batch from %s", batch.server)
+            self.dropped_ticks += len(batch.ticks)
+            return True
+
+        for attempt in range(self.retries):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+            batch.attempts += 1
+            try:
+                await self.push(batch, pprof_bytes)
+            except httpx.HTTPStatusError as e:
+                self.failed_attempts += 1
+                status = e.response.status_code
+                if 400 <= status < 500 and status != 429:
+                    # Retrying won't help if Pyroscope rejects the profile, so
+                    # record it as done with to avoid sending it again
+                    logger.error(
+                        "Pyroscope rejected batch from %s: %s", batch.server, e
+                    )
+                    await self._mark_pushed(batch)
+                    self.dropped_ticks += len(batch.ticks)
+                    return True
+                logger.warning("Error pushing batch from %s: %s", batch.server, e)
+            except httpx.HTTPError as e:
+                self.failed_attempts += 1
+                logger.warning("Error pushing batch from %s: %s", batch.server, e)
+            else:
+                await self._mark_pushed(batch)
+                self.exported_ticks += len(batch.ticks)
+                return True
+
+        return False
+
+    async def _mark_pushed(self, batch: ExportBatch):
+        await asyncio.to_thread(
+            self.archive.mark_pushed, batch.server, batch.shard, batch.tick_keys
+        )
+
+    def load_ticks(self, batch: ExportBatch) -> List[ProfilingNode]:
+        """Return the trees of a batch's ticks, from the cache or archive."""
+        trees: Dict[str, ProfilingNode] = {}
+        if self.trees is not None:
+            for tick_key in batch.tick_keys:
+                tree = self.trees.get(batch.server, batch.shard, tick_key)
+                if tree is not None:
+                    trees[tick_key] = tree
+
+        missing = [key for key in batch.tick_keys if key not in trees]
+        for tree in self.archive.get_ticks_by_key(batch.server, batch.shard, missing):
+            trees[tree.key] = tree
+        return [trees[key] for key in batch.tick_keys if key in trees]
+
+    def convert(self, batch: ExportBatch) -> bytes:
+        """Convert a batch to a pprof profile.
+
+        Each profile carries its own string, function and location tables,
+        so they're shared by the ticks of a batch but not across batches.
+        """
+        ticks = self.load_ticks(batch)
+        with STAGE_SECONDS.time(stage="convert", server=batch.server):
+            pprof_bytes = PprofConverter().convert_ticks_to_pprof_bytes(ticks)
+
+        if DEBUG_ENABLED:
+            with open(f"{DEBUG_DIR}/{batch.server}.prof", "wb") as fh:
+                fh.write(pprof_bytes)
+
+        return pprof_bytes
+
+    async def push(self, batch: ExportBatch, pprof_bytes: bytes):
+        """Push a converted batch to Pyroscope.
+
+        See https://grafana.com/docs/pyroscope/latest/configure-server/about-server-api/
+        """
+        # Pyroscope takes labels in braces after the app name
+        app_name = f"screeps-{batch.server}{{shard={batch.shard}}}"
+        from_time = min(ms_to_ns(tick.timestamp) for tick in batch.ticks)
+        until_time = max(
+            ms_to_ns(tick.timestamp) + ms_to_ns(tick.cpu) for tick in batch.ticks
+        )
+
+        url_params = {
+            "name": app_name,
+            "format": "pprof",
+            "from": from_time,
+            "until": until_time,
+        }
+
+        with STAGE_SECONDS.time(stage="push", server=batch.server):
+            resp = await self.http.post(
+                self.url + "/ingest", params=url_params, content=pprof_bytes
+            )
+        resp.raise_for_status()
+
+        logger.info(
+            "Successfully sent %d ticks of %s to Pyroscope, from: %d, until: %d",
+            len(batch.ticks),
+            app_name,
+            from_time,
+            until_time,
+        )
@@ -0,0 +1,181 @@
+"""Decide when to scrape each server, from its tick rate and request budget."""
+
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.archive import parse_tick_number
+from src.config import ServerConfig
+from src.fetch_history import RawProfilingHistory
+from src.metrics import LOST_TICKS, SCRAPE_DELAY, TICK_SECONDS
+from src.screeps_client import RateLimit
+
+logger = logging.getLogger(__name__)
+
+
+class ShardTicks:
+    """How fast the bot ticks on one shard, and how much history it keeps."""
+
+    def __init__(self):
+        self.seconds_per_tick: Optional[float] = None
+        self.capacity = 0
+        """The size of the bot's ring buffer, in ticks."""
+
+        self.newest_tick: Optional[int] = None
+        self.newest_time = 0.0
+        """Unix time in seconds when the newest tick was recorded."""
+
+    def observe(self, history: RawProfilingHistory) -> int:
+        """Update from a fetched history, returning how many ticks were lost.
+
+        Ticks are lost if the oldest tick in the history is newer than the
+        one after the newest tick seen before.
+        """
+        timed = []
+        for tick in history.ticks:
+            number = parse_tick_number(history.tick_key(tick))
+            if number is not None:
+                timed.append((number, tick["t"] / 1000))
+        if not timed:
+            return 0
+        timed.sort()
+
+        (oldest, oldest_time), (newest, newest_time) = timed[0], timed[-1]
+        if newest > oldest:
+            self.seconds_per_tick = (newest_time - oldest_time) / (newest - oldest)
+        self.capacity = history.capacity
+
+        lost = 0
+        if self.newest_tick is not None and oldest > self.newest_tick + 1:
+            lost = oldest - self.newest_tick - 1
+        if self.newest_tick is None or newest >= self.newest_tick:
+            self.newest_tick = newest
+            self.newest_time = newest_time
+        return lost
+
+    def due_at(self, safety: float) -> Optional[float]:
+        """Return the unix time to fetch by, to read every tick before it's lost."""
+        if self.seconds_per_tick is None or not self.capacity:
+            return None
+        window = self.capacity * self.seconds_per_tick
+        return self.newest_time + window * (1 - safety)
+
+
+class ScrapeSchedule:
+    """When each server is next due to be scraped.
+
+    A server is scraped when most of the bot's ring buffer has been
+    written since the newest tick already fetched, which is worked out
+    from the tick rate measured from the tick timestamps. So servers
+    which tick fast are scraped often enough not to lose ticks, and slow
+    ones aren't fetched again while they have little new to show.
+
+    Scrapes are spaced out to stay within the server's
+    `max_requests_per_hour`, and the rate limits Screeps reports, even if
+    that means ticks are lost.
+    """
+
+    def __init__(
+        self,
+        servers: List[ServerConfig],
+        rate_limits: Callable[[str], List[RateLimit]],
+        default_interval: float,
+        min_interval: float,
+        max_interval: float,
+        safety: float,
+    ):
+        self.servers = {server_cfg.name: server_cfg for server_cfg in servers}
+        self.rate_limits = rate_limits
+        self.default_interval = default_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.safety = safety
+
+        self.shards: Dict[Tuple[str, str], ShardTicks] = {}
+        self.next_due: Dict[str, float] = {}
+        """Unix time when each server is next due to be scraped."""
+
+    def is_due(self, server_name: str, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        return now >= self.next_due.get(server_name, 0.0)
+
+    def observe(
+        self,
+        server_cfg: ServerConfig,
+        histories: Dict[str, RawProfilingHistory],
+        now: Optional[float] = None,
+    ):
+        """Learn from histories just fetched, and reschedule the server."""
+        for shard, history in histories.items():
+            ticks = self.shards.get((server_cfg.name, shard))
+            if ticks is None:
+                ticks = self.shards[(server_cfg.name, shard)] = ShardTicks()
+
+            lost = ticks.observe(history)
+            if lost:
+                logger.warning(
+                    "Lost %d ticks of %s/%s between scrapes",
+                    lost,
+                    server_cfg.name,
+                    shard,
+                )
+                LOST_TICKS.inc(lost, server=server_cfg.name, shard=shard)
+            if ticks.seconds_per_tick is not None:
+                TICK_SECONDS.set(
+                    ticks.seconds_per_tick, server=server_cfg.name, shard=shard
+                )
+        self.scraped(server_cfg.name, now)
+
+    def scraped(self, server_name: str, now: Optional[float] = None):
+        """Schedule the next scrape of a server, after it's fetched or failed."""
+        now = time.time() if now is None else now
+        delay = self.delay(self.servers[server_name], now)
+        self.next_due[server_name] = now + delay
+        SCRAPE_DELAY.set(delay, server=server_name)
+
+    def delay(self, server_cfg: ServerConfig, now: float) -> float:
+        """Return how long to wait before scraping a server again."""
+        due_times = [
+            ticks.due_at(self.safety)
+            for (server, _), ticks in self.shards.items()
+            if server == server_cfg.name
+        ]
+        due_times = [due_at for due_at in due_times if due_at is not None]
+        if due_times:
+            delay = min(due_times) - now
+        else:
+            delay = self.default_interval
+        delay = min(max(delay, self.min_interval), self.max_interval)
+
+        budget_delay = self.budget_delay(server_cfg, now)
+        if budget_delay > delay:
+            if due_times:
+                logger.warning(
+                    "Waiting %.0fs to scrape %s to stay within its request"
+                    " budget, which may lose ticks",
+                    budget_delay,
+                    server_cfg.name,
+                )
+            delay = budget_delay
+        return delay
+
+    def budget_delay(self, server_cfg: ServerConfig, now: float) -> float:
+        """Return the shortest wait between scrapes the request budget allows."""
+        # Every shard is fetched in each scrape, each in as many requests
+        # as the history has segments
+        requests = len(server_cfg.get_shards()) * max(
+            len(server_cfg.history_segments), 1
+        )
+
+        delay = 0.0
+        if server_cfg.max_requests_per_hour:
+            delay = 3600 * requests / server_cfg.max_requests_per_hour
+
+        for rate_limit in self.rate_limits(server_cfg.name):
+            until_reset = max(rate_limit.reset_at - now, 0.0)
+            if rate_limit.remaining < requests:
+                delay = max(delay, until_reset)
+            else:
+                # Spread what's left of the limit until it resets
+                delay = max(delay, until_reset * requests / rate_limit.remaining)
+        return delay
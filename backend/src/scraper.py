@@ -0,0 +1,127 @@
+"""Periodically scrape every screeps server concurrently."""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from src.config import ServerConfig
+from src.metrics import SCHEDULER_LAG, SCRAPE_CYCLE_SECONDS, STAGE_SECONDS
+from src.scrape_schedule import ScrapeSchedule
+
+logger = logging.getLogger(__name__)
+
+
+class Scraper:
+    """Run a scrape of every configured server, in parallel.
+
+    At most `max_workers` servers are scraped at once. A cycle only waits
+    `timeout` seconds for each server; a slower scrape is left to finish in
+    the background, and that server is skipped by later cycles until it has.
+    So two scrapes of the same server never run at the same time.
+
+    With a `schedule`, each cycle only scrapes the servers which are due,
+    and cycles should run every poll `interval`.
+    """
+
+    def __init__(
+        self,
+        servers: List[ServerConfig],
+        scrape_server: Callable[[ServerConfig], Awaitable[None]],
+        max_workers: int,
+        timeout: float,
+        interval: float,
+        schedule: Optional[ScrapeSchedule] = None,
+    ):
+        self.servers = servers
+        self.scrape_server = scrape_server
+        self.timeout = timeout
+        self.interval = interval
+        self.schedule = schedule
+
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.running: Dict[str, "asyncio.Future[None]"] = {}
+
+        self.last_cycle_start: Optional[float] = None
+        self.last_cycle_duration: Optional[float] = None
+
+    async def scrape_all(self):
+        start = time.monotonic()
+        if self.last_cycle_start is not None:
+            # Cycles should start an interval apart, unless the event loop
+            # was too busy to run the scheduler on time
+            lag = start - self.last_cycle_start - self.interval
+            SCHEDULER_LAG.set(max(lag, 0.0))
+        self.last_cycle_start = start
+
+        servers = self.servers
+        if self.schedule is not None:
+            servers = [
+                server_cfg
+                for server_cfg in servers
+                if server_cfg.name not in self.running
+                and self.schedule.is_due(server_cfg.name)
+            ]
+            if not servers:
+                return
+
+        await asyncio.gather(
+            *[self._scrape_with_timeout(server_cfg) for server_cfg in servers]
+        )
+        self.last_cycle_duration = time.monotonic() - start
+        SCRAPE_CYCLE_SECONDS.observe(self.last_cycle_duration)
+
+        if self.schedule is not None:
+            logger.info(
+                "Scraped %d servers in %.2fs", len(servers), self.last_cycle_duration
+            )
+            return
+
+        log = (
+            logger.warning if self.last_cycle_duration > self.interval else logger.info
+        )
+        log(
+            "Scrape cycle took %.2fs of the %.0fs interval",
+            self.last_cycle_duration,
+            self.interval,
+        )
+
+    async def _scrape_with_timeout(self, server_cfg: ServerConfig):
+        name = server_cfg.name
+        if name in self.running:
+            logger.warning("Previous scrape of %s is still running, skipping", name)
+            return
+
+        task = asyncio.ensure_future(self._scrape_limited(server_cfg))
+        self.running[name] = task
+        task.add_done_callback(lambda done: self._finish_scrape(name, done))
+
+        try:
+            # Don't cancel a slow scrape, it may be part way through pushing
+            await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Scrape of %s took longer than %.0fs, leaving it to finish",
+                name,
+                self.timeout,
+            )
+        except Exception:
+            # Logged when the scrape finishes
+            pass
+
+    async def _scrape_limited(self, server_cfg: ServerConfig):
+        async with self.semaphore:
+            start = time.monotonic()
+            with STAGE_SECONDS.time(stage="scrape", server=server_cfg.name):
+                await self.scrape_server(server_cfg)
+            logger.info(
+                "Scraped %s in %.2fs", server_cfg.name, time.monotonic() - start
+            )
+
+    def _finish_scrape(self, name: str, task: "asyncio.Future[None]"):
+        if self.running.get(name) is task:
+            del self.running[name]
+        if self.schedule is not None:
+            self.schedule.scraped(name)
+        if not task.cancelled() and task.exception():
+            logger.error("Error scraping %s", name, exc_info=task.exception())
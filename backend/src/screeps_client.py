@@ -0,0 +1,245 @@
+"""Asynchronous client for the parts of the Screeps API that banan uses."""
+
+import asyncio
+import base64
+import gzip
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from src.config import ServerConfig
+from src.corpus import ResponseCorpus
+from src.metrics import FETCHED_BYTES, SIGN_INS
+
+
+def api_prefix(server_cfg: ServerConfig) -> str:
+    scheme = "https" if server_cfg.secure else "http"
+    return f"{scheme}://{server_cfg.host}/api/"
+
+
+def decode_memory_data(resp: Optional[Dict[str, Any]]) -> Any:
+    """Return the value from a Memory API response.
+
+    Screeps sends the value as gzipped JSON in base64, prefixed by `gz:`.
+    This is CPU bound for large values so should be run off the event loop.
+    """
+    if not resp or not resp.get("ok") or not resp.get("data"):
+        raise ValueError("Failed to fetch history: {}".format(resp))
+
+    data = resp["data"]
+    if isinstance(data, str) and data.startswith("gz:"):
+        data = json.loads(gzip.decompress(base64.b64decode(data[3:])))
+    return data
+
+
+class RateLimit:
+    """The request budget a server reported for one endpoint.
+
+    Screeps limits how often each user can call each endpoint, and says
+    how much of the limit is left in the `X-RateLimit-*` headers.
+    """
+
+    def __init__(self, limit: int, remaining: int, reset_at: float):
+        self.limit = limit
+        self.remaining = remaining
+
+        self.reset_at = reset_at
+        """Unix time in seconds when the full limit is available again."""
+
+    @classmethod
+    def from_headers(cls, headers: httpx.Headers) -> Optional["RateLimit"]:
+        try:
+            return cls(
+                int(headers["X-RateLimit-Limit"]),
+                int(headers["X-RateLimit-Remaining"]),
+                float(headers["X-RateLimit-Reset"]),
+            )
+        except (KeyError, ValueError):
+            # Private servers usually have no limits
+            return None
+
+
+class ServerSession:
+    """The auth token of one server, reused until it expires or is rejected."""
+
+    def __init__(self):
+        self.token: Optional[str] = None
+        self.expires_at = 0.0
+        # So concurrent requests wait for one sign in, rather than each
+        # signing in
+        self.lock = asyncio.Lock()
+
+    def valid_token(self) -> Optional[str]:
+        if self.token and time.monotonic() < self.expires_at:
+            return self.token
+        return None
+
+    def set_token(self, token: str, ttl: float):
+        self.token = token
+        self.expires_at = time.monotonic() + ttl
+
+
+class ScreepsClient:
+    """Client for the Screeps HTTP API, sharing one pool of connections.
+
+    A single instance should be shared by the whole app, so connections
+    to each server are kept alive between requests, and each server which
+    signs in with a password has one session. Its token is reused until
+    `token_ttl` seconds pass or the server rejects it. Screeps sends a
+    fresh token with responses, which replaces the old one.
+
+    If given a `corpus`, every Memory response is captured to it, to be
+    replayed offline later.
+    """
+
+    def __init__(
+        self,
+        http: Optional[httpx.AsyncClient] = None,
+        timeout: float = 30,
+        corpus: Optional[ResponseCorpus] = None,
+        token_ttl: float = 3600,
+    ):
+        self.http = http or httpx.AsyncClient(timeout=timeout)
+        self.corpus = corpus
+        self.token_ttl = token_ttl
+        self.sessions: Dict[str, ServerSession] = {}
+        self.rate_limits: Dict[Tuple[str, str], RateLimit] = {}
+        """The last rate limit reported by each server, for each endpoint."""
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    def get_rate_limits(self, server_name: str) -> List[RateLimit]:
+        """Return the rate limits of each endpoint of a server we've called."""
+        return [
+            rate_limit
+            for (server, _), rate_limit in self.rate_limits.items()
+            if server == server_name
+        ]
+
+    def _session(self, server_cfg: ServerConfig) -> ServerSession:
+        session = self.sessions.get(server_cfg.name)
+        if session is None:
+            session = self.sessions[server_cfg.name] = ServerSession()
+        return session
+
+    async def sign_in(self, server_cfg: ServerConfig) -> str:
+        """Return a token for the server, signing in if there isn't a valid one."""
+        if server_cfg.token:
+            return server_cfg.token
+
+        session = self._session(server_cfg)
+        token = session.valid_token()
+        if token:
+            return token
+
+        async with session.lock:
+            # Someone else may have signed in while we waited
+            token = session.valid_token()
+            if token:
+                return token
+
+            resp = await self.http.post(
+                api_prefix(server_cfg) + "auth/signin",
+                json={"email": server_cfg.email, "password": server_cfg.password},
+            )
+            resp.raise_for_status()
+            SIGN_INS.inc(server=server_cfg.name)
+            token = resp.json()["token"]
+            session.set_token(token, self.token_ttl)
+            return token
+
+    def _token_rejected(self, server_cfg: ServerConfig, token: str):
+        session = self._session(server_cfg)
+        # Unless it has already been replaced by a newer one
+        if session.token == token:
+            session.token = None
+
+    def _token_refreshed(self, server_cfg: ServerConfig, resp: httpx.Response):
+        token = resp.headers.get("X-Token")
+        if token and not server_cfg.token:
+            self._session(server_cfg).set_token(token, self.token_ttl)
+
+    async def get_memory(
+        self, server_cfg: ServerConfig, path: str, shard: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Fetch a path of Memory, leaving the data undecoded."""
+        shard = shard or server_cfg.shard
+        params = {"path": path, "shard": shard}
+        return await self._get(server_cfg, "user/memory", params, shard, path)
+
+    async def get_memory_segment(
+        self, server_cfg: ServerConfig, segment: int, shard: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Fetch a RawMemory segment.
+
+        The data is the segment's string, or None if it was never written.
+        """
+        shard = shard or server_cfg.shard
+        params = {"segment": str(segment), "shard": shard}
+        return await self._get(
+            server_cfg, "user/memory-segment", params, shard, f"segment:{segment}"
+        )
+
+    async def _get(
+        self,
+        server_cfg: ServerConfig,
+        endpoint: str,
+        params: Dict[str, str],
+        shard: str,
+        capture_path: str,
+    ) -> Dict[str, Any]:
+        """GET an API endpoint as the user.
+
+        If the token is rejected, sign in again and retry once.
+        """
+        token = await self.sign_in(server_cfg)
+        resp = await self._send(
+            server_cfg, endpoint, params, shard, capture_path, token
+        )
+        if resp.status_code == 401 and not server_cfg.token:
+            self._token_rejected(server_cfg, token)
+            token = await self.sign_in(server_cfg)
+            resp = await self._send(
+                server_cfg, endpoint, params, shard, capture_path, token
+            )
+
+        resp.raise_for_status()
+        self._token_refreshed(server_cfg, resp)
+        FETCHED_BYTES.inc(len(resp.content), server=server_cfg.name)
+        return resp.json()
+
+    async def _send(
+        self,
+        server_cfg: ServerConfig,
+        endpoint: str,
+        params: Dict[str, str],
+        shard: str,
+        capture_path: str,
+        token: str,
+    ) -> httpx.Response:
+        start = time.perf_counter()
+        resp = await self.http.get(
+            api_prefix(server_cfg) + endpoint,
+            params=params,
+            headers={"X-Token": token, "X-Username": token},
+        )
+        elapsed = time.perf_counter() - start
+
+        rate_limit = RateLimit.from_headers(resp.headers)
+        if rate_limit is not None:
+            self.rate_limits[(server_cfg.name, endpoint)] = rate_limit
+
+        if self.corpus is not None:
+            await asyncio.to_thread(
+                self.corpus.capture,
+                server_cfg.name,
+                shard,
+                capture_path,
+                resp.status_code,
+                elapsed,
+                resp.content,
+            )
+        return resp
@@ -0,0 +1,111 @@
+"""Reassembly of a banan history written across RawMemory segments.
+
+The bot can write its history to segments rather than to Memory, so it
+doesn't parse and serialize the history as part of Memory every tick.
+The history's JSON is split into chunks, each prefixed with a header of
+
+    BANAN:<version>:<write tick>:<index>:<count>:
+
+so the parts of one write can be checked to all be there, and to all be
+from the same tick. See the equivalent TypeScript in `bot/banan.ts`.
+"""
+
+from typing import Any, Dict, List, Optional
+
+SEGMENT_FORMAT_VERSION = 1
+
+SEGMENT_PREFIX = "BANAN"
+
+SEGMENT_MAX_LENGTH = 100 * 1024
+"""Screeps limits each segment to 100 KB."""
+
+SEGMENT_HEADER_MAX_LENGTH = 64
+"""Room left in each segment for its header."""
+
+
+class SegmentChunk:
+    """One segment's part of a written history."""
+
+    def __init__(
+        self, version: int, write_tick: int, index: int, count: int, data: str
+    ):
+        self.version = version
+        self.write_tick = write_tick
+        self.index = index
+        self.count = count
+        self.data = data
+
+    @classmethod
+    def parse(cls, segment: int, value: str) -> "SegmentChunk":
+        parts = value.split(":", 5)
+        if len(parts) != 6 or parts[0] != SEGMENT_PREFIX:
+            raise ValueError(f"Segment {segment} has no banan header")
+        try:
+            version, write_tick, index, count = (int(part) for part in parts[1:5])
+        except ValueError:
+            raise ValueError(f"Segment {segment} has an invalid banan header")
+        if version != SEGMENT_FORMAT_VERSION:
+            raise ValueError(
+                f"Segment {segment} is version {version}, expected"
+                f" {SEGMENT_FORMAT_VERSION}"
+            )
+        return cls(version, write_tick, index, count, parts[5])
+
+
+def split_into_segments(data: str, write_tick: int) -> List[str]:
+    """Split a history into segment values, as the bot does."""
+    chunk_length = SEGMENT_MAX_LENGTH - SEGMENT_HEADER_MAX_LENGTH
+    count = max(1, -(-len(data) // chunk_length))
+    return [
+        f"{SEGMENT_PREFIX}:{SEGMENT_FORMAT_VERSION}:{write_tick}:{i}:{count}:"
+        + data[i * chunk_length : (i + 1) * chunk_length]
+        for i in range(count)
+    ]
+
+
+def decode_segment_response(
+    segment: int, resp: Optional[Dict[str, Any]]
+) -> Optional[str]:
+    """Return the value of a segment from a memory-segment API response.
+
+    Returns None if the segment was never written.
+    """
+    if not resp or not resp.get("ok"):
+        raise ValueError(f"Failed to fetch segment {segment}: {resp}")
+    return resp.get("data") or None
+
+
+def reassemble_segments(values: Dict[int, str]) -> str:
+    """Join the chunks of a history, by segment id, back into its JSON.
+
+    The segments must hold one whole write. Segments past its last chunk
+    are left over from a longer history and are ignored.
+    """
+    if not values:
+        raise ValueError("No segments to reassemble")
+
+    chunks: Dict[int, SegmentChunk] = {}
+    for segment, value in values.items():
+        chunk = SegmentChunk.parse(segment, value)
+        if chunk.index in chunks:
+            raise ValueError(f"Segment {segment} repeats part {chunk.index}")
+        chunks[chunk.index] = chunk
+
+    first = chunks.get(0)
+    if first is None:
+        raise ValueError("Missing the first segment of the history")
+
+    parts = []
+    for index in range(first.count):
+        chunk = chunks.get(index)
+        if chunk is None:
+            raise ValueError(f"Missing segment {index} of {first.count}")
+        # Segments are saved separately, so a read between the bot's
+        # writes could mix two versions of the history
+        if chunk.write_tick != first.write_tick or chunk.count != first.count:
+            raise ValueError(
+                f"Segment {index} was written in tick {chunk.write_tick},"
+                f" but segment 0 in tick {first.write_tick}"
+            )
+        parts.append(chunk.data)
+    return "".join(parts)
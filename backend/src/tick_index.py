@@ -0,0 +1,77 @@
+"""Indexes of the archived ticks, kept up to date as ticks are ingested."""
+
+import threading
+from typing import Callable, Dict, Generic, Iterable, Protocol, Tuple, TypeVar
+
+from src.archive import TickArchive
+from src.fetch_history import ProfilingNode
+from src.history_query import RawTick
+
+
+class TickIndex(Protocol):
+    def add_ticks(self, ticks: Iterable[ProfilingNode]) -> int:
+        """Add the ticks not already indexed, returning how many were new."""
+        ...
+
+    def add_raw_ticks(self, ticks: Iterable[RawTick]) -> int:
+        """Like `add_ticks`, but add ticks in their compressed form."""
+        ...
+
+
+T = TypeVar("T", bound=TickIndex)
+R = TypeVar("R")
+
+
+class TickIndexStore(Generic[T]):
+    """An index of every archived tick, for each server and shard.
+
+    A server's index is built from the archive the first time it's asked
+    for, and after that kept up to date as new ticks are ingested, rather
+    than being rebuilt on every request. It's built from the compressed
+    ticks, read `chunk_size` at a time, so the archive is never loaded into
+    memory all at once.
+    """
+
+    def __init__(
+        self, archive: TickArchive, build: Callable[[], T], chunk_size: int = 1000
+    ):
+        self.archive = archive
+        self.build = build
+        self.chunk_size = chunk_size
+        self.indexes: Dict[Tuple[str, str], T] = {}
+        # Called from worker threads by both the API and the scraper. It's
+        # reentrant, so one query can run inside another, e.g. to compare
+        # two indexes
+        self.lock = threading.RLock()
+
+    def query(self, server: str, shard: str, query: Callable[[T], R]) -> R:
+        """Run a query on the index of a server, building it if needed."""
+        with self.lock:
+            index = self.indexes.get((server, shard))
+            if index is None:
+                index = self.build()
+                index.add_raw_ticks(
+                    self.archive.iter_raw_ticks(
+                        server, shard, chunk_size=self.chunk_size
+                    )
+                )
+                self.indexes[(server, shard)] = index
+            return query(index)
+
+    def add_ticks(self, server: str, shard: str, ticks: Iterable[ProfilingNode]):
+        """Add newly archived ticks to the index, if it has been built.
+
+        The ticks must already be in the archive, so that an index which
+        hasn't been built yet will include them when it is.
+        """
+        with self.lock:
+            index = self.indexes.get((server, shard))
+            if index is not None:
+                index.add_ticks(ticks)
+
+    def add_raw_ticks(self, server: str, shard: str, ticks: Iterable[RawTick]):
+        """Like `add_ticks`, but add ticks in their compressed form."""
+        with self.lock:
+            index = self.indexes.get((server, shard))
+            if index is not None:
+                index.add_raw_ticks(ticks)
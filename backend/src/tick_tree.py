@@ -0,0 +1,335 @@
+"""Compact, array backed representation of a tick's call tree."""
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.fetch_history import (
+    EXPECTED_BANAN_FORMAT_VERSION,
+    CompressedProfilingDump,
+    CompressedProfilingHistory,
+    ProfilingMark,
+    ProfilingNode,
+    RawProfilingHistory,
+)
+
+_SUBTREE_END = object()
+"""Marks the end of the subtree of its parent, when walking a tree."""
+
+
+class TickTree:
+    """The call tree of a single tick, stored as parallel typed arrays.
+
+    Nodes are stored in pre-order, so node 0 is the root and the subtree
+    of node `i` is the range of nodes `i` up to `subtree_end[i]`
+    (exclusive). The root has a parent of -1.
+
+    Key strings are not stored per node. Instead `key_id` indexes into a
+    key table, which is shared between all the ticks of a history.
+    """
+
+    def __init__(
+        self,
+        keys: Dict[int, str],
+        key_id: np.ndarray,
+        start: np.ndarray,
+        cpu: np.ndarray,
+        intents: np.ndarray,
+        parent: np.ndarray,
+        subtree_end: np.ndarray,
+        marks: Optional[List[ProfilingMark]] = None,
+        timestamp: Optional[int] = None,
+        shard: Optional[str] = None,
+    ):
+        self.keys = keys
+        self.key_id = key_id
+        self.start = start
+        self.cpu = cpu
+        self.intents = intents
+        self.parent = parent
+        self.subtree_end = subtree_end
+        self.marks = marks
+        self.timestamp = timestamp
+        self.shard = shard
+
+        self._self_costs: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_compressed(
+        cls,
+        keys: Dict[int, str],
+        node: Sequence,
+        marks: Optional[List[ProfilingMark]] = None,
+        timestamp: Optional[int] = None,
+    ) -> "TickTree":
+        """Build a tree from a compressed node, without recursion.
+
+        `keys` is the inverted keyMap of the history the node came from.
+        """
+
+        def unpack(comp: Sequence) -> Tuple[int, float, float, int, Sequence]:
+            if (
+                not isinstance(comp, (list, tuple))
+                or len(comp) != 5
+                or not isinstance(comp[4], (list, tuple))
+            ):
+                raise ValueError("Invalid node in banan history: {}".format(comp))
+            if comp[0] not in keys:
+                raise ValueError("Did not find key ID {} in key map".format(comp[0]))
+            try:
+                return comp[0], float(comp[1]), float(comp[2]), int(comp[3]), comp[4]
+            except (TypeError, ValueError):
+                raise ValueError("Invalid node in banan history: {}".format(comp))
+
+        return cls._build(keys, node, unpack, marks, timestamp)
+
+    @classmethod
+    def from_dump(
+        cls, keys: Dict[int, str], dump: CompressedProfilingDump
+    ) -> "TickTree":
+        """Build a tree from a compressed dump of a tick."""
+        return cls.from_compressed(keys, dump.d, marks=dump.m, timestamp=dump.t)
+
+    @classmethod
+    def from_raw_tick(
+        cls, history: RawProfilingHistory, tick: Dict[str, Any]
+    ) -> "TickTree":
+        """Build a tree from a tick of a raw history."""
+        marks = [ProfilingMark.model_validate(mark) for mark in tick["m"]]
+        tree = cls.from_compressed(history.keys, tick["d"], marks, tick["t"])
+        tree.shard = history.shard
+        return tree
+
+    @classmethod
+    def from_profiling_node(cls, root: ProfilingNode) -> "TickTree":
+        """Build a tree from an already decompressed node."""
+        key_ids: Dict[str, int] = {}
+
+        def unpack(node: ProfilingNode) -> Tuple[int, float, float, int, Sequence]:
+            key_id = key_ids.setdefault(node.key, len(key_ids))
+            return key_id, node.start, node.cpu, node.intents, node.children
+
+        tree = cls._build({}, root, unpack, root.marks, root.timestamp)
+        tree.keys.update((v, k) for k, v in key_ids.items())
+        tree.shard = root.shard
+        return tree
+
+    @classmethod
+    def _build(
+        cls,
+        keys: Dict[int, str],
+        root: Any,
+        unpack: Callable[[Any], Tuple[int, float, float, int, Sequence]],
+        marks: Optional[List[ProfilingMark]],
+        timestamp: Optional[int],
+    ) -> "TickTree":
+        """Walk a tree in pre-order and fill in the arrays."""
+        key_ids: List[int] = []
+        starts: List[float] = []
+        cpus: List[float] = []
+        intents: List[int] = []
+        parents: List[int] = []
+        ends: List[int] = []
+
+        pending: List[Tuple[Any, int]] = [(root, -1)]
+        while pending:
+            node, parent = pending.pop()
+            if node is _SUBTREE_END:
+                ends[parent] = len(key_ids)
+                continue
+
+            key_id, start, cpu, node_intents, children = unpack(node)
+
+            index = len(key_ids)
+            key_ids.append(key_id)
+            starts.append(start)
+            cpus.append(cpu)
+            intents.append(node_intents)
+            parents.append(parent)
+            ends.append(-1)
+
+            pending.append((_SUBTREE_END, index))
+            for child in reversed(children):
+                pending.append((child, index))
+
+        return cls(
+            keys=keys,
+            key_id=np.array(key_ids, dtype=np.int32),
+            start=np.array(starts, dtype=np.float64),
+            cpu=np.array(cpus, dtype=np.float64),
+            intents=np.array(intents, dtype=np.int32),
+            parent=np.array(parents, dtype=np.int32),
+            subtree_end=np.array(ends, dtype=np.int32),
+            marks=marks,
+            timestamp=timestamp,
+        )
+
+    def __len__(self) -> int:
+        return len(self.key_id)
+
+    @property
+    def root(self) -> "TickTreeNode":
+        return TickTreeNode(self, 0)
+
+    @property
+    def key(self) -> str:
+        return self.keys[int(self.key_id[0])]
+
+    def node(self, index: int) -> "TickTreeNode":
+        return TickTreeNode(self, index)
+
+    def child_indices(self, index: int) -> Iterator[int]:
+        """Yield the indices of the direct children of a node."""
+        child = index + 1
+        end = self.subtree_end[index]
+        while child < end:
+            yield child
+            child = int(self.subtree_end[child])
+
+    def self_costs(self) -> np.ndarray:
+        """Return the cpu cost of every node minus the cost of its children."""
+        if self._self_costs is None:
+            costs = self.cpu.copy()
+            np.subtract.at(costs, self.parent[1:], self.cpu[1:])
+            self._self_costs = costs
+        return self._self_costs
+
+    def depths(self) -> np.ndarray:
+        """Return the depth of every node, where the root is at depth 0.
+
+        Each subtree opens just after its root and closes at its end, so
+        the depth of a node is the running count of open subtrees.
+        """
+        count = len(self)
+        delta = np.zeros(count + 1, dtype=np.int32)
+        delta[1:] += 1
+        np.add.at(delta, self.subtree_end, -1)
+        return np.cumsum(delta[:count])
+
+    def subtree_sums(self, values: np.ndarray) -> np.ndarray:
+        """Return the sum of `values` over the subtree of every node."""
+        prefix = np.concatenate(([0], np.cumsum(values)))
+        return prefix[self.subtree_end] - prefix[: len(self)]
+
+    def to_profiling_node(self, index: int = 0) -> ProfilingNode:
+        """Materialize the subtree of a node as ProfilingNode models."""
+        nodes: Dict[int, ProfilingNode] = {}
+        for i in range(index, int(self.subtree_end[index])):
+            node = ProfilingNode.model_construct(
+                key=self.keys[int(self.key_id[i])],
+                start=float(self.start[i]),
+                cpu=float(self.cpu[i]),
+                intents=int(self.intents[i]),
+                children=[],
+            )
+            nodes[i] = node
+            if i != index:
+                nodes[int(self.parent[i])].children.append(node)
+
+        result = nodes[index]
+        if index == 0:
+            result.marks = self.marks
+            result.timestamp = self.timestamp
+            result.shard = self.shard
+        return result
+
+
+class TickTreeNode:
+    """A lazy, read-only view of one node of a TickTree.
+
+    This has the same attributes as a ProfilingNode, so can be passed to
+    code expecting one without materializing the whole tree.
+    """
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree: TickTree, index: int):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def key(self) -> str:
+        return self.tree.keys[int(self.tree.key_id[self.index])]
+
+    @property
+    def start(self) -> float:
+        return float(self.tree.start[self.index])
+
+    @property
+    def cpu(self) -> float:
+        return float(self.tree.cpu[self.index])
+
+    @property
+    def intents(self) -> int:
+        return int(self.tree.intents[self.index])
+
+    @property
+    def children(self) -> List["TickTreeNode"]:
+        indices = self.tree.child_indices(self.index)
+        return [TickTreeNode(self.tree, i) for i in indices]
+
+    @property
+    def marks(self) -> Optional[List[ProfilingMark]]:
+        return self.tree.marks if self.index == 0 else None
+
+    @property
+    def timestamp(self) -> Optional[int]:
+        return self.tree.timestamp if self.index == 0 else None
+
+    @property
+    def shard(self) -> Optional[str]:
+        return self.tree.shard if self.index == 0 else None
+
+    def self_cost(self) -> float:
+        return float(self.tree.self_costs()[self.index])
+
+    def get_end_time(self) -> float:
+        return self.start + self.cpu
+
+    def count_nodes(self) -> int:
+        """Return the number of nodes in the tree under this one, inclusive."""
+        return int(self.tree.subtree_end[self.index]) - self.index
+
+    def contains_time(self, search_time: float) -> bool:
+        return self.start <= search_time <= self.get_end_time()
+
+    def search_by_time(
+        self, search_time: float, call_stack: List[str]
+    ) -> Tuple[Optional["TickTreeNode"], List[str]]:
+        """Search for the deepest child node which was running at the given time.
+
+        Return the found node (if any) as well as the frame stack.
+        """
+        call_stack.append(self.key)
+
+        if not self.contains_time(search_time):
+            return None, call_stack
+
+        tree = self.tree
+        index = self.index
+        while True:
+            # The earliest child running at the time, as for ProfilingNode
+            for child in tree.child_indices(index):
+                start = tree.start[child]
+                if start <= search_time <= start + tree.cpu[child]:
+                    index = child
+                    call_stack.append(tree.keys[int(tree.key_id[child])])
+                    break
+            else:
+                return TickTreeNode(tree, index), call_stack
+
+    def to_profiling_node(self) -> ProfilingNode:
+        return self.tree.to_profiling_node(self.index)
+
+
+def decompress_history_trees(comp: CompressedProfilingHistory) -> List[TickTree]:
+    """Decompress a dump of profiling history into array backed trees.
+
+    The key table is inverted once and shared by all the ticks.
+    """
+    if comp.version != EXPECTED_BANAN_FORMAT_VERSION:
+        raise ValueError(
+            f"Expected banan format version {EXPECTED_BANAN_FORMAT_VERSION} but got {comp.version}"
+        )
+    keys = {v: k for k, v in comp.keyMap.map.items()}
+    return [TickTree.from_dump(keys, dump) for dump in comp.ticks if dump]
@@ -0,0 +1,80 @@
+"""A shared, size-bounded cache of decompressed ticks."""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from src.fetch_history import ProfilingNode, RawProfilingHistory
+
+TreeKey = Tuple[str, str, str]
+
+
+class TreeCache:
+    """The most recently used decompressed ticks, by server, shard and key.
+
+    Ticks are kept in compressed form until they're needed, and the
+    expanded trees are cached here, so memory grows with the ticks being
+    looked at rather than with every tick of every server. The cache is
+    bounded by the total number of nodes in its trees, and the least
+    recently used trees are evicted first.
+
+    Cached trees are shared, so they must not be changed.
+    """
+
+    def __init__(self, max_nodes: int):
+        self.max_nodes = max_nodes
+        self.trees: "OrderedDict[TreeKey, Tuple[ProfilingNode, int]]" = OrderedDict()
+        self.nodes = 0
+
+        # Used from worker threads by the API, the scraper and the exporter
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.trees)
+
+    def get(self, server: str, shard: str, tick_key: str) -> Optional[ProfilingNode]:
+        key = (server, shard, tick_key)
+        with self.lock:
+            entry = self.trees.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.trees.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, server: str, shard: str, tree: ProfilingNode):
+        size = tree.count_nodes()
+        # A tree too big to cache would only push everything else out
+        if size > self.max_nodes:
+            return
+
+        key = (server, shard, tree.key)
+        with self.lock:
+            old = self.trees.pop(key, None)
+            if old is not None:
+                self.nodes -= old[1]
+            self.trees[key] = (tree, size)
+            self.nodes += size
+
+            while self.nodes > self.max_nodes:
+                _, (_, evicted) = self.trees.popitem(last=False)
+                self.nodes -= evicted
+
+    def decompress(
+        self,
+        server: str,
+        shard: str,
+        history: RawProfilingHistory,
+        tick: Dict[str, Any],
+    ) -> ProfilingNode:
+        """Return the tree of a raw tick, decompressing it if it isn't cached."""
+        tick_key = history.tick_key(tick)
+        tree = self.get(server, shard, tick_key)
+        if tree is None:
+            tree = history.decompress_tick(tick)
+            self.put(server, shard, tree)
+        return tree
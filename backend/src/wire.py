@@ -0,0 +1,213 @@
+"""Compact binary encoding of a history, for the frontend.
+
+Rather than expanding every tick to JSON, where each node repeats its key
+and field names, the ticks are sent as one string table and flat typed
+columns, which the browser can view without parsing. See
+`frontend/src/wire.ts` for the decoder.
+
+All numbers are little endian, and every section starts on an 8 byte
+boundary so it can be viewed as a typed array. After a 32 byte header of
+magic, version and counts, the sections are:
+
+    stringLengths  u32[strings]   UTF-8 byte length of each string
+    stringData     u8[stringBytes]
+    tickRoot       u32[ticks]     index of the root node of each tick
+    tickTimestamp  f64[ticks]     NaN if the tick has no timestamp
+    tickShard      u32[ticks]     index into the string table, or NO_SHARD
+    nodeKey        u32[nodes]     index into the string table
+    nodeStart      f64[nodes]
+    nodeCpu        f64[nodes]
+    nodeIntents    i32[nodes]
+    nodeSubtreeEnd u32[nodes]
+    markTick       u32[marks]     index of the tick of each mark
+    markShortName  u32[marks]
+    markFullName   u32[marks]
+    markTimestamp  f64[marks]
+
+Nodes are in pre-order, so the subtree of node `i` is the nodes from `i`
+up to `nodeSubtreeEnd[i]` (exclusive), and the ticks follow each other.
+"""
+
+import math
+import struct
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from src.fetch_history import ProfilingMark, ProfilingNode
+from src.tick_tree import TickTree
+
+MAGIC = b"BANW"
+VERSION = 2
+MEDIA_TYPE = "application/x-banan-wire"
+
+HEADER = struct.Struct("<4s6I")
+HEADER_SIZE = 32
+
+NO_SHARD = 0xFFFFFFFF
+"""The shard of a tick which wasn't tagged with one."""
+
+
+class StringTable:
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+
+    def add(self, value: str) -> int:
+        return self.ids.setdefault(value, len(self.ids))
+
+
+def encode_history_wire(trees: List[TickTree]) -> bytes:
+    """Encode the trees of a history's ticks in the wire format."""
+    strings = StringTable()
+
+    key_columns = []
+    tick_roots = []
+    tick_timestamps = []
+    tick_shards = []
+    mark_rows: List[Tuple[int, int, int, float]] = []
+    node_count = 0
+    for tick_index, tree in enumerate(trees):
+        used = np.unique(tree.key_id)
+        lookup = np.zeros(int(used[-1]) + 1 if len(used) else 0, dtype=np.uint32)
+        lookup[used] = [strings.add(tree.keys[int(key_id)]) for key_id in used]
+        key_columns.append(lookup[tree.key_id])
+
+        tick_roots.append(node_count)
+        tick_timestamps.append(
+            float("nan") if tree.timestamp is None else tree.timestamp
+        )
+        tick_shards.append(NO_SHARD if tree.shard is None else strings.add(tree.shard))
+        for mark in tree.marks or []:
+            mark_rows.append(
+                (
+                    tick_index,
+                    strings.add(mark.shortName),
+                    strings.add(mark.fullName),
+                    mark.timestamp,
+                )
+            )
+        node_count += len(tree)
+
+    encoded_strings = [value.encode("utf-8") for value in strings.ids]
+    string_data = b"".join(encoded_strings)
+
+    def concat(columns: List[np.ndarray], dtype: str) -> np.ndarray:
+        if not columns:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(columns).astype(dtype, copy=False)
+
+    # The subtree ends are relative to each tree, so offset them
+    subtree_ends = [
+        tree.subtree_end.astype(np.int64) + root
+        for tree, root in zip(trees, tick_roots)
+    ]
+    marks = np.array(mark_rows, dtype=np.float64).reshape(-1, 4)
+
+    sections = [
+        np.array([len(value) for value in encoded_strings], dtype="<u4"),
+        np.frombuffer(string_data, dtype=np.uint8),
+        np.array(tick_roots, dtype="<u4"),
+        np.array(tick_timestamps, dtype="<f8"),
+        np.array(tick_shards, dtype="<u4"),
+        concat(key_columns, "<u4"),
+        concat([tree.start for tree in trees], "<f8"),
+        concat([tree.cpu for tree in trees], "<f8"),
+        concat([tree.intents for tree in trees], "<i4"),
+        concat(subtree_ends, "<u4"),
+        marks[:, 0].astype("<u4"),
+        marks[:, 1].astype("<u4"),
+        marks[:, 2].astype("<u4"),
+        marks[:, 3].astype("<f8"),
+    ]
+
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        len(encoded_strings),
+        len(string_data),
+        len(trees),
+        node_count,
+        len(mark_rows),
+    )
+    parts = [header, b"\0" * (HEADER_SIZE - len(header))]
+    for section in sections:
+        data = section.tobytes()
+        parts.append(data)
+        parts.append(b"\0" * (-len(data) % 8))
+    return b"".join(parts)
+
+
+def decode_history_wire(data: bytes) -> List[ProfilingNode]:
+    """Decode a history from the wire format, as the frontend does."""
+    magic, version, string_count, string_bytes, tick_count, node_count, mark_count = (
+        HEADER.unpack_from(data)
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unsupported wire format: {magic!r} v{version}")
+
+    offset = HEADER_SIZE
+
+    def read(dtype: str, count: int) -> np.ndarray:
+        nonlocal offset
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes + (-array.nbytes % 8)
+        return array
+
+    string_lengths = read("<u4", string_count)
+    string_data = read("u1", string_bytes).tobytes()
+    string_ends = np.cumsum(string_lengths)
+    strings = [
+        string_data[end - length : end].decode("utf-8")
+        for length, end in zip(string_lengths.tolist(), string_ends.tolist())
+    ]
+
+    tick_roots = read("<u4", tick_count).tolist()
+    tick_timestamps = read("<f8", tick_count).tolist()
+    tick_shards = read("<u4", tick_count).tolist()
+    keys = read("<u4", node_count).tolist()
+    starts = read("<f8", node_count).tolist()
+    cpus = read("<f8", node_count).tolist()
+    intents = read("<i4", node_count).tolist()
+    subtree_ends = read("<u4", node_count).tolist()
+    mark_ticks = read("<u4", mark_count).tolist()
+    mark_short_names = read("<u4", mark_count).tolist()
+    mark_full_names = read("<u4", mark_count).tolist()
+    mark_timestamps = read("<f8", mark_count).tolist()
+
+    nodes = [
+        ProfilingNode(
+            key=strings[keys[i]],
+            start=starts[i],
+            cpu=cpus[i],
+            intents=intents[i],
+            children=[],
+        )
+        for i in range(node_count)
+    ]
+    # Each node is a child of the closest earlier node whose subtree holds it
+    open_nodes: List[int] = []
+    for i in range(node_count):
+        while open_nodes and subtree_ends[open_nodes[-1]] <= i:
+            open_nodes.pop()
+        if open_nodes:
+            nodes[open_nodes[-1]].children.append(nodes[i])
+        open_nodes.append(i)
+
+    ticks = [nodes[root] for root in tick_roots]
+    for tick, timestamp, shard in zip(ticks, tick_timestamps, tick_shards):
+        if not math.isnan(timestamp):
+            tick.timestamp = int(timestamp)
+        if shard != NO_SHARD:
+            tick.shard = strings[shard]
+    for tick_index, short_name, full_name, timestamp in zip(
+        mark_ticks, mark_short_names, mark_full_names, mark_timestamps
+    ):
+        tick = ticks[tick_index]
+        tick.marks = (tick.marks or []) + [
+            ProfilingMark(
+                shortName=strings[short_name],
+                fullName=strings[full_name],
+                timestamp=timestamp,
+            )
+        ]
+    return ticks
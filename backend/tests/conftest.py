@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+# The config is read when src.config is first imported, and the app opens
+# the archive when it's imported, so these must be set before any test
+# module imports them
+TEST_DIR = tempfile.mkdtemp()
+with open(os.path.join(TEST_DIR, "secrets.yml"), "w") as fh:
+    fh.write(
+        """
+banan_history_key: BANAN
+servers:
+  - name: main
+    host: screeps.com
+    token: abc
+  - name: pserver
+    host: localhost:21025
+    token: def
+"""
+    )
+os.environ["CONFIG_FILE"] = os.path.join(TEST_DIR, "secrets.yml")
+os.environ["ARCHIVE_PATH"] = os.path.join(TEST_DIR, "archive.sqlite3")
@@ -0,0 +1,111 @@
+import sys
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.aggregate import ROOT_KEY, AggregateTree, diff_aggregates
+from src.archive import TickArchive
+from src.fetch_history import ProfilingNode, RawProfilingHistory
+from src.tick_index import TickIndexStore
+
+
+def make_tick(tick: int, a_cpu: float, b_cpus) -> ProfilingNode:
+    b_calls = [
+        ProfilingNode(key="B", start=1 + i, cpu=cpu, intents=1, children=[])
+        for i, cpu in enumerate(b_cpus)
+    ]
+    child_a = ProfilingNode(key="A", start=0, cpu=a_cpu, intents=0, children=b_calls)
+    return ProfilingNode(
+        key=f"Tick {tick}", start=0, cpu=10, intents=0, children=[child_a]
+    )
+
+
+def test_aggregate_merges_by_stack_path():
+    tree = AggregateTree.from_ticks([make_tick(100, 6, [1, 2]), make_tick(101, 4, [3])])
+    # Ticks aren't added twice
+    assert tree.add_ticks([make_tick(101, 4, [3])]) == 0
+
+    result = tree.to_dict()
+    assert (result["ticks"], result["first_tick"], result["last_tick"]) == (
+        2,
+        100,
+        101,
+    )
+
+    root = result["tree"]
+    assert root["key"] == ROOT_KEY
+    assert (root["total"], root["calls"], root["max"]) == (20, 2, 10)
+
+    [node_a] = root["children"]
+    assert (node_a["total"], node_a["mean"], node_a["max"]) == (10, 5, 6)
+    assert (node_a["calls"], node_a["self"]) == (2, 4)
+
+    [node_b] = node_a["children"]
+    assert (node_b["total"], node_b["calls"], node_b["max"]) == (6, 3, 3)
+    assert node_b["intents"] == 3
+
+
+def test_store_updates_incrementally(tmp_path):
+    data = SyntheticHistoryGenerator(seed=2).generate_json(ticks=6, first_tick=10)
+    history = RawProfilingHistory.from_json(data).decompress()
+    archive = TickArchive(str(tmp_path / "archive.sqlite3"))
+    # Built a tick at a time, so from several chunks
+    store = TickIndexStore(archive, AggregateTree, chunk_size=1)
+
+    # Ticks added before the tree is built are read from the archive
+    archive.add_ticks("main", "shard0", history[:3])
+    store.add_ticks("main", "shard0", history[:3])
+    assert store.query("main", "shard0", AggregateTree.to_dict)["ticks"] == 3
+
+    archive.add_ticks("main", "shard0", history[3:])
+    store.add_ticks("main", "shard0", history[3:])
+    assert (
+        store.query("main", "shard0", AggregateTree.to_dict)
+        == AggregateTree.from_ticks(history).to_dict()
+    )
+    assert store.query("main", "shard1", AggregateTree.to_dict)["ticks"] == 0
+
+
+def test_raw_ticks_aggregate_like_decompressed():
+    data = SyntheticHistoryGenerator(seed=3).generate_json(ticks=5)
+    raw = RawProfilingHistory.from_json(data)
+    from_raw = AggregateTree.from_raw_ticks((raw, tick) for tick in raw.ticks)
+    assert from_raw.to_dict() == AggregateTree.from_ticks(raw.decompress()).to_dict()
+
+
+def test_diff_compares_mean_self_cost_per_path():
+    base = AggregateTree.from_ticks([make_tick(100, 6, [1, 2]), make_tick(101, 4, [3])])
+    target = AggregateTree.from_ticks([make_tick(200, 8, [2])])
+    target.add_ticks(
+        [
+            ProfilingNode(
+                key="Tick 201",
+                start=0,
+                cpu=2,
+                intents=0,
+                children=[
+                    ProfilingNode(key="C", start=0, cpu=1, intents=0, children=[])
+                ],
+            )
+        ]
+    )
+
+    diff = diff_aggregates(base, target)
+    assert diff["base"] == {"ticks": 2, "first_tick": 100, "last_tick": 101}
+    assert diff["target"]["ticks"] == 2
+
+    node_a, node_c = diff["tree"]["children"]
+    # A's self cost per tick went from (3 + 1) / 2 to 6 / 2
+    assert (node_a["key"], node_a["base_self"], node_a["target_self"]) == ("A", 2, 3)
+    assert (node_a["self_delta"], node_a["self_ratio"]) == (1, 0.5)
+    assert node_a["total_delta"] == 4 - 5
+
+    [node_b] = node_a["children"]
+    assert (node_b["base_self"], node_b["target_self"]) == (3, 1)
+
+    # Only called in the target
+    assert (node_c["key"], node_c["base_self"], node_c["self_ratio"]) == (
+        "C",
+        0,
+        None,
+    )
+    assert node_c["self_delta"] == 0.5
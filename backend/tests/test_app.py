@@ -0,0 +1,213 @@
+import asyncio
+import json
+import sys
+import time
+
+import httpx
+import pytest
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src import app as app_module
+from src.wire import decode_history_wire
+from tests.test_screeps_client import encode_memory_data
+
+
+class FakeScreeps:
+    """Stand in for the Screeps memory API, which takes a while to respond."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.requests = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request.url.host)
+        await asyncio.sleep(self.delay)
+        history = SyntheticHistoryGenerator(seed=1).generate_json(ticks=3)
+        return httpx.Response(200, json={"ok": 1, "data": encode_memory_data(history)})
+
+
+@pytest.fixture
+def fake_screeps(monkeypatch):
+    fake = FakeScreeps(delay=0.3)
+    http = httpx.AsyncClient(transport=httpx.MockTransport(fake))
+    monkeypatch.setattr(app_module.screeps_client, "http", http)
+    app_module.history_cache.entries.clear()
+    return fake
+
+
+def api_client() -> httpx.AsyncClient:
+    transport = httpx.ASGITransport(app=app_module.app)
+    return httpx.AsyncClient(transport=transport, base_url="http://banan")
+
+
+def test_history_requests_overlap(fake_screeps):
+    async def run():
+        async with api_client() as client:
+            start = time.monotonic()
+            responses = await asyncio.gather(
+                client.get("/api/history/main"),
+                client.get("/api/history/main"),
+                client.get("/api/history/pserver"),
+                client.get("/api/history_pprof/pserver?gzip=true"),
+            )
+            return responses, time.monotonic() - start
+
+    responses, duration = asyncio.run(run())
+    assert [response.status_code for response in responses] == [200] * 4
+
+    # Requests to different servers overlap, and to the same server are
+    # served by a single fetch
+    assert duration < 2 * fake_screeps.delay
+    assert sorted(fake_screeps.requests) == ["localhost", "screeps.com"]
+
+    # The pprof file is gzipped when asked
+    assert responses[3].content[:2] == b"\x1f\x8b"
+
+    history = json.loads(responses[0].content)["history"]
+    assert [tick["key"] for tick in history] == ["Tick 1000", "Tick 1001", "Tick 1002"]
+
+    archived = asyncio.run(_get("/api/history/main?from_tick=1001"))
+    assert [tick["key"] for tick in archived.json()["history"]] == [
+        "Tick 1001",
+        "Tick 1002",
+    ]
+
+
+def test_history_wire_format(fake_screeps):
+    history = asyncio.run(_get("/api/history/main")).json()["history"]
+    for url in [
+        "/api/history/main?format=wire",
+        "/api/history/main?from_tick=0&format=wire",
+    ]:
+        response = asyncio.run(_get(url))
+        assert response.headers["content-type"] == "application/x-banan-wire"
+        ticks = decode_history_wire(response.content)
+        assert [tick.model_dump() for tick in ticks] == history
+
+
+def test_history_query(fake_screeps):
+    history = asyncio.run(_get("/api/history/main?last=1&max_depth=1")).json()[
+        "history"
+    ]
+    assert [tick["key"] for tick in history] == ["Tick 1002"]
+    for child in history[0]["children"]:
+        assert child["children"] == []
+
+    archived = asyncio.run(_get("/api/history/main?from_tick=1001&to_tick=1001"))
+    assert [tick["key"] for tick in archived.json()["history"]] == ["Tick 1001"]
+
+    # A time window is also served from the archive
+    window = asyncio.run(
+        _get("/api/history/main?from_time=1700000003000&to_time=1700000003000")
+    )
+    assert [tick["key"] for tick in window.json()["history"]] == ["Tick 1001"]
+
+    response = asyncio.run(_get("/api/history/main?last=-1"))
+    assert response.status_code == 400
+
+
+def test_history_aggregate(fake_screeps):
+    asyncio.run(_get("/api/history/main"))
+    aggregate = asyncio.run(_get("/api/history_aggregate/main")).json()
+    assert aggregate["ticks"] >= 3
+    assert aggregate["tree"]["calls"] == aggregate["ticks"]
+
+
+def test_history_diff(fake_screeps):
+    asyncio.run(_get("/api/history/main"))
+    asyncio.run(_get("/api/history/pserver"))
+
+    diff = asyncio.run(
+        _get("/api/history_diff/main?base_to_tick=1000&target_from_tick=1001")
+    ).json()
+    assert (diff["base"]["ticks"], diff["target"]["ticks"]) == (1, 2)
+    assert diff["tree"]["children"]
+
+    # The fake servers have the same history
+    diff = asyncio.run(_get("/api/history_diff/main?target_server=pserver")).json()
+    assert diff["tree"]["self_delta"] == 0
+
+    response = asyncio.run(_get("/api/history_diff/main?target_server=nope"))
+    assert response.status_code == 404
+
+
+def test_history_diff_range_is_limited(fake_screeps, monkeypatch):
+    asyncio.run(_get("/api/history/main"))
+    monkeypatch.setattr(app_module.config, "diff_max_ticks", 1)
+
+    response = asyncio.run(_get("/api/history_diff/main?target_from_tick=1001"))
+    assert response.status_code == 400
+    # Without bounds, the diff reads the kept up to date aggregate instead
+    response = asyncio.run(_get("/api/history_diff/main?target_to_tick=1000"))
+    assert response.status_code == 200
+
+
+def test_cost_queries(fake_screeps):
+    asyncio.run(_get("/api/history/main"))
+    top = asyncio.run(_get("/api/costs/main/top?n=3&by=p95")).json()
+    assert len(top) == 3
+
+    series = asyncio.run(_get(f"/api/costs/main/series?key={top[0]['key']}")).json()
+    assert len(series["tick"]) == top[0]["ticks"]
+
+    response = asyncio.run(_get("/api/costs/main/series?key=nope"))
+    assert response.status_code == 404
+
+    for n in [0, -1]:
+        response = asyncio.run(_get(f"/api/costs/main/top?n={n}"))
+        assert response.status_code == 422
+
+
+def test_metrics(fake_screeps):
+    asyncio.run(_get("/api/history/main"))
+    asyncio.run(_get("/api/history/main"))
+    response = asyncio.run(_get("/metrics"))
+    assert response.headers["content-type"].startswith("text/plain")
+
+    samples = {}
+    for line in response.text.splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+
+    assert samples['banan_fetched_bytes_total{server="main"}'] > 0
+    assert samples['banan_stage_seconds_count{stage="fetch",server="main"}'] >= 1
+    assert samples['banan_stage_seconds_count{stage="parse",server="main"}'] >= 1
+    assert samples['banan_ticks_total{server="main",result="skipped"}'] >= 3
+    assert samples["banan_history_cache_hits_total"] >= 1
+    assert 'banan_tick_nodes_bucket{server="main",le="+Inf"}' in samples
+
+
+def test_cached_history_doesnt_delay_scrapes(fake_screeps):
+    asyncio.run(_get("/api/history/main"))
+    next_due = app_module.schedule.next_due["main"]
+
+    time.sleep(0.01)
+    asyncio.run(_get("/api/history/main"))
+    assert fake_screeps.requests == ["screeps.com"]
+    assert app_module.schedule.next_due["main"] == next_due
+
+
+def test_unknown_server(fake_screeps):
+    response = asyncio.run(_get("/api/history/nope"))
+    assert response.status_code == 404
+
+
+def test_history_shards(fake_screeps):
+    history = asyncio.run(_get("/api/history/main?shard=shard0")).json()["history"]
+    assert {tick["shard"] for tick in history} == {"shard0"}
+
+    for url in [
+        "/api/history/main?shard=shard9",
+        "/api/history_aggregate/main?shard=shard9",
+        "/api/costs/main/top?shard=shard9",
+        "/api/history_live/main?shard=shard9",
+    ]:
+        response = asyncio.run(_get(url))
+        assert response.status_code == 404
+
+
+async def _get(url: str) -> httpx.Response:
+    async with api_client() as client:
+        return await client.get(url)
@@ -0,0 +1,66 @@
+import sys
+
+import pytest
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.archive import (
+    TickArchive,
+    decode_tick_payload,
+    encode_tick_payload,
+    parse_tick_number,
+)
+from src.fetch_history import RawProfilingHistory
+
+
+@pytest.fixture
+def history():
+    data = SyntheticHistoryGenerator(seed=7).generate_json(ticks=5, first_tick=100)
+    return RawProfilingHistory.from_json(data, shard="shard0").decompress()
+
+
+def test_parse_tick_number():
+    assert parse_tick_number("Tick 123") == 123
+    assert parse_tick_number("Role:run") is None
+
+
+def test_tick_payload_roundtrip(history):
+    for tick in history:
+        assert decode_tick_payload(encode_tick_payload(tick), "shard0") == tick
+
+
+def test_archive_dedup_and_ranges(tmp_path, history):
+    path = str(tmp_path / "archive.sqlite3")
+    archive = TickArchive(path)
+    assert archive.add_ticks("main", "shard0", history[:3]) == 3
+    assert archive.add_ticks("main", "shard0", history) == 2
+    assert archive.add_ticks("main", "shard1", history[:1]) == 1
+
+    # Ticks come back tagged with their shard
+    assert archive.get_ticks("main", "shard0") == history
+    assert archive.get_ticks("main", "shard1")[0].shard == "shard1"
+    assert [t.key for t in archive.get_ticks("main", from_tick=103)] == [
+        "Tick 103",
+        "Tick 104",
+    ]
+    assert [t.key for t in archive.get_ticks("main", "shard0", 101, 102)] == [
+        "Tick 101",
+        "Tick 102",
+    ]
+    assert archive.get_ticks("other") == []
+
+    by_key = archive.get_ticks_by_key("main", "shard0", ["Tick 102", "Tick 200"])
+    assert by_key == [history[2]]
+
+    archive.mark_pushed("main", "shard0", ["Tick 100", "Tick 101"])
+    unpushed = archive.get_unpushed_ticks("main", "shard0", limit=2)
+    assert [(t.key, t.timestamp, t.cpu) for t in unpushed] == [
+        (t.key, t.timestamp, t.cpu) for t in history[3:]
+    ]
+    archive.close()
+
+    # The pushed ledger survives a restart
+    archive = TickArchive(path)
+    assert archive.pushed_tick_keys("main", "shard0") == {"Tick 100", "Tick 101"}
+    assert archive.pushed_tick_keys("main", "shard1") == set()
+    assert archive.add_ticks("main", "shard0", history) == 0
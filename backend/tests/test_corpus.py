@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+import sys
+
+import httpx
+
+sys.path.append(".")
+from bench.replay import ReplayScreeps
+from bench.synthetic import SyntheticHistoryGenerator
+from src.config import AppConfig, ServerConfig
+from src.corpus import CapturedResponse, ResponseCorpus
+from src.fetch_history import RawProfilingHistory, fetch_shard_histories_async
+from src.screeps_client import ScreepsClient
+from src.segments import split_into_segments
+
+
+def captured(i: int, size: int = 100) -> CapturedResponse:
+    return CapturedResponse(
+        "main", "shard0", "BANAN", 200, 0.5, 1000.0 + i, b"x" * size
+    )
+
+
+def test_corpus_is_bounded_and_ordered(tmp_path):
+    corpus = ResponseCorpus(str(tmp_path), max_bytes=10000, max_entries=3)
+    for i in range(5):
+        corpus.add(captured(i))
+
+    assert len(corpus) == 3
+    assert [response.captured_at for response in corpus] == [1002.0, 1003.0, 1004.0]
+    assert len(os.listdir(tmp_path)) == 3
+
+    # Reopening carries on where it left off, and the size bound applies
+    corpus = ResponseCorpus(str(tmp_path), max_bytes=corpus.size, max_entries=10)
+    corpus.add(captured(5))
+    assert [response.captured_at for response in corpus] == [1003.0, 1004.0, 1005.0]
+
+    # The newest response is always kept, however big
+    corpus.add(captured(6, size=100000))
+    assert [response.captured_at for response in corpus] == [1006.0]
+
+
+def test_client_captures_memory_responses(tmp_path):
+    body = {"ok": 1, "data": "{}"}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json=body)
+
+    corpus = ResponseCorpus(str(tmp_path), max_bytes=10000)
+    client = ScreepsClient(
+        httpx.AsyncClient(transport=httpx.MockTransport(handler)), corpus=corpus
+    )
+    server_cfg = ServerConfig(name="main", host="screeps.com", token="abc")
+    assert asyncio.run(client.get_memory(server_cfg, "BANAN")) == body
+
+    [response] = list(corpus)
+    assert (response.server, response.shard, response.path) == (
+        "main",
+        "shard0",
+        "BANAN",
+    )
+    assert response.status == 200
+    assert response.elapsed >= 0.05
+    assert json.loads(response.body) == body
+
+
+def test_replay_segmented_shards():
+    generator = SyntheticHistoryGenerator(seed=8)
+    expected = []
+    responses = []
+    for scrape in range(2):
+        histories = {}
+        # Captured in a different order to the one they're fetched in
+        for shard in ["shard1", "shard0"]:
+            first_tick = 100 * scrape + (50 if shard == "shard1" else 0)
+            data = generator.generate_json(ticks=3, first_tick=first_tick)
+            histories[shard] = data
+            [segment] = split_into_segments(data, write_tick=first_tick + 3)
+            # The second segment was never written
+            for path, value in [("segment:10", segment), ("segment:11", None)]:
+                body = json.dumps({"ok": 1, "data": value}).encode("utf-8")
+                responses.append(
+                    CapturedResponse("main", shard, path, 200, 0.0, 0.0, body)
+                )
+        expected.append(histories)
+
+    replay = ReplayScreeps(responses)
+    server_cfg = ServerConfig(
+        name="replayed",
+        host="localhost",
+        token="abc",
+        shards=["shard1"],
+        history_segments=[10, 11],
+    )
+    cfg = AppConfig(servers=[server_cfg], banan_history_key="BANAN")
+    http = httpx.AsyncClient(transport=httpx.ASGITransport(app=replay.app))
+    client = ScreepsClient(http)
+
+    for histories in expected:
+        fetched = asyncio.run(fetch_shard_histories_async(cfg, "replayed", client))
+        assert set(fetched) == {"shard0", "shard1"}
+        for shard, data in histories.items():
+            assert (
+                fetched[shard].decompress()
+                == RawProfilingHistory.from_json(data, shard).decompress()
+            )
+
+    # Nothing was captured from Memory itself
+    response = asyncio.run(http.get("http://localhost/api/user/memory?path=BANAN"))
+    assert response.status_code == 404
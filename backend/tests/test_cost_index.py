@@ -0,0 +1,120 @@
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.cost_index import (
+    TICK_KEY,
+    CostIndex,
+    grouped_percentile,
+    nested_in_same_key,
+)
+from src.fetch_history import ProfilingNode, RawProfilingHistory
+
+
+def node(key, cpu, children=(), intents=0):
+    return ProfilingNode(
+        key=key, start=0, cpu=cpu, intents=intents, children=list(children)
+    )
+
+
+def make_tick(tick: int, a_cpu: float) -> ProfilingNode:
+    # A calls itself, which shouldn't count towards its total twice
+    inner_a = node("A", a_cpu / 2, [node("B", 1, intents=1)], intents=1)
+    outer_a = node("A", a_cpu, [inner_a], intents=1)
+    root = node(f"Tick {tick}", 10, [outer_a, node("B", 2)], intents=1)
+    root.timestamp = 1000 + tick
+    return root
+
+
+def test_index_costs_per_tick():
+    index = CostIndex.from_ticks([make_tick(1, 4), make_tick(2, 8), make_tick(3, 6)])
+    # Ticks aren't indexed twice
+    assert index.add_ticks([make_tick(2, 8)]) == 0
+
+    series = index.series("A")
+    assert series["tick"] == [1, 2, 3]
+    assert series["timestamp"] == [1001, 1002, 1003]
+    assert series["total"] == [4, 8, 6]
+    assert series["self"] == [3, 7, 5]
+    assert series["intents"] == [1, 1, 1]
+    assert series["calls"] == [2, 2, 2]
+
+    assert index.series("B", from_tick=2, to_tick=2)["self"] == [3]
+    assert index.series(TICK_KEY)["self"] == [4, 0, 2]
+    with pytest.raises(KeyError):
+        index.series("C")
+
+
+def test_top_keys():
+    index = CostIndex.from_ticks([make_tick(1, 4), make_tick(2, 8), make_tick(3, 6)])
+
+    top = index.top(2)
+    assert [entry["key"] for entry in top] == ["A", "B"]
+    assert top[0]["mean"] == 5
+    assert top[0]["max"] == 7
+    assert top[0]["p95"] == pytest.approx(np.percentile([3, 7, 5], 95))
+
+    top = index.top(1, by="p95", metric="total", from_tick=2)
+    assert [(entry["key"], entry["ticks"]) for entry in top] == [(TICK_KEY, 2)]
+    assert index.top(from_tick=10) == []
+    with pytest.raises(ValueError):
+        index.top(-1)
+
+
+def test_stacks_index():
+    index = CostIndex.from_ticks([make_tick(1, 4)], stacks=True)
+    top = index.top(10, stacks=True)
+    assert {entry["key"]: entry["mean"] for entry in top} == {
+        "Tick": 4,
+        "Tick;A": 2,
+        "Tick;A;A": 1,
+        "Tick;A;A;B": 1,
+        "Tick;B": 2,
+    }
+
+    with pytest.raises(ValueError):
+        CostIndex.from_ticks([make_tick(1, 4)]).top(stacks=True)
+
+
+def test_nested_in_same_key():
+    # A(A(B), B), A
+    key_id = np.array([0, 0, 1, 1, 0])
+    subtree_end = np.array([4, 3, 3, 4, 5])
+    assert nested_in_same_key(key_id, subtree_end).tolist() == [
+        False,
+        True,
+        False,
+        False,
+        False,
+    ]
+
+
+def test_grouped_percentile_matches_numpy():
+    data = SyntheticHistoryGenerator(seed=4).generate_json(ticks=40)
+    index = CostIndex.from_ticks(RawProfilingHistory.from_json(data).decompress())
+    columns = index.functions.columns()
+    tick_count = index.tick_count()
+    length = len(index.functions.keys)
+
+    dense = np.zeros((tick_count, length))
+    ticks = sorted(set(columns["tick"].tolist()))
+    rows = np.searchsorted(ticks, columns["tick"])
+    dense[rows, columns["key"]] = columns["self"]
+
+    percentiles = grouped_percentile(
+        columns["key"], columns["self"], length, tick_count, 0.95
+    )
+    assert np.allclose(percentiles, np.percentile(dense, 95, axis=0))
+
+
+def test_raw_ticks_index_like_decompressed():
+    data = SyntheticHistoryGenerator(seed=5).generate_json(ticks=5)
+    raw = RawProfilingHistory.from_json(data)
+    from_raw = CostIndex(stacks=True)
+    assert from_raw.add_raw_ticks((raw, tick) for tick in raw.ticks) == 5
+    index = CostIndex.from_ticks(raw.decompress(), stacks=True)
+    assert from_raw.top(5) == index.top(5)
+    assert from_raw.top(5, stacks=True) == index.top(5, stacks=True)
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import sys
+
+import httpx
+import pytest
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.config import AppConfig, ServerConfig
+from src.fetch_history import (
+    CompressedProfilingHistory,
+    RawProfilingHistory,
+    decompress_history,
+    fetch_shard_histories_async,
+)
+from src.screeps_client import ScreepsClient
+from tests.test_screeps_client import encode_memory_data
+
+
+def test_raw_history_matches_validated():
+    data = SyntheticHistoryGenerator(seed=3).generate_json(ticks=10, max_history=15)
+
+    expected = decompress_history(CompressedProfilingHistory.model_validate_json(data))
+    history = RawProfilingHistory.from_json(data)
+
+    # The null slots of the ring buffer are skipped
+    assert len(history.ticks) == 10
+    assert history.decompress() == expected
+    assert [history.tick_key(tick) for tick in history.ticks] == [
+        node.key for node in expected
+    ]
+
+
+def test_raw_history_deep_tree():
+    depth = 5000
+    node = [1, depth, 1, 0, []]
+    for i in range(depth - 1, -1, -1):
+        node = [1, i, depth - i + 1, 0, [node]]
+    history = {
+        "version": 2,
+        "keyMap": {"maxID": 2, "map": {"Tick 1": 0, "A:run": 1}},
+        "ticks": [{"t": 1, "m": [], "d": [0, 0, depth + 2, 0, [node]]}, None],
+    }
+
+    (tick,) = RawProfilingHistory.from_obj(history).decompress()
+    for _ in range(depth + 1):
+        (tick,) = tick.children
+    assert tick.key == "A:run"
+    assert tick.start == depth
+
+
+@pytest.mark.parametrize(
+    "history",
+    [
+        [],
+        {"version": 1, "keyMap": {"maxID": 0, "map": {}}, "ticks": []},
+        {"version": 2, "ticks": []},
+        {"version": 2, "keyMap": {"maxID": 0, "map": {}}, "ticks": [{"t": 1}]},
+        {
+            "version": 2,
+            "keyMap": {"maxID": 1, "map": {"Tick 1": 0}},
+            "ticks": [{"t": 1, "m": [], "d": [0, 0, 1, 0, [[5, 0, 1, 0, []]]]}],
+        },
+        {
+            "version": 2,
+            "keyMap": {"maxID": 1, "map": {"Tick 1": 0}},
+            "ticks": [{"t": 1, "m": [], "d": [0, 0, 1, 0, [[0, 0]]]}],
+        },
+        {
+            "version": 2,
+            "keyMap": {"maxID": 1, "map": {"Tick 1": 0}},
+            "ticks": [{"t": 1, "m": [], "d": [0, 0, 1, 0, [[0, None, 1, 0, []]]]}],
+        },
+        {
+            "version": 2,
+            "keyMap": {"maxID": 1, "map": {"Tick 1": 0}},
+            "ticks": [{"t": 1, "m": [], "d": [0, 0, 1, 0, [[0, 0, [], 0, []]]]}],
+        },
+    ],
+)
+def test_raw_history_invalid(history):
+    with pytest.raises(ValueError):
+        RawProfilingHistory.from_json(json.dumps(history)).decompress()
+
+
+def test_fetch_every_shard():
+    def handler(request: httpx.Request) -> httpx.Response:
+        shard = request.url.params["shard"]
+        if shard == "shard2":
+            return httpx.Response(500)
+        first_tick = {"shard0": 100, "shard1": 200}[shard]
+        history = SyntheticHistoryGenerator(seed=2).generate_json(
+            ticks=2, first_tick=first_tick
+        )
+        return httpx.Response(200, json={"ok": 1, "data": encode_memory_data(history)})
+
+    server_cfg = ServerConfig(
+        name="main", host="screeps.com", token="abc", shards=["shard1", "shard2"]
+    )
+    assert server_cfg.get_shards() == ["shard0", "shard1", "shard2"]
+    cfg = AppConfig(servers=[server_cfg], banan_history_key="BANAN")
+    client = ScreepsClient(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+    # A failing shard is left out rather than failing the others
+    histories = asyncio.run(fetch_shard_histories_async(cfg, "main", client))
+    assert list(histories) == ["shard0", "shard1"]
+    for shard, history in histories.items():
+        assert history.shard == shard
+        assert {tick.shard for tick in history.decompress()} == {shard}
+    assert histories["shard1"].decompress()[0].key == "Tick 200"
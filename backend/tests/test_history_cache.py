@@ -0,0 +1,89 @@
+import asyncio
+import sys
+
+import pytest
+
+sys.path.append(".")
+from src.history_cache import HistoryCache
+
+
+class FakeLoader:
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.calls = []
+        self.fail = False
+
+    async def __call__(self, server_name: str) -> str:
+        self.calls.append(server_name)
+        call_number = len(self.calls)
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ValueError("Screeps is down")
+        return f"{server_name}:{call_number}"
+
+
+def test_concurrent_gets_share_one_fetch():
+    loader = FakeLoader()
+    cache = HistoryCache(loader, ttl=60)
+
+    async def run():
+        results = await asyncio.gather(
+            *[cache.get("main") for _ in range(5)], cache.get("pserver")
+        )
+        assert results == ["main:1"] * 5 + ["pserver:2"]
+
+        # Served from the cache now
+        assert await cache.get("main") == "main:1"
+
+    asyncio.run(run())
+    assert loader.calls == ["main", "pserver"]
+    assert cache.hits == 1
+    assert not cache.in_flight
+
+
+def test_stale_entries_are_refetched():
+    loader = FakeLoader()
+    cache = HistoryCache(loader, ttl=0)
+
+    async def run():
+        assert await cache.get("main") == "main:1"
+        assert await cache.get("main", max_age=60) == "main:1"
+        assert await cache.get("main") == "main:2"
+        # The scheduler warming the cache always fetches
+        assert await cache.refresh("main") == "main:3"
+
+    asyncio.run(run())
+
+
+def test_errors_reach_every_waiter_and_are_not_cached():
+    loader = FakeLoader()
+    loader.fail = True
+    cache = HistoryCache(loader, ttl=60)
+
+    async def run():
+        results = await asyncio.gather(
+            cache.get("main"), cache.get("main"), return_exceptions=True
+        )
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(loader.calls) == 1
+
+        loader.fail = False
+        assert await cache.get("main") == "main:2"
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_cancel_fetch():
+    loader = FakeLoader(delay=0.05)
+    cache = HistoryCache(loader, ttl=60)
+
+    async def run():
+        impatient = asyncio.ensure_future(cache.get("main"))
+        patient = asyncio.ensure_future(cache.get("main"))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        assert await patient == "main:1"
+        with pytest.raises(asyncio.CancelledError):
+            await impatient
+
+    asyncio.run(run())
@@ -0,0 +1,96 @@
+import sys
+
+import pytest
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.fetch_history import RawProfilingHistory
+from src.history_query import OTHER_KEY, HistoryQuery
+from src.tick_tree import TickTree
+
+
+def make_history() -> RawProfilingHistory:
+    data = SyntheticHistoryGenerator(seed=6).generate_json(
+        ticks=10, max_history=12, first_tick=100
+    )
+    return RawProfilingHistory.from_json(data)
+
+
+def select_keys(history: RawProfilingHistory, query: HistoryQuery):
+    ticks = query.select((history, tick) for tick in history.ticks)
+    return [history.tick_key(tick) for history, tick in ticks]
+
+
+def test_select_ticks():
+    history = make_history()
+    assert select_keys(history, HistoryQuery()) == [
+        f"Tick {i}" for i in range(100, 110)
+    ]
+    assert select_keys(history, HistoryQuery(from_tick=103, to_tick=104)) == [
+        "Tick 103",
+        "Tick 104",
+    ]
+    assert select_keys(history, HistoryQuery(last=2)) == ["Tick 108", "Tick 109"]
+    assert select_keys(history, HistoryQuery(last=0)) == []
+
+    # The synthetic ticks are 3 seconds apart
+    query = HistoryQuery(from_time=1700000003000, to_time=1700000006000)
+    assert select_keys(history, query) == ["Tick 101", "Tick 102"]
+
+    with pytest.raises(ValueError):
+        HistoryQuery(last=-1)
+
+
+def test_max_depth():
+    history = make_history()
+    full_depth = TickTree.from_raw_tick(history, history.ticks[0]).depths().max()
+    assert full_depth > 2
+
+    ticks = HistoryQuery(max_depth=2).select((history, t) for t in history.ticks)
+    assert len(ticks) == 10
+    originals = sorted(history.ticks, key=lambda tick: tick["t"])
+    for (pruned, tick), original in zip(ticks, originals):
+        tree = TickTree.from_raw_tick(pruned, tick)
+        assert tree.depths().max() <= 2
+        assert tree.cpu[0] == original["d"][2]
+
+    # The history, which may be cached, isn't changed
+    assert OTHER_KEY not in history.keys.values()
+    assert (
+        TickTree.from_raw_tick(history, history.ticks[0]).depths().max() == full_depth
+    )
+
+
+def test_fold_small_calls():
+    history = RawProfilingHistory(
+        {0: "Tick 1", 1: "A", 2: "B", 3: "C"},
+        [
+            {
+                "t": 1,
+                "m": [],
+                "d": [
+                    0,
+                    0,
+                    10,
+                    3,
+                    [
+                        [1, 0, 6, 1, [[3, 0, 0.5, 0, []]]],
+                        [2, 6, 0.5, 1, []],
+                        [3, 7, 1, 1, []],
+                        [1, 8, 2, 0, []],
+                    ],
+                ],
+            }
+        ],
+    )
+    query = HistoryQuery(min_cpu=2)
+    [(pruned, tick)] = query.select([(history, history.ticks[0])])
+    node = pruned.decompress_tick(tick)
+
+    # The "other" node is in start order with the calls which weren't folded
+    assert [child.key for child in node.children] == ["A", OTHER_KEY, "A"]
+    assert node.has_ordered_children()
+    other = node.children[1]
+    assert (other.start, other.cpu, other.intents) == (6, 1.5, 2)
+    # Folding applies at every level
+    assert [child.key for child in node.children[0].children] == [OTHER_KEY]
@@ -0,0 +1,56 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.archive import TickArchive
+from src.fetch_history import RawProfilingHistory
+from src.ingest import ingest_history
+
+
+def test_ingest_only_new_ticks(monkeypatch):
+    generator = SyntheticHistoryGenerator(seed=11)
+    first = generator.generate(ticks=5, max_history=5, first_tick=100)
+    expected = RawProfilingHistory.from_obj(first, shard="shard0").decompress()
+
+    def no_decompress(*args):
+        raise AssertionError("Ingest shouldn't decompress any ticks")
+
+    monkeypatch.setattr(RawProfilingHistory, "decompress_tick", no_decompress)
+
+    archive = TickArchive(":memory:")
+    result = ingest_history(
+        archive, "main", "shard0", RawProfilingHistory.from_obj(first)
+    )
+    assert len(result.new_ticks) == 5
+    assert result.skipped == 0
+
+    # The ring buffer wraps around, replacing the two oldest ticks
+    second = generator.generate(ticks=7, max_history=5, first_tick=100)
+    result = ingest_history(
+        archive, "main", "shard0", RawProfilingHistory.from_obj(second)
+    )
+    assert [tick["t"] for tick in result.new_ticks] == [
+        tick["t"] for tick in second["ticks"][:2]
+    ]
+    assert result.skipped == 3
+
+    monkeypatch.undo()
+    stored = archive.get_ticks("main", "shard0")
+    assert stored[:5] == expected
+    assert [tick.key for tick in stored] == [f"Tick {i}" for i in range(100, 107)]
+    assert len(archive.get_unpushed_ticks("main", "shard0")) == 7
+
+
+def test_concurrent_ingests_report_each_tick_once():
+    data = SyntheticHistoryGenerator(seed=12).generate(ticks=20, first_tick=100)
+    archive = TickArchive(":memory:")
+
+    def ingest(_):
+        history = RawProfilingHistory.from_obj(data, shard="shard0")
+        return ingest_history(archive, "main", "shard0", history).new_ticks
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(ingest, range(4)))
+    new_ticks = [tick["t"] for ticks in results for tick in ticks]
+    assert sorted(new_ticks) == sorted(tick["t"] for tick in data["ticks"])
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import sys
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.archive import TickArchive
+from src.fetch_history import RawProfilingHistory
+from src.live_tail import KEEPALIVE, LiveTail
+
+
+def make_ticks(first_tick: int, ticks: int):
+    data = SyntheticHistoryGenerator(seed=4).generate_json(
+        ticks=ticks, first_tick=first_tick
+    )
+    ticks = RawProfilingHistory.from_json(data, shard="shard0").decompress()
+    # In tick order, rather than ring buffer order
+    return sorted(ticks, key=lambda tick: tick.key)
+
+
+def parse_event(event: str):
+    fields = dict(line.split(": ", 1) for line in event.strip().split("\n"))
+    assert fields["event"] == "tick"
+    tick = json.loads(fields["data"])
+    assert tick["key"] == f"Tick {fields['id']}"
+    return int(fields["id"])
+
+
+def test_new_ticks_are_streamed():
+    archive = TickArchive(":memory:")
+    tail = LiveTail(archive, keepalive=0.05)
+    ticks = make_ticks(100, 3)
+
+    async def run():
+        stream = tail.stream("main", "shard0")
+        first = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.01)
+        assert len(tail) == 1
+
+        # Other shards aren't streamed
+        tail.publish("main", "shard1", make_ticks(200, 1))
+        archive.add_ticks("main", "shard0", ticks)
+        tail.publish("main", "shard0", ticks[::-1])
+
+        events = [await first] + [await stream.__anext__() for _ in range(2)]
+        assert [parse_event(event) for event in events] == [100, 101, 102]
+        assert await stream.__anext__() == KEEPALIVE
+
+        await stream.aclose()
+        assert len(tail) == 0
+
+    asyncio.run(run())
+
+
+def test_stream_resumes_from_archive():
+    archive = TickArchive(":memory:")
+    tail = LiveTail(archive, backlog_chunk=2)
+    ticks = make_ticks(100, 5)
+    archive.add_ticks("main", "shard0", ticks[:4])
+
+    async def run():
+        stream = tail.stream("main", "shard0", after=100)
+        events = [await stream.__anext__() for _ in range(3)]
+
+        # Ticks already read from the archive aren't sent again
+        archive.add_ticks("main", "shard0", ticks[4:])
+        tail.publish("main", "shard0", ticks[3:])
+        events.append(await stream.__anext__())
+        await stream.aclose()
+        return [parse_event(event) for event in events]
+
+    assert asyncio.run(run()) == [101, 102, 103, 104]
+
+
+def test_slow_client_catches_up_from_archive():
+    archive = TickArchive(":memory:")
+    tail = LiveTail(archive, max_queued=2, backlog_chunk=2)
+    ticks = make_ticks(100, 7)
+
+    async def run():
+        stream = tail.stream("main", "shard0")
+        first = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.01)
+
+        archive.add_ticks("main", "shard0", ticks[:5])
+        tail.publish("main", "shard0", ticks[:5])
+        (subscription,) = tail.subscriptions[("main", "shard0")]
+        assert subscription.overflowed
+        assert subscription.queue.qsize() == 2
+
+        events = [await first] + [await stream.__anext__() for _ in range(4)]
+        archive.add_ticks("main", "shard0", ticks[5:])
+        tail.publish("main", "shard0", ticks[5:])
+        events += [await stream.__anext__() for _ in range(2)]
+        await stream.aclose()
+        return [parse_event(event) for event in events]
+
+    assert asyncio.run(run()) == list(range(100, 107))
+    assert tail.resyncs == 1
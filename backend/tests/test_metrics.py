@@ -0,0 +1,75 @@
+import sys
+import time
+
+import pytest
+
+sys.path.append(".")
+from src.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    ticks = registry.counter("ticks_total", "Ticks seen.", ["server", "result"])
+    lag = registry.gauge("lag_seconds", "Scheduler lag.")
+    registry.callback("hits_total", "Cache hits.", "counter", lambda: 7)
+
+    ticks.inc(3, server="main", result="ingested")
+    ticks.inc(server="main", result="ingested")
+    ticks.inc(2, server='a "b"\n', result="skipped")
+    lag.set(0.25)
+
+    assert registry.render() == (
+        "# HELP ticks_total Ticks seen.\n"
+        "# TYPE ticks_total counter\n"
+        'ticks_total{server="a \\"b\\"\\n",result="skipped"} 2\n'
+        'ticks_total{server="main",result="ingested"} 4\n'
+        "# HELP lag_seconds Scheduler lag.\n"
+        "# TYPE lag_seconds gauge\n"
+        "lag_seconds 0.25\n"
+        "# HELP hits_total Cache hits.\n"
+        "# TYPE hits_total counter\n"
+        "hits_total 7\n"
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("stage_seconds", "Stages.", ["stage"], buckets=[0.1, 1])
+    for value in [0.05, 0.1, 0.5, 2]:
+        histogram.observe(value, stage="fetch")
+
+    assert histogram.render()[2:] == [
+        'stage_seconds_bucket{stage="fetch",le="0.1"} 2',
+        'stage_seconds_bucket{stage="fetch",le="1"} 3',
+        'stage_seconds_bucket{stage="fetch",le="+Inf"} 4',
+        'stage_seconds_sum{stage="fetch"} 2.65',
+        'stage_seconds_count{stage="fetch"} 4',
+    ]
+
+
+def test_timer_observes_even_on_error():
+    histogram = Histogram("stage_seconds", "Stages.", ["stage"])
+    with histogram.time(stage="push"):
+        time.sleep(0.01)
+    with pytest.raises(ValueError):
+        with histogram.time(stage="push"):
+            raise ValueError()
+
+    assert histogram.count(stage="push") == 2
+    assert histogram.values[("push",)][-1] >= 0.01
+
+
+def test_labels_must_match():
+    counter = Counter("ticks_total", "Ticks seen.", ["server"])
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(server="main", shard="shard0")
+    with pytest.raises(ValueError):
+        counter.inc(-1, server="main")
+    with pytest.raises(ValueError):
+        Gauge("lag", "Lag.").set(1, server="main")
+
+    registry = MetricsRegistry()
+    registry.register(counter)
+    with pytest.raises(ValueError):
+        registry.register(counter)
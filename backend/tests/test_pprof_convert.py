@@ -1,6 +1,7 @@
 import json
-import sys
 import os
+import random
+import sys
 
 import pytest
 
@@ -10,7 +11,12 @@ from src.fetch_history import (
     CompressedProfilingHistory,
     decompress_history,
 )
-from src.pprof_convert import TimelineConverter, TimelineStackTrace, PprofConverter
+from src.pprof_convert import (
+    PprofConverter,
+    TimelineConverter,
+    TimelineStackTrace,
+    ms_to_ns,
+)
 
 
 # @pytest.fixture
@@ -38,6 +44,78 @@ def test_timeline_convert():
     assert len(stack_traces)
 
 
+def make_random_tick(rng: random.Random, ordered: bool = True) -> ProfilingNode:
+    """Build a random call tree, with touching and zero cpu children."""
+
+    def make_children(start: float, end: float, depth: int):
+        children = []
+        time = start
+        while depth < 5 and rng.random() < 0.8:
+            time += rng.choice([0, 0, rng.random() * (end - start) / 3])
+            cpu = rng.choice([0, round(rng.random() * (end - start) / 2, 4)])
+            if time + cpu > end:
+                break
+            children.append(
+                ProfilingNode(
+                    key=f"K{rng.randint(0, 8)}",
+                    start=time,
+                    cpu=cpu,
+                    intents=0,
+                    children=make_children(time, time + cpu, depth + 1),
+                )
+            )
+            time += cpu
+        if not ordered:
+            rng.shuffle(children)
+        return children
+
+    return ProfilingNode(
+        key="Tick 1", start=0, cpu=20, intents=0, children=make_children(0, 20, 0)
+    )
+
+
+def linear_search_by_time(node: ProfilingNode, search_time: float, call_stack):
+    """The original unindexed search, kept as a reference."""
+    call_stack.append(node.key)
+    if search_time < node.start or search_time > node.get_end_time():
+        return None, call_stack
+    if not node.children:
+        return node, call_stack
+    for child in node.children:
+        (target, _) = linear_search_by_time(child, search_time, call_stack)
+        if target:
+            return target, call_stack
+        else:
+            call_stack.pop()
+    return node, call_stack
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_indexed_search_matches_linear(ordered):
+    rng = random.Random(1234)
+    for _ in range(20):
+        tick = make_random_tick(rng, ordered)
+        for i in range(2100):
+            search_time = i * 0.01
+            expected_node, expected_stack = linear_search_by_time(
+                tick, search_time, []
+            )
+            node, stack = tick.search_by_time(search_time, [])
+            assert node is expected_node
+            assert stack == expected_stack
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_timeline_iter_traces_matches_convert(ordered):
+    rng = random.Random(5678)
+    for _ in range(20):
+        tick = make_random_tick(rng, ordered)
+        expected = TimelineConverter().convert(tick)
+        traces = TimelineConverter().iter_traces(tick)
+        assert not isinstance(traces, list)
+        assert list(traces) == expected
+
+
 def test_pprof_convert():
     child_a = ProfilingNode(key="A", start=1.0, cpu=10, intents=0, children=[])
     child_b = ProfilingNode(key="B", start=20, cpu=5, intents=0, children=[])
@@ -56,3 +134,65 @@ def test_pprof_convert():
 
     serialized_protobuf = PprofConverter().convert_to_pprof_bytes(example_tick)
     assert len(serialized_protobuf)
+
+    timeline_protobuf = PprofConverter(exact=False).convert_to_pprof_bytes(example_tick)
+    assert len(timeline_protobuf)
+
+
+def test_pprof_convert_exact():
+    grandchild = ProfilingNode(key="C", start=2.0, cpu=3.25, intents=0, children=[])
+    child_a = ProfilingNode(
+        key="A", start=1.0, cpu=10, intents=0, children=[grandchild]
+    )
+    child_a_again = ProfilingNode(key="A", start=12, cpu=0.05, intents=0, children=[])
+    child_b = ProfilingNode(key="B", start=20, cpu=5, intents=0, children=[])
+    example_tick = ProfilingNode(
+        key="Tick 100",
+        start=0,
+        cpu=40,
+        intents=0,
+        children=[child_a, child_a_again, child_b],
+    )
+
+    converter = PprofConverter()
+    profile = converter.convert_to_pprof_format(example_tick)
+
+    def stack_keys(sample):
+        return tuple(
+            profile.string_table[converter.function_map[lid].name]
+            for lid in sample.location_id
+        )
+
+    samples = {stack_keys(sample): sample.value for sample in profile.sample}
+
+    # One sample per unique stack, leaf first, with exact self cost
+    assert len(profile.sample) == 4
+    assert samples[("Tick 100",)] == [ms_to_ns(40 - 10 - 0.05 - 5), 1]
+    assert samples[("A", "Tick 100")] == [ms_to_ns(10 - 3.25 + 0.05), 2]
+    assert samples[("C", "A", "Tick 100")] == [ms_to_ns(3.25), 1]
+    assert samples[("B", "Tick 100")] == [ms_to_ns(5), 1]
+
+    total = sum(sample.value[0] for sample in profile.sample)
+    assert abs(total - ms_to_ns(40)) <= len(profile.sample)
+
+
+def test_pprof_converter_reuse():
+    example_tick = ProfilingNode(
+        key="Tick 100", start=0, cpu=40, intents=0, children=[]
+    )
+
+    def sample_types(profile):
+        return [
+            (profile.string_table[t.type], profile.string_table[t.unit])
+            for t in profile.sample_type
+        ]
+
+    converter = PprofConverter()
+    first = converter.convert_to_pprof_format(example_tick)
+    second = converter.convert_to_pprof_format(example_tick)
+    assert second.string_table.count("") == 1
+    assert sample_types(second) == [("cpu", "nanoseconds"), ("calls", "count")]
+    assert second.sample == first.sample
+
+    timeline = PprofConverter(exact=False).convert_to_pprof_format(example_tick)
+    assert sample_types(timeline)[1] == ("samples", "count")
@@ -0,0 +1,47 @@
+import gzip
+import sys
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.fetch_history import RawProfilingHistory
+from src.pprof_convert import PprofConverter
+from src.pprof_encode import encode_pprof, iter_pprof_bytes
+from src.protogen.orig import pprof_pb2
+
+
+def make_profile():
+    data = SyntheticHistoryGenerator(seed=5).generate_json(ticks=4)
+    ticks = RawProfilingHistory.from_json(data).decompress()
+    return PprofConverter().convert_ticks_to_pprof_format(ticks)
+
+
+def test_encode_matches_protobuf():
+    profile = make_profile()
+    encoded = encode_pprof(profile)
+
+    # Same as the old round trip through the Google protobuf code
+    expected = pprof_pb2.Profile()
+    expected.ParseFromString(bytes(profile))
+    expected.string_table.insert(0, "")
+
+    parsed = pprof_pb2.Profile()
+    parsed.ParseFromString(encoded)
+    assert parsed == expected
+    assert parsed.string_table[0] == ""
+    assert list(parsed.string_table) == profile.string_table
+
+
+def test_encode_negative_and_gzip():
+    profile = make_profile()
+    profile.sample[0].value[0] = -5
+
+    parsed = pprof_pb2.Profile()
+    parsed.ParseFromString(gzip.decompress(encode_pprof(profile, compress=True)))
+    assert parsed.sample[0].value[0] == -5
+
+
+def test_encode_in_chunks():
+    profile = make_profile()
+    chunks = list(iter_pprof_bytes(profile, chunk_size=256))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == encode_pprof(profile)
@@ -0,0 +1,123 @@
+import asyncio
+import sys
+
+import httpx
+import pytest
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.archive import TickArchive
+from src.fetch_history import RawProfilingHistory
+from src.pyroscope_export import PyroscopeExporter
+from src.tree_cache import TreeCache
+
+
+@pytest.fixture
+def history():
+    data = SyntheticHistoryGenerator(seed=3).generate_json(ticks=5, first_tick=100)
+    return RawProfilingHistory.from_json(data, shard="shard0").decompress()
+
+
+@pytest.fixture
+def archive(history):
+    archive = TickArchive(":memory:")
+    archive.add_ticks("main", "shard0", history)
+    yield archive
+    archive.close()
+
+
+class FakePyroscope:
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        status = self.statuses.pop(0) if self.statuses else 200
+        return httpx.Response(status)
+
+
+def make_exporter(archive, pyroscope, **kwargs):
+    http = httpx.AsyncClient(transport=httpx.MockTransport(pyroscope))
+    return PyroscopeExporter(
+        "http://pyroscope", archive, backoff=0, http=http, **kwargs
+    )
+
+
+def test_pushes_one_profile_per_batch(archive, history):
+    pyroscope = FakePyroscope()
+    exporter = make_exporter(archive, pyroscope, batch_size=2)
+    exporter.enqueue("main", "shard0", history)
+    asyncio.run(exporter.flush())
+
+    assert len(pyroscope.requests) == 3
+    params = pyroscope.requests[0].url.params
+    assert params["name"] == "screeps-main{shard=shard0}"
+    assert params["format"] == "pprof"
+    assert int(params["from"]) < int(params["until"])
+
+    assert not exporter.pending
+    assert exporter.exported_ticks == 5
+    assert archive.pushed_tick_keys("main", "shard0") == {t.key for t in history}
+
+
+def test_retries_then_keeps_batch_queued(archive, history):
+    pyroscope = FakePyroscope([503, 503, 503])
+    exporter = make_exporter(archive, pyroscope, batch_size=5, retries=3)
+    exporter.enqueue("main", "shard0", history)
+
+    asyncio.run(exporter.flush())
+    assert len(pyroscope.requests) == 3
+    assert len(exporter.pending) == 1
+    assert archive.pushed_tick_keys("main", "shard0") == set()
+
+    # Pyroscope has recovered by the next flush
+    asyncio.run(exporter.flush())
+    assert len(pyroscope.requests) == 4
+    assert not exporter.pending
+    assert exporter.failed_attempts == 3
+    assert len(archive.pushed_tick_keys("main", "shard0")) == 5
+
+
+def test_rejected_batch_is_dropped(archive, history):
+    pyroscope = FakePyroscope([400])
+    exporter = make_exporter(archive, pyroscope, batch_size=5)
+    exporter.enqueue("main", "shard0", history)
+    asyncio.run(exporter.flush())
+
+    assert len(pyroscope.requests) == 1
+    assert not exporter.pending
+    assert exporter.dropped_ticks == 5
+
+
+def test_queue_is_bounded(archive, history):
+    exporter = make_exporter(archive, FakePyroscope(), batch_size=1, max_batches=2)
+    exporter.enqueue("main", "shard0", history)
+
+    assert [b.tick_keys for b in exporter.pending] == [["Tick 103"], ["Tick 104"]]
+    assert exporter.dropped_ticks == 3
+
+
+def test_queued_ticks_are_not_queued_again(archive, history):
+    exporter = make_exporter(archive, FakePyroscope(), batch_size=2)
+    exporter.enqueue("main", "shard0", history)
+    exporter.enqueue("main", "shard0", history[3:])
+    assert sum(len(batch.ticks) for batch in exporter.pending) == 5
+
+    # Once pushed they can be queued again, as after a restart
+    asyncio.run(exporter.flush())
+    assert not exporter.queued
+    exporter.enqueue("main", "shard0", history[:1])
+    assert len(exporter.pending) == 1
+
+
+def test_batches_load_trees_from_the_cache(archive, history):
+    trees = TreeCache(max_nodes=100000)
+    for tick in history[:2]:
+        trees.put("main", "shard0", tick)
+
+    exporter = make_exporter(archive, FakePyroscope(), batch_size=5, trees=trees)
+    exporter.enqueue("main", "shard0", history)
+    [batch] = exporter.pending
+    assert exporter.load_ticks(batch) == history
+    assert (trees.hits, trees.misses) == (2, 3)
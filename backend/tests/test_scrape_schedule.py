@@ -0,0 +1,135 @@
+import asyncio
+import sys
+
+import httpx
+import pytest
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.config import ServerConfig
+from src.fetch_history import RawProfilingHistory
+from src.metrics import LOST_TICKS
+from src.scrape_schedule import ScrapeSchedule
+from src.scraper import Scraper
+from src.screeps_client import RateLimit
+
+# Synthetic ticks are recorded 3s apart, from this unix time
+T0 = 1_700_000_000
+
+
+def make_history(first_tick: int, ticks: int, max_history: int = 10):
+    obj = SyntheticHistoryGenerator(seed=1).generate(
+        ticks=ticks, max_history=max_history, first_tick=first_tick
+    )
+    return RawProfilingHistory.from_obj(obj)
+
+
+def make_schedule(servers, rate_limits=None, safety=0.25):
+    return ScrapeSchedule(
+        servers,
+        lambda name: (rate_limits or {}).get(name, []),
+        default_interval=30,
+        min_interval=5,
+        max_interval=600,
+        safety=safety,
+    )
+
+
+def test_scrape_is_due_before_history_wraps():
+    server_cfg = ServerConfig(name="fast", host="localhost")
+    schedule = make_schedule([server_cfg])
+    assert schedule.is_due("fast", now=0)
+
+    # Ten ticks of history, 3s a tick, so it wraps 30s after the newest
+    # tick, which was at T0 + 27
+    history = make_history(first_tick=100, ticks=10)
+    assert history.capacity == 10
+    schedule.observe(server_cfg, {"shard0": history}, now=T0 + 30)
+    assert schedule.shards[("fast", "shard0")].seconds_per_tick == 3
+    assert schedule.next_due["fast"] == pytest.approx(T0 + 27 + 22.5)
+    assert not schedule.is_due("fast", now=T0 + 49)
+    assert schedule.is_due("fast", now=T0 + 50)
+
+
+def test_lost_ticks_are_counted():
+    server_cfg = ServerConfig(name="lossy", host="localhost")
+    schedule = make_schedule([server_cfg])
+    schedule.observe(server_cfg, {"shard0": make_history(100, 10)}, now=T0 + 30)
+    # Ticks 110 to 114 were overwritten before this fetch
+    schedule.observe(server_cfg, {"shard0": make_history(100, 25)}, now=T0 + 75)
+    assert LOST_TICKS.get(server="lossy", shard="shard0") == 5
+
+
+def test_slow_server_waits_at_most_max_interval():
+    server_cfg = ServerConfig(name="slow", host="localhost")
+    schedule = make_schedule([server_cfg])
+    history = make_history(first_tick=100, ticks=10, max_history=1000)
+    schedule.observe(server_cfg, {"shard0": history}, now=T0 + 30)
+    assert schedule.next_due["slow"] == T0 + 30 + 600
+
+
+def test_request_budget_spaces_scrapes():
+    server_cfg = ServerConfig(
+        name="budget",
+        host="localhost",
+        shards=["shard1"],
+        history_segments=[1, 2],
+        max_requests_per_hour=360,
+    )
+    schedule = make_schedule([server_cfg])
+    history = make_history(first_tick=100, ticks=10)
+    now = T0 + 30
+    schedule.observe(server_cfg, {"shard0": history, "shard1": history}, now=now)
+    # The history would allow 19.5s, but four requests a scrape at 360 an
+    # hour is one scrape every 40s
+    assert schedule.next_due["budget"] == now + 40
+
+    # Screeps allows 8 more requests in the next 60s, so two more scrapes
+    rate_limits = {"budget": [RateLimit(limit=100, remaining=8, reset_at=now + 60)]}
+    server_cfg.max_requests_per_hour = None
+    schedule = make_schedule([server_cfg], rate_limits)
+    schedule.observe(server_cfg, {"shard0": history}, now=now)
+    assert schedule.next_due["budget"] == now + 30
+
+    rate_limits["budget"][0].remaining = 0
+    schedule.scraped("budget", now=now)
+    assert schedule.next_due["budget"] == now + 60
+
+
+def test_rate_limit_from_headers():
+    headers = httpx.Headers(
+        {
+            "X-RateLimit-Limit": "1440",
+            "X-RateLimit-Remaining": "1000",
+            "X-RateLimit-Reset": "1700000000",
+        }
+    )
+    rate_limit = RateLimit.from_headers(headers)
+    assert (rate_limit.limit, rate_limit.remaining) == (1440, 1000)
+    assert rate_limit.reset_at == 1700000000
+    assert RateLimit.from_headers(httpx.Headers()) is None
+
+
+def test_scraper_only_scrapes_due_servers():
+    servers = [ServerConfig(name=name, host="localhost") for name in ["a", "b"]]
+    schedule = make_schedule(servers)
+    scraped = []
+
+    async def scrape(server_cfg: ServerConfig):
+        scraped.append(server_cfg.name)
+        if server_cfg.name == "a":
+            schedule.observe(server_cfg, {"shard0": make_history(100, 10)})
+
+    scraper = Scraper(
+        servers, scrape, max_workers=2, timeout=1, interval=1, schedule=schedule
+    )
+
+    async def run():
+        await scraper.scrape_all()
+        await asyncio.sleep(0)
+        # Both are rescheduled, so neither is due again straight away
+        await scraper.scrape_all()
+
+    asyncio.run(run())
+    assert sorted(scraped) == ["a", "b"]
+    assert set(schedule.next_due) == {"a", "b"}
@@ -0,0 +1,66 @@
+import asyncio
+import sys
+
+sys.path.append(".")
+from src.config import ServerConfig
+from src.scraper import Scraper
+
+
+def make_servers(*names):
+    return [ServerConfig(name=name, host="localhost") for name in names]
+
+
+class FakeScrape:
+    def __init__(self, delays):
+        self.delays = delays
+        self.active = 0
+        self.max_active = 0
+        self.started = []
+        self.finished = []
+
+    async def __call__(self, server_cfg: ServerConfig):
+        self.started.append(server_cfg.name)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delays.get(server_cfg.name, 0.05))
+            if server_cfg.name == "broken":
+                raise ValueError("Bad server")
+        finally:
+            self.active -= 1
+        self.finished.append(server_cfg.name)
+
+
+def test_scrapes_in_parallel_with_bounded_workers():
+    scrape = FakeScrape({})
+    servers = make_servers("a", "b", "c", "d", "broken")
+    scraper = Scraper(servers, scrape, max_workers=2, timeout=1, interval=30)
+
+    asyncio.run(scraper.scrape_all())
+
+    assert sorted(scrape.started) == ["a", "b", "broken", "c", "d"]
+    assert sorted(scrape.finished) == ["a", "b", "c", "d"]
+    assert scrape.max_active == 2
+    assert 0.1 < scraper.last_cycle_duration < 0.25
+    assert not scraper.running
+
+
+def test_slow_server_is_not_scraped_twice():
+    scrape = FakeScrape({"slow": 0.3})
+    servers = make_servers("fast", "slow")
+    scraper = Scraper(servers, scrape, max_workers=4, timeout=0.1, interval=30)
+
+    async def run():
+        await scraper.scrape_all()
+        assert scraper.last_cycle_duration < 0.2
+        assert list(scraper.running) == ["slow"]
+
+        # The slow scrape is still going, so only the fast server is scraped
+        await scraper.scrape_all()
+        assert scrape.started == ["fast", "slow", "fast"]
+
+        await asyncio.sleep(0.3)
+        assert not scraper.running
+        assert scrape.finished.count("slow") == 1
+
+    asyncio.run(run())
@@ -0,0 +1,144 @@
+import asyncio
+import base64
+import gzip
+import json
+import sys
+
+import httpx
+import pytest
+
+sys.path.append(".")
+from src.config import ServerConfig
+from src.screeps_client import ScreepsClient, decode_memory_data
+
+
+def encode_memory_data(value) -> str:
+    return "gz:" + base64.b64encode(gzip.compress(json.dumps(value).encode())).decode()
+
+
+def test_decode_memory_data():
+    value = json.dumps({"version": 2})
+    assert decode_memory_data({"ok": 1, "data": encode_memory_data(value)}) == value
+    assert decode_memory_data({"ok": 1, "data": value}) == value
+
+    for resp in [None, {"ok": 0}, {"ok": 1, "data": None}]:
+        with pytest.raises(ValueError):
+            decode_memory_data(resp)
+
+
+def test_get_memory_with_password():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.path == "/api/auth/signin":
+            assert json.loads(request.content) == {
+                "email": "bob@example.org",
+                "password": "hunter2",
+            }
+            return httpx.Response(200, json={"ok": 1, "token": "abc"})
+
+        assert request.url.path == "/api/user/memory"
+        assert request.url.params["path"] == "BANAN"
+        assert request.url.params["shard"] == "shard3"
+        assert request.headers["X-Token"] == "abc"
+        return httpx.Response(200, json={"ok": 1, "data": encode_memory_data("{}")})
+
+    server_cfg = ServerConfig(
+        name="pserver",
+        host="localhost:21025",
+        email="bob@example.org",
+        password="hunter2",
+        shard="shard3",
+    )
+    client = ScreepsClient(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    resp = asyncio.run(client.get_memory(server_cfg, "BANAN"))
+
+    assert decode_memory_data(resp) == "{}"
+    assert [str(request.url).split("?")[0] for request in requests] == [
+        "http://localhost:21025/api/auth/signin",
+        "http://localhost:21025/api/user/memory",
+    ]
+
+
+class FakeAuthServer:
+    """Issues numbered tokens, and accepts only the latest one."""
+
+    def __init__(self, rotate: bool = False):
+        self.rotate = rotate
+        self.sign_ins = 0
+        self.valid_tokens = set()
+        self.rotations = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/auth/signin":
+            await asyncio.sleep(0.01)
+            self.sign_ins += 1
+            token = f"token{self.sign_ins}"
+            self.valid_tokens = {token}
+            return httpx.Response(200, json={"ok": 1, "token": token})
+
+        if request.headers["X-Token"] not in self.valid_tokens:
+            return httpx.Response(401)
+        headers = {}
+        if self.rotate:
+            self.rotations += 1
+            token = f"rotated{self.rotations}"
+            self.valid_tokens.add(token)
+            headers["X-Token"] = token
+        return httpx.Response(200, json={"ok": 1, "data": "{}"}, headers=headers)
+
+
+PASSWORD_CFG = ServerConfig(
+    name="pserver", host="localhost:21025", email="bob@example.org", password="x"
+)
+
+
+def test_token_is_reused_until_rejected():
+    server = FakeAuthServer()
+    client = ScreepsClient(httpx.AsyncClient(transport=httpx.MockTransport(server)))
+
+    async def run():
+        # Concurrent requests share one sign in
+        await asyncio.gather(
+            *[client.get_memory(PASSWORD_CFG, "BANAN") for _ in range(3)]
+        )
+        assert server.sign_ins == 1
+        await client.get_memory(PASSWORD_CFG, "BANAN")
+        assert server.sign_ins == 1
+
+        # The server forgets the token, so it's replaced and the request retried
+        server.valid_tokens = set()
+        assert await client.get_memory(PASSWORD_CFG, "BANAN") == {"ok": 1, "data": "{}"}
+        assert server.sign_ins == 2
+
+    asyncio.run(run())
+
+
+def test_token_expires_and_rotates():
+    server = FakeAuthServer(rotate=True)
+    client = ScreepsClient(
+        httpx.AsyncClient(transport=httpx.MockTransport(server)), token_ttl=60
+    )
+
+    async def run():
+        await client.get_memory(PASSWORD_CFG, "BANAN")
+        await client.get_memory(PASSWORD_CFG, "BANAN")
+        # The rotated token from the last response is used next
+        assert client.sessions["pserver"].token == "rotated2"
+        assert server.sign_ins == 1
+
+        client.sessions["pserver"].expires_at = 0
+        await client.get_memory(PASSWORD_CFG, "BANAN")
+        assert server.sign_ins == 2
+
+    asyncio.run(run())
+
+
+def test_rejected_configured_token_is_an_error():
+    server = FakeAuthServer()
+    client = ScreepsClient(httpx.AsyncClient(transport=httpx.MockTransport(server)))
+    server_cfg = ServerConfig(name="main", host="screeps.com", token="nope")
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.get_memory(server_cfg, "BANAN"))
+    assert server.sign_ins == 0
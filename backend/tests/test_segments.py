@@ -0,0 +1,76 @@
+import asyncio
+import sys
+
+import httpx
+import pytest
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.config import AppConfig, ServerConfig
+from src.fetch_history import RawProfilingHistory, fetch_raw_history_async
+from src.screeps_client import ScreepsClient
+from src.segments import SEGMENT_MAX_LENGTH, reassemble_segments, split_into_segments
+
+
+def test_segments_roundtrip():
+    data = "x" * (SEGMENT_MAX_LENGTH * 2)
+    segments = split_into_segments(data, write_tick=7)
+    assert len(segments) == 3
+    assert all(len(segment) <= SEGMENT_MAX_LENGTH for segment in segments)
+    assert segments[1].startswith("BANAN:1:7:1:3:")
+
+    # Out of order, and with a segment left over from a longer history
+    stale = split_into_segments(data * 2, write_tick=3)[3]
+    values = {12: segments[2], 10: segments[0], 11: segments[1], 13: stale}
+    assert reassemble_segments(values) == data
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        {},
+        {0: "not banan"},
+        {0: "BANAN:2:7:0:1:{}"},
+        {0: "BANAN:1:x:0:1:{}"},
+        # Missing a part
+        {0: "BANAN:1:7:0:3:a", 1: "BANAN:1:7:1:3:b"},
+        # Parts of two writes
+        {0: "BANAN:1:7:0:2:a", 1: "BANAN:1:6:1:2:b"},
+        {0: "BANAN:1:7:0:2:a", 1: "BANAN:1:7:0:2:a"},
+    ],
+)
+def test_segments_invalid(values):
+    with pytest.raises(ValueError):
+        reassemble_segments(values)
+
+
+def test_fetch_history_from_segments():
+    data = SyntheticHistoryGenerator(seed=5).generate_json(ticks=4, first_tick=100)
+    # Split small, so the history spans a few segments
+    segments = [
+        f"BANAN:1:104:{i}:3:" + data[i * len(data) // 3 : (i + 1) * len(data) // 3]
+        for i in range(3)
+    ]
+    values = dict(zip([20, 21, 22], segments))
+    requested = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/api/user/memory-segment"
+        assert request.url.params["shard"] == "shard1"
+        segment = int(request.url.params["segment"])
+        requested.append(segment)
+        return httpx.Response(200, json={"ok": 1, "data": values.get(segment)})
+
+    server_cfg = ServerConfig(
+        name="main", host="screeps.com", token="abc", history_segments=[20, 21, 22, 23]
+    )
+    cfg = AppConfig(servers=[server_cfg], banan_history_key="BANAN")
+    client = ScreepsClient(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+    history = asyncio.run(fetch_raw_history_async(cfg, "main", client, "shard1"))
+    assert sorted(requested) == [20, 21, 22, 23]
+    assert history.shard == "shard1"
+    assert (
+        history.decompress()
+        == RawProfilingHistory.from_json(data, "shard1").decompress()
+    )
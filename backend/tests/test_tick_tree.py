@@ -0,0 +1,131 @@
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+from src.fetch_history import (
+    CompressedProfilingHistory,
+    ProfilingNode,
+    decompress_history,
+)
+from src.pprof_convert import PprofConverter
+from src.tick_tree import TickTree, decompress_history_trees
+
+
+@pytest.fixture
+def example_history() -> CompressedProfilingHistory:
+    return CompressedProfilingHistory.model_validate(
+        {
+            "version": 2,
+            "keyMap": {
+                "maxID": 5,
+                "map": {"Tick 7": 0, "A:run": 1, "B:run": 2, "C:run": 3, "D:run": 4},
+            },
+            "ticks": [
+                {
+                    "t": 1700000000000,
+                    "m": [{"shortName": "m", "fullName": "mark", "timestamp": 2}],
+                    "d": [
+                        0,
+                        0,
+                        20,
+                        3,
+                        [
+                            [1, 1, 8, 2, [[3, 2, 3, 0, []], [4, 5, 1, 2, []]]],
+                            [2, 10, 4, 1, [[3, 11, 1.5, 0, []]]],
+                        ],
+                    ],
+                }
+            ],
+        }
+    )
+
+
+def test_tick_tree_layout(example_history):
+    (tree,) = decompress_history_trees(example_history)
+
+    keys = [tree.keys[int(key_id)] for key_id in tree.key_id]
+    assert keys == ["Tick 7", "A:run", "C:run", "D:run", "B:run", "C:run"]
+    assert tree.parent.tolist() == [-1, 0, 1, 1, 0, 4]
+    assert tree.subtree_end.tolist() == [6, 4, 3, 4, 6, 6]
+    assert tree.depths().tolist() == [0, 1, 2, 2, 1, 2]
+    assert list(tree.child_indices(0)) == [1, 4]
+
+    np.testing.assert_allclose(tree.self_costs(), [8, 4, 3, 1, 2.5, 1.5])
+    np.testing.assert_allclose(tree.subtree_sums(tree.intents), [8, 4, 0, 2, 1, 0])
+
+
+def test_tick_tree_matches_profiling_node(example_history):
+    (expected,) = decompress_history(example_history)
+    (tree,) = decompress_history_trees(example_history)
+
+    assert tree.to_profiling_node() == expected
+    assert TickTree.from_profiling_node(expected).to_profiling_node() == expected
+
+    def compare(view, node: ProfilingNode):
+        assert view.key == node.key
+        assert view.start == node.start
+        assert view.cpu == node.cpu
+        assert view.intents == node.intents
+        assert view.self_cost() == pytest.approx(node.self_cost())
+        assert view.count_nodes() == node.count_nodes()
+        assert len(view.children) == len(node.children)
+        for child_view, child in zip(view.children, node.children):
+            compare(child_view, child)
+
+    compare(tree.root, expected)
+    assert tree.root.timestamp == expected.timestamp
+    assert tree.root.marks == expected.marks
+
+
+def test_tick_tree_search_by_time(example_history):
+    (expected,) = decompress_history(example_history)
+    (tree,) = decompress_history_trees(example_history)
+
+    for search_time in [0, 3, 5, 9.5, 11, 25]:
+        view, view_stack = tree.root.search_by_time(search_time, [])
+        node, stack = expected.search_by_time(search_time, [])
+        assert view_stack == stack
+        if node is None:
+            assert view is None
+        else:
+            assert (view.key, view.start) == (node.key, node.start)
+
+
+def test_tick_tree_view_pprof_convert(example_history):
+    (expected,) = decompress_history(example_history)
+    (tree,) = decompress_history_trees(example_history)
+
+    assert (
+        PprofConverter().convert_to_pprof_format(tree.root).sample
+        == PprofConverter().convert_to_pprof_format(expected).sample
+    )
+
+
+def test_tick_tree_deep():
+    depth = 5000
+    node = [1, depth, 1, 0, []]
+    for i in range(depth - 1, -1, -1):
+        node = [1, i, depth - i + 1, 0, [node]]
+
+    tree = TickTree.from_compressed({1: "A:run"}, node)
+    assert len(tree) == depth + 1
+    assert tree.depths()[-1] == depth
+    np.testing.assert_allclose(tree.self_costs(), 1)
+
+
+@pytest.mark.parametrize(
+    "node",
+    [
+        [1, 0, 1, 0],
+        [1, 0, 1, 0, [[1, 0, 1]]],
+        [1, 0, 1, 0, [None]],
+        [1, 0, 1, 0, {}],
+        [1, None, 1, 0, []],
+        [1, 0, "x", 0, []],
+    ],
+)
+def test_tick_tree_invalid(node):
+    with pytest.raises(ValueError, match="Invalid node"):
+        TickTree.from_compressed({1: "A:run"}, node)
@@ -0,0 +1,52 @@
+import sys
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.fetch_history import RawProfilingHistory
+from src.tree_cache import TreeCache
+
+
+def test_evicts_least_recently_used_by_node_count():
+    data = SyntheticHistoryGenerator(seed=0).generate_json(ticks=4)
+    raw = RawProfilingHistory.from_json(data)
+    history = raw.decompress()
+    sizes = [tick.count_nodes() for tick in history]
+
+    # Room for the first three ticks, but not all four
+    cache = TreeCache(max_nodes=sum(sizes[:3]))
+    for tick in history[:3]:
+        cache.put("main", "shard0", tick)
+    assert cache.nodes == sum(sizes[:3])
+
+    # Using the oldest tick keeps it over the second
+    assert cache.get("main", "shard0", history[0].key) is history[0]
+    assert cache.get("main", "shard1", history[0].key) is None
+    cache.put("main", "shard0", history[3])
+    assert cache.get("main", "shard0", history[1].key) is None
+    assert cache.get("main", "shard0", history[0].key) is history[0]
+    assert cache.nodes <= cache.max_nodes
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Putting a tick again replaces it
+    cache.put("main", "shard0", history[0])
+    assert cache.nodes == sum(
+        size
+        for tick, size in zip(history, sizes)
+        if cache.get("main", "shard0", tick.key)
+    )
+
+
+def test_decompress_only_once():
+    data = SyntheticHistoryGenerator(seed=0).generate_json(ticks=2)
+    raw = RawProfilingHistory.from_json(data)
+    cache = TreeCache(max_nodes=100000)
+
+    first = cache.decompress("main", "shard0", raw, raw.ticks[0])
+    assert first == raw.decompress_tick(raw.ticks[0])
+    assert cache.decompress("main", "shard0", raw, raw.ticks[0]) is first
+    assert len(cache) == 1
+
+    # A tree bigger than the whole cache isn't cached
+    small = TreeCache(max_nodes=1)
+    small.decompress("main", "shard0", raw, raw.ticks[1])
+    assert len(small) == 0
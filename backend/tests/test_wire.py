@@ -0,0 +1,54 @@
+import sys
+
+sys.path.append(".")
+from bench.synthetic import SyntheticHistoryGenerator
+from src.fetch_history import ProfilingNode, RawProfilingHistory
+from src.tick_tree import TickTree
+from src.wire import decode_history_wire, encode_history_wire
+
+
+def make_history() -> RawProfilingHistory:
+    data = SyntheticHistoryGenerator(seed=9).generate_json(ticks=8, max_history=10)
+    return RawProfilingHistory.from_json(data)
+
+
+def test_wire_roundtrip():
+    history = make_history()
+    trees = [TickTree.from_raw_tick(history, tick) for tick in history.ticks]
+
+    decoded = decode_history_wire(encode_history_wire(trees))
+    assert decoded == history.decompress()
+
+
+def test_wire_roundtrip_from_nodes():
+    # Trees built from separate nodes each have their own key table
+    child = ProfilingNode(key="Ü:run", start=1, cpu=2, intents=-1, children=[])
+    tick = ProfilingNode(key="Tick 5", start=0, cpu=3, intents=0, children=[child])
+    ticks = make_history().decompress() + [tick]
+
+    trees = [TickTree.from_profiling_node(node) for node in ticks]
+    assert decode_history_wire(encode_history_wire(trees)) == ticks
+    assert decode_history_wire(encode_history_wire([])) == []
+
+
+def test_wire_smaller_than_json():
+    history = make_history()
+    trees = [TickTree.from_raw_tick(history, tick) for tick in history.ticks]
+    json_size = sum(len(node.model_dump_json()) for node in history.decompress())
+    assert len(encode_history_wire(trees)) * 2 < json_size
+
+
+def test_wire_roundtrip_shards():
+    data = SyntheticHistoryGenerator(seed=9).generate_json(ticks=2)
+    ticks = [
+        *RawProfilingHistory.from_json(data, shard="shard0").decompress(),
+        *RawProfilingHistory.from_json(data, shard="shard3").decompress(),
+        *RawProfilingHistory.from_json(data).decompress(),
+    ]
+
+    trees = [TickTree.from_profiling_node(node) for node in ticks]
+    decoded = decode_history_wire(encode_history_wire(trees))
+    assert [tick.shard for tick in decoded] == ["shard0"] * 2 + ["shard3"] * 2 + [
+        None
+    ] * 2
+    assert decoded == ticks
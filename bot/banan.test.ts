@@ -4,6 +4,7 @@ import {
   CompressedProfilingDump,
   ProfilingNode,
   profile,
+  splitIntoSegments,
 } from "../src/utils/profiler/banan";
 import { mockGame, mockMemory } from "./mocks";
 
@@ -124,4 +125,34 @@ describe("Banan", () => {
     const dump = JSON.parse((Memory as any).BANAN);
     expect(dump.ticks.length).toBeGreaterThan(0);
   });
+
+  test("autosave to segments", () => {
+    const test = newTestClass();
+    (global as any).RawMemory = { segments: {} };
+
+    Banan.instance.init({ autoSaveSegments: [90, 91] });
+    Banan.instance.startTick();
+    test.doWork(2);
+    Banan.instance.endTick();
+
+    const segment = RawMemory.segments[90];
+    expect(segment.startsWith(`BANAN:1:${Game.time}:0:1:`)).toBe(true);
+    const dump = JSON.parse(segment.split(":").slice(5).join(":"));
+    expect(dump.ticks.length).toBeGreaterThan(0);
+    expect(RawMemory.segments[91]).toBeUndefined();
+  });
+
+  test("history is split across segments", () => {
+    const data = "x".repeat(250 * 1024);
+    const segments = splitIntoSegments(data, 7);
+    expect(segments.length).toBe(3);
+    segments.forEach((segment, i) => {
+      expect(segment.length).toBeLessThanOrEqual(100 * 1024);
+      expect(segment.startsWith(`BANAN:1:7:${i}:3:`)).toBe(true);
+    });
+    const joined = segments
+      .map((s) => s.split(":").slice(5).join(":"))
+      .join("");
+    expect(joined).toBe(data);
+  });
 });
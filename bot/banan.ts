@@ -4,10 +4,29 @@ export const BANAN_CONFIG = {
 };
 const BANAN_DUMP_FORMAT_VERSION = 2;
 
+/** Version of the header at the start of each segment of the history */
+const BANAN_SEGMENT_FORMAT_VERSION = 1;
+
+/** Screeps limits each RawMemory segment to 100 KB */
+const SEGMENT_MAX_LENGTH = 100 * 1024;
+
+/** Room left in each segment for its header */
+const SEGMENT_HEADER_MAX_LENGTH = 64;
+
+/** Screeps saves at most 10 segments each tick */
+const MAX_SEGMENT_WRITES = 10;
+
 /** Options for configuring the profiler. */
 export interface BananOpts {
   maxHistory?: number;
   autoSaveKey?: string;
+
+  /**
+   * RawMemory segments to write the history across each tick, in order.
+   * This keeps the history out of Memory, so it isn't parsed and
+   * serialized along with the rest of Memory.
+   */
+  autoSaveSegments?: number[];
 }
 
 /**
@@ -125,6 +144,9 @@ export class Banan {
   /** The key to use for auto-saving the profiler data to Memory */
   private autoSaveKey?: string;
 
+  /** The segments to use for auto-saving the profiler data to RawMemory */
+  private autoSaveSegments?: number[];
+
   /** A list of interesting events that we want to highlight */
   private marks: ProfilingMark[] = [];
 
@@ -147,6 +169,15 @@ export class Banan {
     if (opts?.autoSaveKey) {
       this.autoSaveKey = opts.autoSaveKey;
     }
+
+    if (opts?.autoSaveSegments?.length) {
+      if (opts.autoSaveSegments.length > MAX_SEGMENT_WRITES) {
+        throw new Error(
+          `Banan can write at most ${MAX_SEGMENT_WRITES} segments each tick`,
+        );
+      }
+      this.autoSaveSegments = opts.autoSaveSegments;
+    }
   }
 
   /**
@@ -182,6 +213,10 @@ export class Banan {
     if (this.autoSaveKey) {
       this.saveToMemory(this.autoSaveKey);
     }
+
+    if (this.autoSaveSegments) {
+      this.saveToSegments(this.autoSaveSegments);
+    }
   }
 
   /**
@@ -272,6 +307,26 @@ export class Banan {
     (Memory as any)[key] = JSON.stringify(this.history);
   }
 
+  /**
+   * Write the current profiling history across RawMemory segments.
+   * Returns false if it doesn't fit in the segments given.
+   */
+  public saveToSegments(segmentIDs: number[]): boolean {
+    const segments = splitIntoSegments(JSON.stringify(this.history), Game.time);
+    if (segments.length > segmentIDs.length) {
+      console.log(
+        `BANAN history needs ${segments.length} segments, but only has`,
+        segmentIDs.length,
+      );
+      return false;
+    }
+
+    segments.forEach((segment, i) => {
+      RawMemory.segments[segmentIDs[i]] = segment;
+    });
+    return true;
+  }
+
   /**
    * Get a pointer to the history array for the given tick.
    */
@@ -454,6 +509,27 @@ const compressNode = (
   return comp;
 };
 
+/**
+ * Split a dump of the history into the values of RawMemory segments.
+ * Each starts with a header of `BANAN:<version>:<write tick>:<index>:<count>:`
+ * so that a reader can check it has every part of the same write.
+ * See the equivalent Python in the backend's `segments.py`.
+ */
+export const splitIntoSegments = (
+  data: string,
+  writeTick: number,
+): string[] => {
+  const chunkLength = SEGMENT_MAX_LENGTH - SEGMENT_HEADER_MAX_LENGTH;
+  const count = Math.max(1, Math.ceil(data.length / chunkLength));
+  const segments: string[] = [];
+  for (let i = 0; i < count; i++) {
+    const header =
+      `BANAN:${BANAN_SEGMENT_FORMAT_VERSION}:` + `${writeTick}:${i}:${count}:`;
+    segments.push(header + data.slice(i * chunkLength, (i + 1) * chunkLength));
+  }
+  return segments;
+};
+
 /**
  * Profiling decorator that should be applied to any code to be profiled.
  */
@@ -7,12 +7,27 @@ import type {
 
 import { colorByTotalDuration } from "./colors";
 import { renderFlameGraph } from "./flamegraph";
+import { decodeHistoryWire } from "./wire";
 
 type GraphDisplayMode = "single-tick-call-tree" | "single-tick-totals";
 
+/** The most ticks kept in the page as new ones arrive from the live tail */
+const MAX_LIVE_HISTORY = 1000;
+
+/**
+ * Identify a tick across shards, which each count their own ticks, so the
+ * same tick key can come from more than one shard.
+ */
+const tickId = (node: ProfilingNode): string =>
+	`${node.shard ?? ""}:${node.key}`;
+
+const tickLabel = (node: ProfilingNode): string =>
+	node.shard ? `${node.shard} ${node.key}` : node.key;
+
 class AppEvents {
 	private static currentHistory: ProfilingNode[] | undefined;
 	private static graphDisplayMode: GraphDisplayMode = "single-tick-call-tree";
+	/** The id of the selected tick, from `tickId` */
 	private static selectedTick: string | undefined;
 
 	/**
@@ -41,6 +56,50 @@ class AppEvents {
 		AppEvents.onSetGraphDisplayMode("single-tick-call-tree");
 	}
 
+	/**
+	 * The shard of the tick being viewed, whose new ticks the live tail
+	 * follows.
+	 */
+	static getViewedShard(): string | undefined {
+		const node = AppEvents.selectedTick
+			? AppEvents.getNodeForTick(AppEvents.selectedTick)
+			: AppEvents.getNodeForMostRecentTick();
+		return node?.shard;
+	}
+
+	/**
+	 * Called when a newly ingested tick arrives from the live tail.
+	 */
+	static onLiveTick(tick: ProfilingNode) {
+		const id = tickId(tick);
+		const history = AppEvents.currentHistory ?? [];
+		if (history.some((node) => tickId(node) === id)) return;
+
+		const latest = history
+			.filter((node) => node.shard === tick.shard)
+			.pop();
+		history.push(tick);
+		if (history.length > MAX_LIVE_HISTORY) history.shift();
+		AppEvents.currentHistory = history;
+
+		const availableTicksElem = document.getElementById(
+			"availableTicks",
+		) as HTMLSelectElement;
+		availableTicksElem.add(new Option(tickLabel(tick), id));
+		while (availableTicksElem.options.length > MAX_LIVE_HISTORY) {
+			availableTicksElem.remove(0);
+		}
+
+		// Keep showing the newest tick, unless an older one was picked
+		if (
+			!AppEvents.selectedTick ||
+			(latest && AppEvents.selectedTick === tickId(latest))
+		) {
+			availableTicksElem.value = id;
+			AppEvents.onSetSelectedTick(id);
+		}
+	}
+
 	/**
 	 * Called after we fail to fetch profiling history from the API.
 	 */
@@ -70,8 +129,9 @@ class AppEvents {
 
 		let selectedTick = AppEvents.selectedTick;
 		if (!selectedTick && AppEvents.currentHistory?.length) {
-			selectedTick =
-				AppEvents.currentHistory[AppEvents.currentHistory.length - 1].key;
+			selectedTick = tickId(
+				AppEvents.currentHistory[AppEvents.currentHistory.length - 1],
+			);
 		}
 
 		if (selectedTick) AppEvents.onSetSelectedTick(selectedTick);
@@ -113,6 +173,12 @@ class AppEvents {
 		}
 
 		AppEvents.onSetCurrentNode(node);
+
+		// Follow the shard of the tick now being viewed
+		const history = AppEvents.currentHistory;
+		if (history && liveTail && liveTailShard !== AppEvents.getViewedShard()) {
+			startLiveTail(history, AppEvents.getViewedShard());
+		}
 	}
 
 	/**
@@ -126,20 +192,22 @@ class AppEvents {
 	 * Update the available ticks dropdown.
 	 */
 	private static setAvailableTicks(resp: ApiHistoryResponse) {
-		const availableTicksElem = document.getElementById("availableTicks")!;
+		const availableTicksElem = document.getElementById(
+			"availableTicks",
+		) as HTMLSelectElement;
 		availableTicksElem.innerHTML = "";
 		AppEvents.currentHistory = resp.history;
 		for (const dump of resp.history || []) {
-			availableTicksElem.innerHTML += `<option value="${dump.key}">${dump.key}</option>`;
+			availableTicksElem.add(new Option(tickLabel(dump), tickId(dump)));
 		}
 	}
 
 	/**
 	 * Try and get the node for the given tick from the current history.
 	 */
-	private static getNodeForTick(key: string): ProfilingNode | undefined {
+	private static getNodeForTick(id: string): ProfilingNode | undefined {
 		for (const node of AppEvents.currentHistory || []) {
-			if (node.key === key) {
+			if (tickId(node) === id) {
 				return node;
 			}
 		}
@@ -348,19 +416,52 @@ const renderSummary = (node: ProfilingNode) => {
 const refreshHistoryData = () => {
 	console.log("Refreshing graph");
 
-	fetch("/api/history/pserver")
-		.then((response) => response.json())
-		.then((data) => {
-			console.log("history", data);
-			const apiResp = data as ApiHistoryResponse;
+	// The compact wire format is much quicker to transfer and decode than JSON
+	fetch("/api/history/pserver?format=wire").then(async (response) => {
+		if (!response.ok) {
+			const data = await response.json();
+			AppEvents.onFetchHistoryError(data.detail || response.statusText);
+			return;
+		}
 
-			if (apiResp.error) {
-				AppEvents.onFetchHistoryError(apiResp.error);
-				return;
-			}
+		const history = decodeHistoryWire(await response.arrayBuffer());
+		console.log("history", history);
+		AppEvents.onFetchHistory({ history });
+		startLiveTail(history, AppEvents.getViewedShard());
+	});
+};
+
+let liveTail: EventSource | undefined;
+let liveTailShard: string | undefined;
 
-			AppEvents.onFetchHistory(data);
-		});
+/**
+ * Follow the ticks of a shard ingested after the given history, one event
+ * per tick. Without a shard, the server's default shard is followed. If
+ * the connection drops, the browser reconnects by itself and resumes after
+ * the last tick it was sent.
+ */
+const startLiveTail = (history: ProfilingNode[], shard?: string) => {
+	liveTail?.close();
+
+	const params = new URLSearchParams();
+	if (shard) params.set("shard", shard);
+	const tickNumbers = history
+		.filter((node) => node.shard === shard)
+		.map((node) => Number(node.key.split(" ")[1]));
+	const lastTick = Math.max(...tickNumbers.filter(Number.isFinite));
+	if (Number.isFinite(lastTick)) {
+		params.set("after", String(lastTick));
+	}
+
+	const query = params.toString();
+	liveTail = new EventSource(
+		`/api/history_live/pserver${query ? `?${query}` : ""}`,
+	);
+	liveTailShard = shard;
+	liveTail.addEventListener("tick", (event) => {
+		const tick = JSON.parse((event as MessageEvent).data) as ProfilingNode;
+		AppEvents.onLiveTick(tick);
+	});
 };
 
 window.addEventListener("load", () => {
@@ -18,6 +18,8 @@ export interface ProfilingNode {
 	children: ProfilingNode[];
 	marks?: Mark[];
 	intents?: number;
+	timestamp?: number;
+	shard?: string;
 }
 
 export type ProfilingSummary = ProfilingSummaryItem[];
@@ -0,0 +1,152 @@
+import type { ProfilingNode } from "./types";
+
+/**
+ * Decoder for the compact binary history format of backend/src/wire.py.
+ *
+ * The history is sent as a string table and flat typed columns, which are
+ * viewed in place rather than parsed like JSON.
+ */
+
+export const WIRE_MEDIA_TYPE = "application/x-banan-wire";
+
+const MAGIC = "BANW";
+const VERSION = 2;
+const HEADER_SIZE = 32;
+const NO_SHARD = 0xffffffff;
+
+/**
+ * The columns of a history, as sent by the backend.
+ */
+export interface WireHistory {
+	strings: string[];
+	tickRoot: Uint32Array;
+	tickTimestamp: Float64Array;
+	tickShard: Uint32Array;
+	nodeKey: Uint32Array;
+	nodeStart: Float64Array;
+	nodeCpu: Float64Array;
+	nodeIntents: Int32Array;
+	nodeSubtreeEnd: Uint32Array;
+	markTick: Uint32Array;
+	markShortName: Uint32Array;
+	markFullName: Uint32Array;
+	markTimestamp: Float64Array;
+}
+
+/**
+ * View the columns of a history in the wire format.
+ */
+export const decodeWireHistory = (buffer: ArrayBuffer): WireHistory => {
+	const header = new DataView(buffer, 0, HEADER_SIZE);
+	const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4));
+	const version = header.getUint32(4, true);
+	if (magic !== MAGIC || version !== VERSION) {
+		throw new Error(`Unsupported wire format: ${magic} v${version}`);
+	}
+
+	const stringCount = header.getUint32(8, true);
+	const stringBytes = header.getUint32(12, true);
+	const tickCount = header.getUint32(16, true);
+	const nodeCount = header.getUint32(20, true);
+	const markCount = header.getUint32(24, true);
+
+	// Every section starts on an 8 byte boundary
+	let offset = HEADER_SIZE;
+	const read = <T>(
+		ArrayType: {
+			new (buffer: ArrayBuffer, offset: number, length: number): T;
+			BYTES_PER_ELEMENT: number;
+		},
+		length: number,
+	): T => {
+		const array = new ArrayType(buffer, offset, length);
+		const size = length * ArrayType.BYTES_PER_ELEMENT;
+		offset += size + ((8 - (size % 8)) % 8);
+		return array;
+	};
+
+	const stringLengths = read(Uint32Array, stringCount);
+	const stringData = read(Uint8Array, stringBytes);
+	const decoder = new TextDecoder();
+	const strings: string[] = [];
+	let stringStart = 0;
+	for (const length of stringLengths) {
+		strings.push(
+			decoder.decode(stringData.subarray(stringStart, stringStart + length)),
+		);
+		stringStart += length;
+	}
+
+	return {
+		strings,
+		tickRoot: read(Uint32Array, tickCount),
+		tickTimestamp: read(Float64Array, tickCount),
+		tickShard: read(Uint32Array, tickCount),
+		nodeKey: read(Uint32Array, nodeCount),
+		nodeStart: read(Float64Array, nodeCount),
+		nodeCpu: read(Float64Array, nodeCount),
+		nodeIntents: read(Int32Array, nodeCount),
+		nodeSubtreeEnd: read(Uint32Array, nodeCount),
+		markTick: read(Uint32Array, markCount),
+		markShortName: read(Uint32Array, markCount),
+		markFullName: read(Uint32Array, markCount),
+		markTimestamp: read(Float64Array, markCount),
+	};
+};
+
+/**
+ * Decode a history in the wire format to a tree for each tick.
+ */
+export const decodeHistoryWire = (buffer: ArrayBuffer): ProfilingNode[] => {
+	const wire = decodeWireHistory(buffer);
+	const nodeCount = wire.nodeKey.length;
+
+	const nodes: ProfilingNode[] = new Array(nodeCount);
+	// Nodes are in pre-order, so each is a child of the closest earlier
+	// node whose subtree holds it
+	const openNodes: number[] = [];
+	for (let i = 0; i < nodeCount; i++) {
+		const node: ProfilingNode = {
+			key: wire.strings[wire.nodeKey[i]],
+			start: wire.nodeStart[i],
+			cpu: wire.nodeCpu[i],
+			intents: wire.nodeIntents[i],
+			children: [],
+		};
+		nodes[i] = node;
+
+		while (
+			openNodes.length &&
+			wire.nodeSubtreeEnd[openNodes[openNodes.length - 1]] <= i
+		) {
+			openNodes.pop();
+		}
+		if (openNodes.length) {
+			nodes[openNodes[openNodes.length - 1]].children.push(node);
+		}
+		openNodes.push(i);
+	}
+
+	const ticks = Array.from(wire.tickRoot, (root, i) => {
+		const tick = nodes[root];
+		if (!Number.isNaN(wire.tickTimestamp[i])) {
+			tick.timestamp = wire.tickTimestamp[i];
+		}
+		if (wire.tickShard[i] !== NO_SHARD) {
+			tick.shard = wire.strings[wire.tickShard[i]];
+		}
+		return tick;
+	});
+
+	for (let i = 0; i < wire.markTick.length; i++) {
+		const tick = ticks[wire.markTick[i]];
+		tick.marks = tick.marks || [];
+		tick.marks.push({
+			shortName: wire.strings[wire.markShortName[i]],
+			fullName: wire.strings[wire.markFullName[i]],
+			timestamp: wire.markTimestamp[i],
+		});
+	}
+
+	return ticks;
+};